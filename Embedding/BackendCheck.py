@@ -0,0 +1,122 @@
+'''
+-- @Time    : 2025/7/23 10:15
+-- @File    : BackendCheck.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+"""
+Compare the configured embedding backend (settings.EMBEDDING_BACKEND, EMBEDDING_TRUNCATE_DIM, EMBEDDING_STORAGE_DTYPE)
+with full-precision PyTorch on the (previous, new) outline pairs the twist router scored (settings.SIMILARITY_LOG_PATH),
+and check that the twist decision (similarity >= settings.SIMILARITY_THRESHOLD) comes out the same.
+run in bash: python -m Embedding.BackendCheck [--file memory_storage/similarity_pairs.jsonl] [--min-agreement 1.0]
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from Embedding.EmbeddingProvider import provider, twist_model
+from Embedding.LongText import chunk_texts, pool
+
+
+def load_outline_pairs(path: str) -> List[Tuple[str, str]]:
+    """
+    Read the (previous, new) outline pairs the twist router scored, logged by calculate_similarity.
+
+    :param path: (str) Similarity log (JSONL, like similarity_pairs.jsonl).
+    :return: (List[Tuple[str, str]]) Outline pairs, unreadable lines skipped.
+    """
+    pairs = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                pairs.append((str(record['previous']), str(record['new'])))
+            except (json.JSONDecodeError, TypeError, KeyError):
+                continue
+    return pairs
+
+
+def encode_pairs(texts: List[str], baseline: bool, long_text: bool = True) -> np.ndarray:
+    """
+    Encode outlines the way calculate_similarity does (settings.TWIST_EMBEDDING_MODEL), bypassing the embedding cache.
+
+    :param texts: (List[str]) Outlines.
+    :param baseline: (bool) Use the full-precision reference variant instead of the configured backend.
+    :param long_text: (bool) Encode long outlines chunk by chunk, like settings.EMBEDDING_LONG_TEXT.
+    :return: (numpy.ndarray) L2-normalised float32 embeddings, one row per text.
+    """
+    if not long_text:
+        return provider.encode(texts, twist_model(), baseline=baseline, use_cache=False)
+    from settings import EMBEDDING_CHUNK_TOKENS
+    chunks, owners, lengths = chunk_texts(texts, EMBEDDING_CHUNK_TOKENS)
+    vectors = provider.encode(chunks, twist_model(), baseline=baseline, use_cache=False)
+    if len(chunks) == len(texts):
+        return vectors
+    return pool(vectors, owners, lengths, len(texts))
+
+
+def compare(pairs: List[Tuple[str, str]], threshold: float, long_text: bool = True) -> Dict[str, float]:
+    """
+    Encode the outlines with both variants, bypassing the embedding cache, and compare the similarity of every pair.
+
+    :param pairs: (List[Tuple[str, str]]) (previous, new) outline pairs.
+    :param threshold: (float) Similarity from which a twist is triggered.
+    :param long_text: (bool) Embed long outlines chunk by chunk, like settings.EMBEDDING_LONG_TEXT.
+    :return: (Dict) Pair count, decision agreement, max similarity difference and timings.
+    """
+    texts = [text for pair in pairs for text in pair]
+    provider.get(twist_model())
+    provider.get(twist_model(), backend='torch')
+    start = time.perf_counter()
+    baseline = encode_pairs(texts, baseline=True, long_text=long_text)
+    baseline_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    candidate = encode_pairs(texts, baseline=False, long_text=long_text)
+    candidate_seconds = time.perf_counter() - start
+
+    baseline_sim = np.einsum('ij,ij->i', baseline[0::2], baseline[1::2])
+    candidate_sim = np.einsum('ij,ij->i', candidate[0::2], candidate[1::2])
+    return {
+        'pairs': len(baseline_sim),
+        'agreement': float(np.mean((baseline_sim >= threshold) == (candidate_sim >= threshold))),
+        'max_abs_diff': float(np.max(np.abs(baseline_sim - candidate_sim))),
+        'baseline_seconds': baseline_seconds,
+        'candidate_seconds': candidate_seconds,
+        'speedup': baseline_seconds / max(candidate_seconds, 1e-9),
+    }
+
+
+def main() -> int:
+    from settings import SIMILARITY_THRESHOLD, SIMILARITY_LOG_PATH, EMBEDDING_LONG_TEXT
+    parser = argparse.ArgumentParser(description="Check an embedding backend against full precision")
+    parser.add_argument('--file', default=SIMILARITY_LOG_PATH, help="Outline pairs logged by the twist router (JSONL)")
+    parser.add_argument('--threshold', type=float, default=SIMILARITY_THRESHOLD)
+    parser.add_argument('--min-agreement', type=float, default=1.0,
+                        help="Fail when fewer twist decisions than this fraction agree")
+    args = parser.parse_args()
+
+    pairs = load_outline_pairs(args.file)
+    if not pairs:
+        print(f"No outline pairs in {args.file}, generate a story first")
+        return 1
+    variant = provider.variant()
+    result = compare(pairs, args.threshold, EMBEDDING_LONG_TEXT)
+    print(f"backend={variant['backend']} truncate_dim={variant['truncate_dim']} dtype={variant['dtype']}")
+    print(f"pairs: {result['pairs']}  decision agreement: {result['agreement']:.2%}  "
+          f"max |similarity diff|: {result['max_abs_diff']:.4f}")
+    print(f"encode time: torch {result['baseline_seconds']:.2f}s, "
+          f"{variant['backend']} {result['candidate_seconds']:.2f}s ({result['speedup']:.1f}x)")
+    for name, stats in provider.report().items():
+        print(f"  {name}: loaded in {stats['load_seconds']:.2f}s, +{stats['rss_mb']:.0f} MB resident")
+    if result['agreement'] < args.min_agreement:
+        print(f"FAIL: agreement below {args.min_agreement:.2%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+'''
+-- @Time    : 2025/7/24 15:40
+-- @File    : CascadeCheck.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+"""
+Replay the outline pairs the twist router scored (settings.SIMILARITY_LOG_PATH) through the similarity cascade
+(settings.CASCADE_BAND) and report how often its decision disagrees with the embedding model's
+(similarity >= settings.SIMILARITY_THRESHOLD), and the narrowest band that would have agreed on every pair.
+run in bash: python -m Embedding.CascadeCheck [--file memory_storage/similarity_pairs.jsonl] [--min-agreement 1.0]
+"""
+import argparse
+import sys
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from Embedding.BackendCheck import load_outline_pairs
+from Embedding.EmbeddingProvider import provider, twist_model
+from Embedding.SimilarityCascade import SimilarityCascade, lexical_similarity
+
+
+def calibrate(pairs: List[Tuple[str, str]], threshold: float, band: Tuple[float, float],
+              long_text: bool = True) -> Dict[str, float]:
+    """
+    Score every pair with both tiers and compare the cascade with the embedding decision.
+
+    :param pairs: (List[Tuple[str, str]]) (previous, new) outline pairs.
+    :param threshold: (float) Similarity from which a twist is triggered.
+    :param band: (Tuple[float, float]) Cascade band below and above the threshold.
+    :param long_text: (bool) Embed long outlines chunk by chunk, like settings.EMBEDDING_LONG_TEXT.
+    :return: (Dict) Pair count, agreement, missed and false twists, share decided lexically and the suggested band.
+    """
+    encode = provider.encode_long if long_text else provider.encode
+    embeddings = encode([text for pair in pairs for text in pair], twist_model())
+    similarity = np.einsum('ij,ij->i', embeddings[0::2], embeddings[1::2])
+    lexical = np.array([lexical_similarity(previous, new) for previous, new in pairs])
+    cascade = SimilarityCascade(threshold, band, encoder=None)
+    decides = np.array([cascade.lexical_decides(score) for score in lexical])
+    embedding_twist = similarity >= threshold
+    cascade_twist = np.where(decides, lexical >= cascade.high, embedding_twist)
+    # The lexical tier must not decide at or below a twist pair's score, nor at or above a plain pair's score
+    lowest_twist = lexical[embedding_twist].min() if embedding_twist.any() else threshold
+    highest_plain = lexical[~embedding_twist].max() if (~embedding_twist).any() else threshold
+    return {
+        'pairs': len(pairs),
+        'agreement': float(np.mean(cascade_twist == embedding_twist)),
+        'missed_twists': int(np.sum(embedding_twist & ~cascade_twist)),
+        'false_twists': int(np.sum(~embedding_twist & cascade_twist)),
+        'lexical_share': float(np.mean(decides)),
+        'suggested_band': (round(max(threshold - lowest_twist, 0.) + 0.01, 2),
+                           round(max(highest_plain - threshold, 0.) + 0.01, 2)),
+    }
+
+
+def main() -> int:
+    from settings import SIMILARITY_THRESHOLD, CASCADE_BAND, EMBEDDING_LONG_TEXT, SIMILARITY_LOG_PATH
+    parser = argparse.ArgumentParser(description="Check the similarity cascade against the embedding model")
+    parser.add_argument('--file', default=SIMILARITY_LOG_PATH, help="Outline pairs logged by the twist router (JSONL)")
+    parser.add_argument('--threshold', type=float, default=SIMILARITY_THRESHOLD)
+    parser.add_argument('--band', type=float, nargs=2, default=CASCADE_BAND, metavar=('BELOW', 'ABOVE'))
+    parser.add_argument('--min-agreement', type=float, default=1.0,
+                        help="Fail when fewer twist decisions than this fraction agree")
+    args = parser.parse_args()
+
+    pairs = load_outline_pairs(args.file)
+    if not pairs:
+        print(f"No outline pairs in {args.file}, generate a story first")
+        return 1
+    result = calibrate(pairs, args.threshold, tuple(args.band), EMBEDDING_LONG_TEXT)
+    print(f"band={tuple(args.band)} threshold={args.threshold}")
+    print(f"pairs: {result['pairs']}  decision agreement: {result['agreement']:.2%}  "
+          f"missed twists: {result['missed_twists']}  false twists: {result['false_twists']}")
+    print(f"decided by the lexical tier: {result['lexical_share']:.2%}")
+    print(f"narrowest band agreeing on every pair: CASCADE_BAND = {result['suggested_band']}")
+    if result['agreement'] < args.min_agreement:
+        print(f"FAIL: agreement below {args.min_agreement:.2%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+'''
+-- @Time    : 2025/7/21 10:12
+-- @File    : EmbeddingCache.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: the cache is shared by the threads of one process only
+    fcntl = None
+
+# Cache layout inside the cache directory, one sub-directory per model:
+#   <model>/vectors.f32    float32 (vectors.f16 for float16) memory-mapped array of shape (capacity, dim)
+#   <model>/index.json     snapshot {"dim", "capacity", "clock", "entries": {text_hash: [slot, last_used]}}
+#   <model>/journal.jsonl  changes since the snapshot, one line per put or flush: {"dim", "capacity", "set": [[text_hash, slot, last_used], ...]}
+#   <model>/lock           locked (flock) by the process reading or changing the cache
+VECTORS_FILES = {'float32': 'vectors.f32', 'float16': 'vectors.f16'}
+INDEX_FILE = 'index.json'
+JOURNAL_FILE = 'journal.jsonl'
+LOCK_FILE = 'lock'
+JOURNAL_COMPACT_BYTES = 4 << 20  # journal size from which it is folded into a new snapshot
+
+
+def text_key(text: str) -> str:
+    """
+    Content hash used as cache key for a text.
+
+    :param text: (str) Text that was embedded.
+    :return: (str) Hex sha1 digest of the utf-8 text.
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, directory: str, model: str, capacity: int = 50000, dtype: str = 'float32'):
+        """
+        Persistent, content-addressed embedding cache for one model with a least-recently-used size cap.
+        Vectors live in a memory-mapped float array so lookups never load the embedding model; the index maps text hashes to rows.
+        A put appends its new rows to a journal instead of rewriting the index, the journal is folded into the index
+        when it grows past JOURNAL_COMPACT_BYTES and on flush.
+        The cache is safe to share between threads and, through a locked file, between processes: every read and write
+        first catches up with what the other processes wrote (on Windows, only one process should use a directory).
+
+        :param directory: (str) Root directory of the cache.
+        :param model: (str) Model path, a separate sub-directory is used for every model.
+        :param capacity: (int) Maximum number of cached vectors before the least recently used ones are evicted.
+        :param dtype: (str) Storage precision, 'float32' or 'float16'.
+        """
+        self.model = model
+        self.path = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]+', '__', model))
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.vectors_file = VECTORS_FILES[self.dtype.name]
+        self.dim = None
+        self.clock = 0
+        self._entries = {}      # text hash -> slot
+        self._slot_keys = []    # slot -> text hash
+        self._ticks = np.zeros(0, dtype=np.int64)  # slot -> last used clock
+        self._vectors = None
+        self._touched = set()   # slots used since their recency was last journaled
+        self._snapshot = None   # identity of the index file read last
+        self._journal_offset = 0  # bytes of the journal applied
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with self._lock, self._file_lock():
+                self._sync()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _file_lock(self):
+        # Exclusive lock of the cache directory across processes, the caller holds self._lock
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _signature(self) -> Optional[Tuple[int, int, int]]:
+        # A compaction or clear of any process replaces the index file
+        try:
+            stat = os.stat(self._file(INDEX_FILE))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _sync(self):
+        """
+        Catch up with the other processes: a new index is read again from scratch,
+        otherwise only the journal lines appended since the last sync are applied.
+        """
+        journal_path = self._file(JOURNAL_FILE)
+        journal_size = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+        if self._signature() != self._snapshot or journal_size < self._journal_offset:
+            self._reset()
+            self._load()
+        if journal_size == self._journal_offset:
+            return
+        with open(journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # cut short by a crash, the next append drops it
+                record = json.loads(line)
+                self._grow(record['dim'], record['capacity'])
+                self._apply(record['set'])
+                self._journal_offset += len(line)
+
+    def _load(self):
+        """
+        Read the index, if there is one.
+        """
+        self._snapshot = self._signature()
+        if self._snapshot is None:
+            return
+        with open(self._file(INDEX_FILE), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self._grow(index['dim'], index['capacity'])
+        self.clock = max(self.clock, index['clock'])
+        self._apply([[key, slot, tick] for key, (slot, tick) in index['entries'].items()])
+
+    def _reset(self):
+        self._entries = {}
+        self._slot_keys = []
+        self._ticks = np.zeros(0, dtype=np.int64)
+        self._vectors = None
+        self._touched = set()
+        self._snapshot = None
+        self._journal_offset = 0
+        self.dim = None
+
+    def _grow(self, dim: int, capacity: int):
+        # Open the vectors, or map them again when another process cached more vectors than this one allows
+        if self._vectors is None or capacity > self.capacity:
+            self.capacity = max(self.capacity, capacity)
+            self._open_vectors(dim)
+
+    def _apply(self, records: List[List]):
+        """
+        Point text hashes at rows, the texts previously held by those rows are evicted.
+
+        :param records: (List) [text hash, slot, last used] per row.
+        """
+        for key, slot, tick in records:
+            if slot >= len(self._slot_keys):
+                grow = slot + 1 - len(self._slot_keys)
+                self._slot_keys.extend([None] * grow)
+                self._ticks = np.concatenate((self._ticks, np.zeros(grow, dtype=np.int64)))
+            old = self._slot_keys[slot]
+            if old is not None and old != key:
+                del self._entries[old]
+            previous = self._entries.get(key)
+            if previous is not None and previous != slot:
+                self._slot_keys[previous] = None
+                self._ticks[previous] = 0
+            self._entries[key] = slot
+            self._slot_keys[slot] = key
+            self._ticks[slot] = tick
+            self.clock = max(self.clock, tick)
+    def _open_vectors(self, dim: int):
+        """
+        Memory-map the vector file, creating or growing it to the configured capacity.
+
+        :param dim: (int) Embedding dimension of the model.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        vectors_path = os.path.join(self.path, self.vectors_file)
+        size = self.capacity * dim * self.dtype.itemsize
+        with open(vectors_path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.dim = dim
+        self._vectors = np.memmap(vectors_path, dtype=self.dtype, mode='r+', shape=(self.capacity, dim))
+
+    def get(self, texts: List[str]) -> Dict[int, np.ndarray]:
+        """
+        Look texts up in the cache and refresh their recency.
+
+        :param texts: (List[str]) Texts to look up.
+        :return: (Dict[int, numpy.ndarray]) Mapping of position in texts to its cached vector, for the hits only.
+        """
+        hits = {}
+        if not os.path.exists(self.path):
+            return hits
+        with self._lock, self._file_lock():
+            self._sync()
+            if self._vectors is None:
+                return hits
+            for i, text in enumerate(texts):
+                slot = self._entries.get(text_key(text))
+                if slot is not None:
+                    self.clock += 1
+                    self._ticks[slot] = self.clock
+                    self._touched.add(slot)
+                    hits[i] = np.array(self._vectors[slot], dtype=np.float32)
+        return hits
+
+    def put(self, texts: List[str], vectors: np.ndarray):
+        """
+        Store vectors, evicting the least recently used entries when the cache is full, and journal the new rows.
+
+        :param texts: (List[str]) Texts that were embedded.
+        :param vectors: (numpy.ndarray) Their embeddings, one row per text.
+        """
+        if len(texts) == 0:
+            return
+        with self._lock, self._file_lock():
+            self._sync()
+            if self._vectors is None:
+                self._open_vectors(vectors.shape[1])
+            new = {}
+            for text, vector in zip(texts, vectors):
+                key = text_key(text)
+                if key not in self._entries:
+                    new[key] = vector
+            keys = list(new)[-self.capacity:]
+            slots = self._free_slots(len(keys))
+            for key, slot in zip(keys, slots):
+                self.clock += 1
+                self._vectors[slot] = new[key]
+                self._entries[key] = slot
+                self._slot_keys[slot] = key
+                self._ticks[slot] = self.clock
+                self._touched.add(slot)
+            # The vectors are on disk before a journal line points at them
+            self._vectors.flush()
+            self._journal_locked()
+
+    def _free_slots(self, n: int) -> List[int]:
+        """
+        Reserve n rows, first from unused capacity, then by evicting the least recently used entries.
+
+        :param n: (int) Number of rows needed.
+        :return: (List[int]) Row indices to write to.
+        """
+        used = len(self._slot_keys)
+        fresh = list(range(used, min(used + n, self.capacity)))
+        missing = n - len(fresh)
+        evicted = []
+        if missing > 0:
+            evicted = [int(slot) for slot in np.argpartition(self._ticks, missing - 1)[:missing]]
+            for slot in evicted:
+                if self._slot_keys[slot] is not None:
+                    del self._entries[self._slot_keys[slot]]
+                    self._slot_keys[slot] = None
+        self._slot_keys.extend([None] * len(fresh))
+        self._ticks = np.concatenate((self._ticks, np.zeros(len(fresh), dtype=np.int64)))
+        return fresh + evicted
+
+    def _journal_locked(self):
+        """
+        Append the rows stored or used since the last journal line, folding the journal into the index once it is large.
+        """
+        records = [[self._slot_keys[slot], slot, int(self._ticks[slot])]
+                   for slot in sorted(self._touched) if self._slot_keys[slot] is not None]
+        self._touched = set()
+        if records:
+            line = (json.dumps({'dim': self.dim, 'capacity': self.capacity, 'set': records}) + '\n').encode('utf-8')
+            with open(self._file(JOURNAL_FILE), 'ab') as f:
+                if f.tell() != self._journal_offset:
+                    f.truncate(self._journal_offset)  # a line cut short by a crash
+                f.write(line)
+            self._journal_offset += len(line)
+        if self._journal_offset >= JOURNAL_COMPACT_BYTES:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        """
+        Write the whole index and empty the journal.
+        """
+        if self._vectors is None:
+            return
+        self._vectors.flush()
+        index = {
+            'dim': self.dim,
+            'capacity': self.capacity,
+            'clock': self.clock,
+            'entries': {key: [slot, int(self._ticks[slot])] for key, slot in self._entries.items()},
+        }
+        # Write to a temporary file of this process first so a crash never leaves a half-written index behind
+        fd, tmp_path = tempfile.mkstemp(prefix=INDEX_FILE + '.', suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._file(INDEX_FILE))
+        # Replaying the journal onto the new index changes nothing, so a crash before this line is harmless
+        open(self._file(JOURNAL_FILE), 'wb').close()
+        self._journal_offset = 0
+        self._snapshot = self._signature()
+
+    def flush(self):
+        """
+        Journal the recency of the vectors used since the last write and fold the journal into the index.
+        """
+        if not os.path.exists(self.path):
+            return
+        with self._lock, self._file_lock():
+            self._sync()
+            self._journal_locked()
+            if self._journal_offset:
+                self._compact_locked()
+
+    def clear(self):
+        """
+        Drop every cached vector of this model, in memory and on disk.
+        """
+        with self._lock, self._file_lock():
+            self._reset()
+            self.clock = 0
+            for name in (INDEX_FILE, JOURNAL_FILE, self.vectors_file):
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
@@ -0,0 +1,306 @@
+'''
+-- @Time    : 2025/7/20 14:05
+-- @File    : EmbeddingProvider.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import atexit
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from Embedding.EmbeddingCache import EmbeddingCache
+from Embedding.LongText import chunk_texts, pool
+
+# Known sentence-transformers checkpoints, addressable by short name or full path
+EMBEDDING_MODELS = {
+    'all-mpnet-base-v2': 'sentence-transformers/all-mpnet-base-v2',
+    'all-MiniLM-L6-v2': 'sentence-transformers/all-MiniLM-L6-v2',
+}
+
+
+# Inference backends: sentence-transformers' own 'torch', 'onnx' and 'openvino',
+# plus 'torch-int8', PyTorch with dynamic int8 quantization of every Linear layer
+BACKENDS = ('torch', 'torch-int8', 'onnx', 'openvino')
+
+
+def _load(path: str, backend: str):
+    """
+    Load a sentence-transformers model with the given inference backend.
+
+    :param path: (str) sentence-transformers model id or local path.
+    :param backend: (str) One of BACKENDS. 'onnx' and 'openvino' need `pip install sentence-transformers[onnx]`
+        (or [openvino]); settings.EMBEDDING_ONNX_FILE selects a pre-quantized export such as 'onnx/model_qint8_avx512.onnx'.
+    :return: (SentenceTransformer) The loaded model.
+    """
+    from sentence_transformers import SentenceTransformer
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', choose one of {BACKENDS}")
+    if backend in ('onnx', 'openvino'):
+        from settings import EMBEDDING_ONNX_FILE
+        model_kwargs = {'file_name': EMBEDDING_ONNX_FILE} if EMBEDDING_ONNX_FILE else None
+        return SentenceTransformer(path, device='cpu', backend=backend, model_kwargs=model_kwargs)
+    if backend == 'torch-int8':
+        import torch
+        model = SentenceTransformer(path, device='cpu')
+        model[0].auto_model = torch.quantization.quantize_dynamic(model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+    return SentenceTransformer(path)
+
+
+def _resident_memory_mb() -> float:
+    """
+    Current resident set size of this process in MB.
+    Reads /proc/self/statm where available, otherwise falls back to the peak RSS reported by the resource module.
+
+    :return: (float) Resident memory in MB.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class EmbeddingProvider:
+    def __init__(self, models: Optional[Dict[str, str]] = None, default: Optional[str] = None):
+        """
+        Registry of sentence embedding models. Each model is loaded the first time it is used and then shared by every caller.
+
+        :param models: (Dict[str, str]) Mapping of short names to model paths (default: EMBEDDING_MODELS).
+        :param default: (str) Model used when a caller does not name one (default: settings.EMBEDDING_MODEL).
+        """
+        self.models = dict(EMBEDDING_MODELS if models is None else models)
+        self.default = default
+        self._loaded = {}
+        self._stats = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, path: str):
+        """
+        Register a model under a short name. Nothing is loaded until the model is first requested.
+
+        :param name: (str) Short name used by callers.
+        :param path: (str) sentence-transformers model id or local path.
+        """
+        self.models[name] = path
+
+    def resolve(self, name: Optional[str] = None) -> str:
+        """
+        Turn a short name (or None for the configured default) into the model path that is actually loaded.
+
+        :param name: (str, optional) Short name or full model path.
+        :return: (str) Model path.
+        """
+        if name is None:
+            if self.default is None:
+                from settings import EMBEDDING_MODEL
+                name = EMBEDDING_MODEL
+            else:
+                name = self.default
+        return self.models.get(name, name)
+
+    def variant(self, baseline: bool = False) -> Dict:
+        """
+        Inference backend and storage options in use, read from settings.
+
+        :param baseline: (bool) Return the reference variant instead: full-precision PyTorch, full dimension, float32.
+        :return: (Dict) Keys 'backend', 'truncate_dim' and 'dtype'.
+        """
+        if baseline:
+            return {'backend': 'torch', 'truncate_dim': None, 'dtype': 'float32'}
+        from settings import EMBEDDING_BACKEND, EMBEDDING_TRUNCATE_DIM, EMBEDDING_STORAGE_DTYPE
+        return {'backend': EMBEDDING_BACKEND, 'truncate_dim': EMBEDDING_TRUNCATE_DIM, 'dtype': EMBEDDING_STORAGE_DTYPE}
+
+    def get(self, name: Optional[str] = None, backend: Optional[str] = None):
+        """
+        Return the loaded model, loading it on first use and recording its load time and resident memory cost.
+
+        :param name: (str, optional) Short name or full model path (default: configured model).
+        :param backend: (str, optional) One of BACKENDS (default: settings.EMBEDDING_BACKEND).
+        :return: (SentenceTransformer) The loaded model.
+        """
+        path = self.resolve(name)
+        backend = backend or self.variant()['backend']
+        key = f"{path} [{backend}]"
+        model = self._loaded.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            if key not in self._loaded:
+                rss_before = _resident_memory_mb()
+                start = time.perf_counter()
+                self._loaded[key] = _load(path, backend)
+                self._stats[key] = {
+                    'load_seconds': time.perf_counter() - start,
+                    'rss_mb': _resident_memory_mb() - rss_before,
+                }
+                print(f"Loaded embedding model {key} in {self._stats[key]['load_seconds']:.2f}s "
+                      f"(+{self._stats[key]['rss_mb']:.0f} MB resident)")
+        return self._loaded[key]
+
+    def cache(self, name: Optional[str] = None, baseline: bool = False) -> Optional[EmbeddingCache]:
+        """
+        The on-disk embedding cache of a model, or None when settings.EMBEDDING_CACHE_DIR is None.
+        Every backend / dimension / dtype variant of a model has its own cache, their vectors are not interchangeable.
+
+        :param name: (str, optional) Short name or full model path (default: configured model).
+        :param baseline: (bool) Cache of the full-precision reference variant.
+        :return: (EmbeddingCache) Cache shared by every caller of this model.
+        """
+        from settings import EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_SIZE
+        if EMBEDDING_CACHE_DIR is None:
+            return None
+        variant = self.variant(baseline)
+        key = f"{self.resolve(name)}@{variant['backend']}-{variant['truncate_dim'] or 'full'}-{variant['dtype']}"
+        with self._lock:
+            if key not in self._caches:
+                self._caches[key] = EmbeddingCache(EMBEDDING_CACHE_DIR, key, EMBEDDING_CACHE_SIZE, variant['dtype'])
+                atexit.register(self._caches[key].flush)
+        return self._caches[key]
+
+    def encode(self, texts: List[str], name: Optional[str] = None, batch_size: int = 32,
+               baseline: bool = False, use_cache: bool = True) -> np.ndarray:
+        """
+        Encode texts in one batched call. Texts found in the embedding cache are not sent to the model,
+        so the model is not even loaded when every text is a hit.
+        Vectors are truncated to settings.EMBEDDING_TRUNCATE_DIM and rounded to settings.EMBEDDING_STORAGE_DTYPE
+        whether or not they come from the cache, so a text always gets the same vector.
+
+        :param texts: (List[str]) Texts to encode.
+        :param name: (str, optional) Short name or full model path (default: configured model).
+        :param batch_size: (int) Number of texts per forward pass.
+        :param baseline: (bool) Use the full-precision reference variant instead of the configured backend.
+        :param use_cache: (bool) Read and write the embedding cache.
+        :return: (numpy.ndarray) L2-normalised float32 embeddings, one row per text.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        variant = self.variant(baseline)
+        cache = self.cache(name, baseline) if use_cache else None
+        if cache is None:
+            return self._encode(texts, name, batch_size, variant)
+        hits = cache.get(texts)
+        # Every distinct missing text is encoded once, in a single batch
+        missing = list(dict.fromkeys(text for i, text in enumerate(texts) if i not in hits))
+        if missing:
+            vectors = self._encode(missing, name, batch_size, variant)
+            cache.put(missing, vectors)
+            encoded = dict(zip(missing, vectors))
+            for i, text in enumerate(texts):
+                if i not in hits:
+                    hits[i] = encoded[text]
+        return np.stack([hits[i] for i in range(len(texts))]).astype(np.float32, copy=False)
+
+    def encode_long(self, texts: List[str], name: Optional[str] = None, batch_size: int = 32,
+                    max_tokens: Optional[int] = None) -> np.ndarray:
+        """
+        Encode texts that may exceed the model's max sequence length, instead of letting the model drop their tail.
+        Each text is split on sentence boundaries into chunks of at most max_tokens, all chunks of all texts
+        are encoded in one batch (through the cache), and each text's chunk vectors are averaged weighted by length.
+        A text that fits in one chunk gets exactly the vector encode would give it.
+
+        :param texts: (List[str]) Texts to encode.
+        :param name: (str, optional) Short name or full model path (default: configured model).
+        :param batch_size: (int) Number of chunks per forward pass.
+        :param max_tokens: (int, optional) Token budget of one chunk (default: settings.EMBEDDING_CHUNK_TOKENS).
+        :return: (numpy.ndarray) L2-normalised float32 embeddings, one row per text.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        if max_tokens is None:
+            from settings import EMBEDDING_CHUNK_TOKENS
+            max_tokens = EMBEDDING_CHUNK_TOKENS
+        chunks, owners, lengths = chunk_texts(texts, max_tokens)
+        vectors = self.encode(chunks, name, batch_size)
+        if len(chunks) == len(texts):
+            return vectors
+        return pool(vectors, owners, lengths, len(texts))
+
+    def _encode(self, texts: List[str], name: Optional[str], batch_size: int, variant: Dict) -> np.ndarray:
+        embeddings = self.get(name, variant['backend']).encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if variant['truncate_dim']:
+            embeddings = embeddings[:, :variant['truncate_dim']]
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings.astype(variant['dtype']).astype(np.float32)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """
+        Load time (seconds) and resident memory increase (MB) of every model loaded so far.
+
+        :return: (Dict) Mapping of model path to its load statistics.
+        """
+        return {path: dict(stats) for path, stats in self._stats.items()}
+
+
+# Process-wide provider shared by utils, Expander and StoryStarter
+provider = EmbeddingProvider()
+
+
+def twist_model() -> str:
+    """
+    Model of the twist gate and every outline comparison, whose vectors share the story's novelty index.
+
+    :return: (str) settings.TWIST_EMBEDDING_MODEL, or settings.EMBEDDING_MODEL when it is None.
+    """
+    from settings import TWIST_EMBEDDING_MODEL, EMBEDDING_MODEL
+    return TWIST_EMBEDDING_MODEL or EMBEDDING_MODEL
+
+
+def embed_outlines(previous: str, new: str) -> np.ndarray:
+    """
+    Embeddings of the outline pair the twist router scores, with the twist gate's model; with
+    settings.EMBEDDING_LONG_TEXT, outlines longer than the model's sequence length are chunked, not truncated.
+    Anything guessing the router's decision calls this too, so it sees the same score and the router hits the cache.
+
+    :param previous: (str) Previous outline.
+    :param new: (str) Newest outline.
+    :return: (numpy.ndarray) Their normalised embeddings, one row each.
+    """
+    from settings import EMBEDDING_LONG_TEXT
+    if EMBEDDING_LONG_TEXT:
+        return provider.encode_long([previous, new], twist_model())
+    return provider.encode([previous, new], twist_model())
+
+
+def get_embedder(name: Optional[str] = None):
+    """
+    Shortcut for provider.get.
+
+    :param name: (str, optional) Short name or full model path (default: configured model).
+    :return: (SentenceTransformer) The loaded model.
+    """
+    return provider.get(name)
+
+
+def encode(texts: List[str], name: Optional[str] = None, batch_size: int = 32) -> np.ndarray:
+    """
+    Shortcut for provider.encode.
+
+    :param texts: (List[str]) Texts to encode.
+    :param name: (str, optional) Short name or full model path (default: configured model).
+    :param batch_size: (int) Number of texts per forward pass.
+    :return: (numpy.ndarray) L2-normalised float32 embeddings, one row per text.
+    """
+    return provider.encode(texts, name, batch_size)
+
+
+def encode_long(texts: List[str], name: Optional[str] = None, batch_size: int = 32) -> np.ndarray:
+    """
+    Shortcut for provider.encode_long.
+
+    :param texts: (List[str]) Texts to encode, of any length.
+    :param name: (str, optional) Short name or full model path (default: configured model).
+    :param batch_size: (int) Number of chunks per forward pass.
+    :return: (numpy.ndarray) L2-normalised float32 embeddings, one row per text.
+    """
+    return provider.encode_long(texts, name, batch_size)
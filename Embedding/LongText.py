@@ -0,0 +1,114 @@
+'''
+-- @Time    : 2025/7/23 16:40
+-- @File    : LongText.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import re
+from typing import List, Tuple
+
+import numpy as np
+
+# A sentence runs up to CJK end punctuation, western end punctuation not glued to the next word (so "3.5" stays whole),
+# or a line break; closing quotes and brackets stay with their sentence
+_SENTENCE = re.compile(r'(?:[^.!?;。！？；…\n]|[.!?;](?=[^\s.!?;"\'”’)\]]))+(?:[.!?;。！？；…]+["\'”’」』）)\]]*)?|[.!?;。！？；…]+')
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]')
+
+
+def estimate_tokens(text: str) -> float:
+    """
+    Rough sub-word token count without loading a tokenizer: one token per CJK character,
+    1.3 tokens per whitespace-separated word of everything else.
+
+    :param text: (str) Any text.
+    :return: (float) Estimated token count.
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + 1.3 * len(_CJK.sub(' ', text).split())
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Split text on sentence boundaries, including Chinese and Japanese punctuation.
+
+    :param text: (str) Text to split.
+    :return: (List[str]) Non-empty sentences, in order.
+    """
+    return [s.strip() for s in _SENTENCE.findall(text) if s.strip()]
+
+
+def _hard_split(sentence: str, max_tokens: int) -> List[str]:
+    # A single sentence over the budget is cut by words (or characters for CJK text)
+    units = sentence.split() if not _CJK.search(sentence) else list(sentence)
+    joiner = ' ' if not _CJK.search(sentence) else ''
+    pieces, current = [], []
+    for unit in units:
+        if current and estimate_tokens(joiner.join(current + [unit])) > max_tokens:
+            pieces.append(joiner.join(current))
+            current = []
+        current.append(unit)
+    if current:
+        pieces.append(joiner.join(current))
+    return pieces
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """
+    Group consecutive sentences into chunks that fit the model's sequence length.
+    A text within the budget is returned as a single chunk, unchanged.
+
+    :param text: (str) Text to chunk.
+    :param max_tokens: (int) Token budget of one chunk, below the model's max_seq_length.
+    :return: (List[str]) Chunks covering the whole text.
+    """
+    if estimate_tokens(text) <= max_tokens or not text.strip():
+        return [text]
+    chunks, current, current_tokens = [], [], 0.
+    for sentence in split_sentences(text):
+        tokens = estimate_tokens(sentence)
+        if tokens > max_tokens:
+            pieces = _hard_split(sentence, max_tokens)
+        else:
+            pieces = [sentence]
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece) if len(pieces) > 1 else tokens
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(' '.join(current))
+                current, current_tokens = [], 0.
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def chunk_texts(texts: List[str], max_tokens: int) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    Chunk several texts at once, ready for a single batched encode.
+
+    :param texts: (List[str]) Texts to chunk.
+    :param max_tokens: (int) Token budget of one chunk.
+    :return: (Tuple) All chunks flattened, the owner text index of every chunk, and every chunk's length in characters.
+    """
+    chunks, owners = [], []
+    for i, text in enumerate(texts):
+        pieces = chunk_text(text, max_tokens)
+        chunks.extend(pieces)
+        owners.extend([i] * len(pieces))
+    lengths = np.fromiter((max(len(c), 1) for c in chunks), dtype=np.float32, count=len(chunks))
+    return chunks, np.asarray(owners, dtype=np.int64), lengths
+
+
+def pool(vectors: np.ndarray, owners: np.ndarray, lengths: np.ndarray, n_texts: int) -> np.ndarray:
+    """
+    Length-weighted mean of chunk embeddings per text, L2-normalised again.
+
+    :param vectors: (numpy.ndarray) Chunk embeddings, one row per chunk.
+    :param owners: (numpy.ndarray) Text index of every chunk.
+    :param lengths: (numpy.ndarray) Weight of every chunk, its length in characters.
+    :param n_texts: (int) Number of texts.
+    :return: (numpy.ndarray) One float32 embedding per text.
+    """
+    pooled = np.zeros((n_texts, vectors.shape[1]), dtype=np.float32)
+    np.add.at(pooled, owners, vectors * lengths[:, None])
+    return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
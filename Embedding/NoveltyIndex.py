@@ -0,0 +1,166 @@
+'''
+-- @Time    : 2025/7/23 16:20
+-- @File    : NoveltyIndex.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import io
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+class NoveltyIndex:
+    def __init__(self, path: Optional[str] = None, capacity: int = 64, dtype: str = 'float32'):
+        """
+        Append-only matrix of normalised segment embeddings of one story.
+        Each query compares a vector with the whole history in a single matrix-vector product,
+        memory stays O(rounds x dim) because only one row per round is stored.
+
+        :param path: (str, optional) .npy file the history is loaded from and saved to.
+        :param capacity: (int) Initial number of preallocated rows, doubled whenever it runs out.
+        :param dtype: (str) Storage precision, 'float16' halves the memory of long stories; scores are computed in float32.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self._matrix = None
+        self._size = 0
+        self._capacity = capacity
+        self._saved = 0  # rows already in the file at self._saved_path
+        self._saved_path = None
+        if path and os.path.exists(path):
+            history = np.load(path)
+            self._capacity = max(capacity, len(history))
+            self._matrix = np.zeros((self._capacity, history.shape[1]), dtype=self.dtype)
+            self._matrix[:len(history)] = history
+            self._size = len(history)
+            if history.dtype == self.dtype:
+                self._saved, self._saved_path = len(history), path
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        :return: (numpy.ndarray) The stored history, one row per added segment.
+        """
+        if self._matrix is None:
+            return np.zeros((0, 0), dtype=self.dtype)
+        return self._matrix[:self._size]
+
+    def add(self, vectors: np.ndarray):
+        """
+        Append one vector or a matrix of vectors to the history.
+
+        :param vectors: (numpy.ndarray) Normalised embedding(s), shape (dim,) or (n, dim).
+        """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self._matrix is None:
+            self._matrix = np.zeros((max(self._capacity, len(vectors)), vectors.shape[1]), dtype=self.dtype)
+        needed = self._size + len(vectors)
+        if needed > len(self._matrix):
+            grown = np.zeros((max(needed, 2 * len(self._matrix)), self._matrix.shape[1]), dtype=self.dtype)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+        self._matrix[self._size:needed] = vectors
+        self._size = needed
+
+    def query(self, vector: np.ndarray, k: int = 3) -> Tuple[float, np.ndarray, np.ndarray]:
+        """
+        Similarity of a vector to every stored segment.
+
+        :param vector: (numpy.ndarray) Normalised embedding of shape (dim,).
+        :param k: (int) Number of most similar segments to return.
+        :return: (Tuple) Max similarity (0.0 for an empty history), top-k scores and their row indices, most similar first.
+        """
+        if self._size == 0:
+            return 0.0, np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        scores = self._matrix[:self._size].astype(np.float32, copy=False) @ np.asarray(vector, dtype=np.float32)
+        k = min(k, self._size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return float(scores[top[0]]), scores[top], top
+
+    def save(self, path: Optional[str] = None):
+        """
+        Write the history to a .npy file. Rows added since the last save to the same file are appended to it,
+        so saving after every round writes one row instead of the whole history.
+
+        :param path: (str, optional) Target file (default: the path the index was created with).
+        """
+        path = path or self.path
+        vectors = self.vectors
+        if path != self._saved_path or not 0 < self._saved <= len(vectors) or not self._append(path, vectors):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            np.save(path, vectors)
+        self._saved, self._saved_path = len(vectors), path
+
+    def _append(self, path: str, vectors: np.ndarray) -> bool:
+        """
+        Append the unsaved rows to the file and update the shape in its header, which numpy pads for growing arrays.
+
+        :param path: (str) .npy file holding the first self._saved rows.
+        :param vectors: (numpy.ndarray) The whole history.
+        :return: (bool) False when the file does not hold them or its header cannot grow in place.
+        """
+        try:
+            with open(path, 'r+b') as f:
+                version = np.lib.format.read_magic(f)
+                read_header, write_header = {(1, 0): (np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0),
+                                             (2, 0): (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0)}[version]
+                shape, fortran_order, dtype = read_header(f)
+                offset = f.tell()
+                if shape != (self._saved, vectors.shape[1]) or fortran_order or dtype != self.dtype:
+                    return False
+                header = io.BytesIO()
+                write_header(header, {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                                      'shape': vectors.shape})
+                if header.tell() != offset:
+                    return False
+                # Rows first, so a crash never leaves a header counting rows that are not there
+                f.seek(offset + self._saved * vectors.shape[1] * self.dtype.itemsize)
+                f.write(np.ascontiguousarray(vectors[self._saved:]).tobytes())
+                f.truncate()
+                f.seek(0)
+                f.write(header.getvalue())
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+
+_indexes: Dict[str, NoveltyIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def story_index(path: Optional[str] = None) -> NoveltyIndex:
+    """
+    The novelty index of the current story, loaded once per process.
+
+    :param path: (str, optional) .npy file of the index (default: settings.NOVELTY_INDEX_PATH).
+    :return: (NoveltyIndex) Shared index for that path.
+    """
+    from settings import NOVELTY_INDEX_PATH, EMBEDDING_STORAGE_DTYPE
+    if path is None:
+        path = NOVELTY_INDEX_PATH
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = NoveltyIndex(path, dtype=EMBEDDING_STORAGE_DTYPE)
+        return _indexes[path]
+
+
+def reset_story_index(path: Optional[str] = None):
+    """
+    Forget the history of the previous story, in memory and on disk.
+
+    :param path: (str, optional) .npy file of the index (default: settings.NOVELTY_INDEX_PATH).
+    """
+    if path is None:
+        from settings import NOVELTY_INDEX_PATH
+        path = NOVELTY_INDEX_PATH
+    with _indexes_lock:
+        _indexes.pop(path, None)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,97 @@
+'''
+-- @Time    : 2025/7/26 15:30
+-- @File    : OutlineSelector.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+class OutlineSelector:
+    def __init__(self, encoder: Callable[[List[str]], np.ndarray], relevance_weight: float = 1.0,
+                 novelty_weight: float = 1.0, margin: float = 0.02):
+        """
+        Picks one candidate outline with embeddings instead of an LLM judge:
+        score = relevance_weight * relevance to the goal and topic + novelty_weight * novelty against the story so far.
+
+        :param encoder: (Callable) Batch encoder returning normalised embeddings, one row per text.
+        :param relevance_weight: (float) Weight of the mean similarity to MainGoal and Topic.
+        :param novelty_weight: (float) Weight of 1 - the highest similarity to the previous outline and the story history.
+        :param margin: (float) Score gap between the two best candidates below which the choice counts as too close to call.
+        """
+        self.encoder = encoder
+        self.relevance_weight = relevance_weight
+        self.novelty_weight = novelty_weight
+        self.margin = margin
+
+    def score(self, candidates: List[str], goal: str = "", topic: str = "", last_outline: str = "",
+              history: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Relevance and novelty of every candidate, all texts embedded in one batch.
+
+        :param candidates: (List[str]) Candidate outlines.
+        :param goal: (str) Main goal of the story, skipped when empty.
+        :param topic: (str) Topic of the story, skipped when empty.
+        :param last_outline: (str) Outline the candidates continue, skipped when empty.
+        :param history: (numpy.ndarray, optional) Normalised embeddings of earlier outlines, e.g. the story's novelty index.
+        :return: (Tuple) Relevance and novelty arrays, one value per candidate.
+        """
+        anchors = [text for text in (goal, topic) if text and text.strip()]
+        previous = [last_outline] if last_outline and last_outline.strip() else []
+        vectors = np.asarray(self.encoder(list(candidates) + anchors + previous), dtype=np.float32)
+        n = len(candidates)
+        cands, anchor_vectors, previous_vectors = vectors[:n], vectors[n:n + len(anchors)], vectors[n + len(anchors):]
+        relevance = (cands @ anchor_vectors.T).mean(axis=1) if len(anchors) else np.zeros(n, dtype=np.float32)
+        story = [previous_vectors]
+        if history is not None and len(history) and history.shape[1] == cands.shape[1]:
+            story.append(np.asarray(history, dtype=np.float32))
+        story = np.concatenate(story)
+        novelty = 1. - (cands @ story.T).max(axis=1) if len(story) else np.ones(n, dtype=np.float32)
+        return relevance, novelty
+
+    def select(self, candidates: List[str], goal: str = "", topic: str = "", last_outline: str = "",
+               history: Optional[np.ndarray] = None) -> Tuple[int, bool, str]:
+        """
+        Best candidate by weighted relevance and novelty.
+
+        :param candidates: (List[str]) Candidate outlines.
+        :param goal: (str) Main goal of the story.
+        :param topic: (str) Topic of the story.
+        :param last_outline: (str) Outline the candidates continue.
+        :param history: (numpy.ndarray, optional) Normalised embeddings of earlier outlines.
+        :return: (Tuple) Index of the best candidate, whether the runner-up is within the margin,
+            and a one-line reason with the scores.
+        """
+        if len(candidates) == 1:
+            return 0, False, "Only one candidate outline."
+        relevance, novelty = self.score(candidates, goal, topic, last_outline, history)
+        total = self.relevance_weight * relevance + self.novelty_weight * novelty
+        order = np.argsort(-total)
+        best, gap = int(order[0]), float(total[order[0]] - total[order[1]])
+        reason = (f"Local selection of outline {best + 1}: relevance {relevance[best]:.3f}, novelty {novelty[best]:.3f}, "
+                  f"ahead of outline {int(order[1]) + 1} by {gap:.3f}.")
+        return best, gap < self.margin, reason
+
+
+_selector = None
+_selector_lock = threading.Lock()
+
+
+def outline_selector() -> OutlineSelector:
+    """
+    Process-wide selector configured from settings (SELECTOR_WEIGHTS, SELECTOR_MARGIN, EMBEDDING_LONG_TEXT).
+
+    :return: (OutlineSelector) Shared selector, created on first use.
+    """
+    global _selector
+    with _selector_lock:
+        if _selector is None:
+            from settings import SELECTOR_WEIGHTS, SELECTOR_MARGIN, EMBEDDING_LONG_TEXT
+            from Embedding.EmbeddingProvider import provider, twist_model
+            encode = provider.encode_long if EMBEDDING_LONG_TEXT else provider.encode
+            encoder = lambda texts: encode(texts, twist_model())
+            _selector = OutlineSelector(encoder, SELECTOR_WEIGHTS[0], SELECTOR_WEIGHTS[1], SELECTOR_MARGIN)
+        return _selector
@@ -0,0 +1,155 @@
+'''
+-- @Time    : 2025/7/24 11:05
+-- @File    : SimilarityCascade.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import math
+import re
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+_SPACES = re.compile(r'\s+')
+
+
+def char_ngrams(text: str, n: int = 3) -> Counter:
+    """
+    Character n-gram counts of a text, lower-cased with whitespace collapsed.
+    Character shingles need no tokenizer, so they work the same for English and CJK text.
+
+    :param text: (str) Any text.
+    :param n: (int) Shingle length.
+    :return: (Counter) n-gram -> count.
+    """
+    text = _SPACES.sub(' ', text.lower()).strip()
+    if len(text) < n:
+        return Counter([text]) if text else Counter()
+    return Counter(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+def lexical_similarity(text1: str, text2: str, n: int = 3) -> float:
+    """
+    Cosine similarity of the character n-gram count vectors of two texts.
+
+    :param text1: (str) First text.
+    :param text2: (str) Second text.
+    :param n: (int) Shingle length.
+    :return: (float) Score in [0, 1].
+    """
+    grams1, grams2 = char_ngrams(text1, n), char_ngrams(text2, n)
+    if not grams1 or not grams2:
+        return 0.
+    if len(grams1) > len(grams2):
+        grams1, grams2 = grams2, grams1
+    dot = sum(count * grams2[gram] for gram, count in grams1.items())
+    norm1 = math.sqrt(sum(c * c for c in grams1.values()))
+    norm2 = math.sqrt(sum(c * c for c in grams2.values()))
+    return dot / (norm1 * norm2)
+
+
+class SimilarityCascade:
+    def __init__(self, threshold: float, band: Tuple[float, float], encoder: Callable[[List[str]], np.ndarray],
+                 ngram: int = 3):
+        """
+        Cheap-first similarity: a character n-gram cosine decides the clear cases,
+        the embedding model only runs when the lexical score falls inside the uncertainty band around the threshold.
+
+        :param threshold: (float) Similarity above which the router triggers a twist.
+        :param band: (Tuple[float, float]) Distances below and above the threshold where the lexical score is not trusted,
+            e.g. (0.35, 0.15) with threshold 0.8 sends lexical scores in [0.45, 0.95] to the embedding model.
+        :param encoder: (Callable) Batch encoder returning normalised embeddings, one row per text.
+        :param ngram: (int) Character shingle length of the lexical tier.
+        """
+        self.threshold = threshold
+        self.low = threshold - band[0]
+        self.high = threshold + band[1]
+        self.encoder = encoder
+        self.ngram = ngram
+        self._lock = threading.Lock()
+        self._decided = Counter()
+
+    def score(self, text1: str, text2: str) -> Tuple[float, Optional[float], str]:
+        """
+        Similarity of two texts through the cheapest tier that can decide.
+        The lexical score is on its own scale, only the embedding similarity can be compared with the threshold.
+
+        :param text1: (str) Previous outline.
+        :param text2: (str) Newest outline.
+        :return: (Tuple) Lexical score, embedding similarity (None when the lexical tier decided)
+            and the deciding tier ('lexical' or 'embedding').
+        """
+        lexical, embeddings, tier = self.compare(text1, text2)
+        return lexical, None if embeddings is None else float(embeddings[0] @ embeddings[1]), tier
+
+    def compare(self, text1: str, text2: str) -> Tuple[float, Optional[np.ndarray], str]:
+        """
+        Like score(), but returns the embeddings of the two texts, for callers that keep them (e.g. in a novelty index).
+
+        :param text1: (str) Previous outline.
+        :param text2: (str) Newest outline.
+        :return: (Tuple) Lexical score, normalised embeddings of both texts (None when the lexical tier decided)
+            and the deciding tier ('lexical' or 'embedding').
+        """
+        lexical = lexical_similarity(text1, text2, self.ngram)
+        if self.lexical_decides(lexical):
+            self._count('lexical')
+            return lexical, None, 'lexical'
+        embeddings = self.encoder([text1, text2])
+        self._count('embedding')
+        return lexical, embeddings, 'embedding'
+
+    def lexical_decides(self, lexical: float) -> bool:
+        """
+        :param lexical: (float) Lexical score of two texts.
+        :return: (bool) True when the score lies outside the uncertainty band, so the embedding model is not asked.
+        """
+        return lexical <= self.low or lexical >= self.high
+
+    def decide(self, lexical: float, similarity: Optional[float] = None) -> bool:
+        """
+        The twist decision of a pair scored by score().
+
+        :param lexical: (float) Lexical score.
+        :param similarity: (float, optional) Embedding similarity, None when the lexical tier decided.
+        :return: (bool) True when the pair is similar enough to trigger a twist.
+        """
+        if similarity is not None:
+            return similarity >= self.threshold
+        return lexical >= self.high
+
+    def _count(self, tier: str):
+        with self._lock:
+            self._decided[tier] += 1
+
+    def report(self) -> Dict[str, int]:
+        """
+        How many decisions each tier made so far.
+
+        :return: (Dict[str, int]) Tier -> number of decisions.
+        """
+        with self._lock:
+            return {'lexical': self._decided['lexical'], 'embedding': self._decided['embedding']}
+
+
+_cascade = None
+_cascade_lock = threading.Lock()
+
+
+def similarity_cascade() -> SimilarityCascade:
+    """
+    Process-wide cascade configured from settings (SIMILARITY_THRESHOLD, CASCADE_BAND, EMBEDDING_LONG_TEXT).
+
+    :return: (SimilarityCascade) Shared cascade, created on first use.
+    """
+    global _cascade
+    with _cascade_lock:
+        if _cascade is None:
+            from settings import SIMILARITY_THRESHOLD, CASCADE_BAND, EMBEDDING_LONG_TEXT
+            from Embedding.EmbeddingProvider import provider, twist_model
+            encode = provider.encode_long if EMBEDDING_LONG_TEXT else provider.encode
+            encoder = lambda texts: encode(texts, twist_model())
+            _cascade = SimilarityCascade(SIMILARITY_THRESHOLD, CASCADE_BAND, encoder)
+        return _cascade
@@ -0,0 +1,20 @@
+'''
+-- @Time    : 2025/7/20 14:05
+-- @File    : __init__.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+from Embedding.EmbeddingCache import EmbeddingCache
+from Embedding.EmbeddingProvider import EmbeddingProvider, EMBEDDING_MODELS, BACKENDS, provider, get_embedder, encode, encode_long, twist_model, embed_outlines
+from Embedding.NoveltyIndex import NoveltyIndex, story_index, reset_story_index
+from Embedding.SimilarityCascade import SimilarityCascade, lexical_similarity, similarity_cascade
+from Embedding.OutlineSelector import OutlineSelector, outline_selector
+'''
+Usage:
+from Embedding import encode
+vectors = encode(["first paragraph", "second paragraph"])  # normalised float32, one row per text
+similarity = float(vectors[0] @ vectors[1])
+long_vectors = encode_long([expanded_segment])  # chunked on sentence boundaries instead of truncated
+outline_vectors = encode([previous_outline, new_outline], twist_model())  # the twist gate's model
+index, too_close, reason = outline_selector().select(candidates, goal, topic, last_outline)  # no LLM call
+'''
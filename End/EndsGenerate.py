@@ -5,13 +5,15 @@
 -- @IDE     : PyCharm
 '''
 import os, sys
+import asyncio
 from StoryState import StoryState
 import warnings
 
 warnings.filterwarnings("ignore")
-from utils import get_content_between_a_b, set_env
-set_env()
-from settings import *
+from utils import get_content_between_a_b
+import settings
+from LLM import invoke_llm, ainvoke_llm, LLMCallError, story_sink, prompt_budget
+from memory_storage.MemoryWriter import flush_memory
 
 # Add the parent directory to sys.path for module imports
 current_dir = os.getcwd()
@@ -40,14 +42,18 @@ def parser_end(str):
     """
     return get_content_between_a_b("## ending:", "##END", str)
 
-def pull_long_story(path = MEMORY_STORAGE_PATH):
+# The part of the ending response that is streamed, see parser_end
+END_MARKERS = ("## ending:", "##END")
+
+def pull_long_story(path = None):
     """
-    Reads the full story content from the memory storage file.
+    Reads the full story content from the memory storage file, after the pending background memory writes are done.
 
     :param path: (str) Path to the memory storage file (default from settings.MEMORY_STORAGE_PATH).
     :return: (str) Full story content stored in the file.
     """
-    with open(path, "r") as f:
+    flush_memory(path)
+    with open(path or settings.MEMORY_STORAGE_PATH, "r") as f:
         story = f.read()
     return story
 
@@ -57,44 +63,92 @@ def pull_long_story(path = MEMORY_STORAGE_PATH):
 def end_generation(story_state: StoryState)->StoryState:
     """
     Generates an ending for the story based on the current story state and saves it to the final output file.
-    Uses a language model to generate the ending, with retries on failure (up to 3 attempts).
+    Uses a language model to generate the ending, retried with backoff by LLM.invoke_llm.
 
     :param story_state: (StoryState) Object containing story metadata (characters, goal, topic, etc.) and recent story outlines.
     :return: (StoryState) Updated story state after generating and saving the ending.
     """
+    llm = settings.get_llm('WRITE_LLM')
+    # The whole story no longer fits the prompt of a long run: fit it and the outlines to settings.PROMPT_BUDGETS
+    fields = prompt_budget('end_generation', llm).fit(specific_story=pull_long_story(),
+                                                      outline='\n'.join(story_state['RecentStory']))
     # Format the prompt with story details from the current state
-    prompt = END_PROMPT.format(
+    prompt = end_prompt(story_state, **fields)
+    # With settings.STREAM_STORY the ending reaches the story file and the console as it is generated
+    sink = story_sink(settings.FINAL_STORY_PATH)
+
+    try:
+        # Invoke the language model to generate the ending, unparsable responses are generated again
+        end = invoke_llm(llm, prompt, node='end_generation', check=parser_end,
+                         sink=sink, markers=END_MARKERS)
+    except LLMCallError:
+        warnings.warn("The end generation failed.")
+        raise
+    print(f"Finally! The story's generation is finished.")
+
+    # Append the generated ending to the final story file
+    if sink is not None:
+        sink.commit(end)
+        print("Saved your story to file:", os.path.basename(settings.FINAL_STORY_PATH))
+    else:
+        save_ending(end)
+    story_state['TotalStoryLength'] += len(end)
+    return story_state
+
+
+async def aend_generation(story_state: StoryState)->StoryState:
+    """
+    Async twin of end_generation, the story files are read and written in a worker thread.
+
+    :param story_state: (StoryState) Object containing story metadata (characters, goal, topic, etc.) and recent story outlines.
+    :return: (StoryState) Updated story state after generating and saving the ending.
+    """
+    llm = settings.get_llm('WRITE_LLM')
+    fields = await prompt_budget('end_generation', llm).afit(specific_story=await asyncio.to_thread(pull_long_story),
+                                                             outline='\n'.join(story_state['RecentStory']))
+    prompt = end_prompt(story_state, **fields)
+    sink = story_sink(settings.FINAL_STORY_PATH)
+    try:
+        end = await ainvoke_llm(llm, prompt, node='end_generation', check=parser_end,
+                                sink=sink, markers=END_MARKERS)
+    except LLMCallError:
+        warnings.warn("The end generation failed.")
+        raise
+    print(f"Finally! The story's generation is finished.")
+    if sink is not None:
+        sink.commit(end)
+        print("Saved your story to file:", os.path.basename(settings.FINAL_STORY_PATH))
+    else:
+        await asyncio.to_thread(save_ending, end)
+    story_state['TotalStoryLength'] += len(end)
+    return story_state
+
+
+def end_prompt(story_state: StoryState, specific_story: str, outline: str = None) -> str:
+    """
+    Formats the ending prompt.
+
+    :param story_state: (StoryState) Current story state.
+    :param specific_story: (str) The story written so far, fitted to its token budget.
+    :param outline: (str, optional) The recent outlines fitted to their token budget (default: all of them).
+    :return: (str) The rendered prompt.
+    """
+    return END_PROMPT.format(
         language=story_state['Language'],
-        outline=story_state['RecentStory'],
-        specific_story=pull_long_story(),
+        outline=outline if outline is not None else '\n'.join(story_state['RecentStory']),
+        specific_story=specific_story,
         main_character=story_state['MainCharacter'],
         main_goal=story_state['MainGoal'],
         topic=story_state['Topic']
     )
 
-    button = True
-    trying = 0
-    # Attempt to generate the ending with up to 3 retries
-    while button and trying < 4:
-        try:
-            # Invoke the language model to generate the ending
-            res = WRITE_LLM.invoke(prompt).content
-            # Parse the generated response to extract the ending
-            end = parser_end(res)
-            button = False
-            print(f"Finally! The story's generation is finished.")
-        except:
-            trying += 1
-            print("End Generation doesn't work, try again...")
-
-    # Handle failure after 3 attempts
-    if trying == 4:
-        warnings.warn("The end generation failed.")
-        sys.exit()
 
-    # Append the generated ending to the final story file
-    with open(FINAL_STORY_PATH, 'a', encoding='UTF-8') as f:
+def save_ending(end: str):
+    """
+    Appends the ending to the final story file.
+
+    :param end: (str) The generated ending.
+    """
+    with open(settings.FINAL_STORY_PATH, 'a', encoding='UTF-8') as f:
         f.write(end)
-    print("Saved your story to file:", os.path.basename(FINAL_STORY_PATH))
-    story_state['TotalStoryLength'] += len(end)
-    return story_state
\ No newline at end of file
+    print("Saved your story to file:", os.path.basename(settings.FINAL_STORY_PATH))
\ No newline at end of file
@@ -5,18 +5,15 @@
 -- @IDE     : PyCharm
 '''
 
-from utils import set_env
-set_env()
 from langgraph.constants import START , END
 from langgraph.graph import StateGraph
 from StoryState import StoryState
-from utils import set_env
-set_env()
 import warnings
 warnings.filterwarnings("ignore")
-from End.EndsGenerate import end_generation
+from End.EndsGenerate import end_generation, aend_generation
+from langchain_core.runnables import RunnableLambda
 
 End_subgraph = StateGraph(StoryState)
-End_subgraph.add_node('end_generation',end_generation)
+End_subgraph.add_node('end_generation',RunnableLambda(end_generation, afunc=aend_generation, name='end_generation'))
 End_subgraph.add_edge(START,'end_generation')
 End_subgraph.add_edge('end_generation',END)
\ No newline at end of file
@@ -6,11 +6,11 @@
 '''
 
 import os
+import re
 import warnings
 from typing import Optional
 
-from langchain_anthropic import ChatAnthropic
-from langchain.prompts import (
+from langchain_core.prompts import (
     ChatPromptTemplate,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
@@ -22,11 +22,9 @@ import sys
 current_dir = os.getcwd()
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
-from utils import set_env
 from StoryState import StoryState
-
-# Set environment variables
-set_env()
+import settings
+from LLM import invoke_llm, ainvoke_llm, LLMCallError, count_tokens
 
 EXPENDER_SYS_PRMPT = """
 You're a talented story writer and a native speaker of {language}. Your task is to edit a part of the story in {language} based on the following OUTLINE:{last_outline}. Remember this: it's ok to generate or delete some details that the original outline doesn't tell, such as characters' names, emotions, logics, and personal stories, as long as they're logically appropriate, and keep as specific as possible.
@@ -47,6 +45,7 @@ Output your result without any explanation.
 HUMAN_REWRITE_PROMPT = """
 After reading your expanded story, I find there are some logical details and character growth issues in your story. Here's my logical detail suggestion:{logical_confusion_and_suggestion}.
 And here's my character suggestion:{character_growth_confusion_and_suggestion}.
+{pacing_suggestion}
 Edit your last output to generate a better one that's based on my logical suggestion and character growth suggestion. Still, make sure your story is across to this topic: {topic} and OUTLINE:{last_outline}.
 Follow these steps:
 1. Look at the logical and character growth suggestion, and edit your last output to generate a better one that's based on my logical suggestion and emotional suggestion. Still, make sure your story is across to this topic: {topic} and OUTLINE:{last_outline}.
@@ -64,6 +63,72 @@ Follow this format:
 """
 
 
+CONTINUE_PROMPT = """
+Your story part is about {missing} characters shorter than required. Continue it from exactly where it stops, in {language}.
+Don't repeat anything you already wrote, write about {missing} more characters and end with a complete sentence.
+Output only the continuation without any explanation.
+"""
+
+# End of a sentence: Western punctuation followed by whitespace or the end, or CJK punctuation, with closing quotes
+SENTENCE_END = re.compile ( r'[.!?…]["\'”’)\]]*(?=\s|$)|[。！？]["”’」』）]*' )
+
+
+def cut_at_sentence(text:str)->str:
+    """
+    Cut a text after its last complete sentence.
+    :param text: (str) The text.
+    :return: (str) The text up to the last sentence end; the whole text when it has none.
+    """
+    ends = [match.end() for match in SENTENCE_END.finditer ( text )]
+    return text[:ends[-1]] if ends else text
+
+
+def cap_at_sentence(text:str, length:int, cap:int)->str:
+    """
+    Cut a story part at a sentence end, never inside a sentence.
+    :param text: (str) The story part, at least length characters.
+    :param length: (int) Characters to keep at least.
+    :param cap: (int) Characters to keep at most, when a sentence ends between length and cap.
+    :return: (str) The part up to the last sentence end between length and cap, else up to the first one after cap;
+        the whole part when no sentence ends after length.
+    """
+    ends = [match.end() for match in SENTENCE_END.finditer ( text ) if match.end() >= length]
+    within = [end for end in ends if end <= cap]
+    if within:
+        return text[:within[-1]]
+    return text[:ends[0]] if ends else text
+
+
+def sentence_head(text:str)->str:
+    """
+    The story part without its unfinished last sentence, so that a continuation starts a new sentence.
+    :param text: (str) The story part so far.
+    :return: (str) The part up to its last sentence end; the whole part when that would drop more than half of it.
+    """
+    head = cut_at_sentence ( text.rstrip() )
+    return head if len ( head ) >= len ( text ) // 2 else text.rstrip()
+
+
+def stitch(head:str, continuation:str)->str:
+    """
+    Join a story part ending at a sentence boundary (see sentence_head) and its continuation;
+    a continuation starting by repeating the part's end is cut.
+    :param head: (str) The story part the continuation was asked for.
+    :param continuation: (str) The writer's continuation.
+    :return: (str) The stitched story part.
+    """
+    continuation = continuation.strip()
+    # The longest end of the part the continuation starts with
+    for size in range ( min ( len ( head ) , len ( continuation ) , 300 ) , 9 , -1 ):
+        if continuation.startswith ( head[-size:] ):
+            continuation = continuation[size:].lstrip()
+            break
+    if not continuation:
+        return head
+    cjk = re.match ( r'[\u3000-\u9fff\uac00-\ud7af]' , continuation[0] ) and re.match ( r'[\u3000-\u9fff\uac00-\ud7af]' , head[-1:] or ' ' )
+    return head + ( '' if cjk else ' ' ) + continuation
+
+
 def get_new_outline(story:str):
     """
     Get the new outline from the story.
@@ -77,18 +142,30 @@ def get_whole_story(story:str):
     :return: (str) The whole story.
     """
     return get_content_between_a_b ( '## whole story:', '## END', story )
-from settings import WRITE_LLM
+
+def require_length(length:int):
+    """
+    Build a response check rejecting expansions shorter than length, so that they are generated again.
+    :param length: (int) Minimum length of the expanded story.
+    :return: (Callable) Check returning the text unchanged when it is long enough.
+    """
+    def check(text:str)->str:
+        assert len ( text ) >= length, "The length of the expended story is less than the required length" + str ( length ) + " generation retrying..."
+        return text
+    return check
 class ExpenderWriterSimulator:
-    def __init__(self,state:StoryState,llm = WRITE_LLM, length:int = 800):
+    def __init__(self,state:StoryState,llm = None, length:int = 800, sink = None):
         """
         Initialize an instance of the Expander class.
 
         :param state: (StoryState) A state object containing story information, such as topic, main character, main goal, language, and the latest story outline.
-        :param llm: (ChatAnthropic) A language model instance, defaulting to ChatAnthropic with a specific model.
+        :param llm: (ChatAnthropic) A language model instance, defaulting to settings.WRITE_LLM.
         :param length: (int) The minimum length of the expanded story, defaulting to 800.
+        :param sink: (LLM.StreamSink, optional) Streams the drafts and rewrites as they are generated; a draft stays provisional
+            until the rewrite replacing it is committed.
         """
         self.state = state
-        self.llm = llm
+        self.llm = llm if llm is not None else settings.get_llm('WRITE_LLM')
         self.topic = self.state['Topic']
         self.main_character = self.state['MainCharacter']
         self.main_goal = self.state['MainGoal']
@@ -99,6 +176,7 @@ class ExpenderWriterSimulator:
         else:
             self.first_line = None
         self.length = length
+        self.sink = sink
         self.text = ''
 
     def __call__(self, logical_confusion_and_suggestion: Optional[str] = None, character_growth_confusion_and_suggestion: Optional[str] = None)->str:
@@ -124,6 +202,22 @@ class ExpenderWriterSimulator:
             # Two strings are passed in, run the rewrite and update process
             return self.rewrite_and_update(logical_confusion_and_suggestion, character_growth_confusion_and_suggestion)
 
+    async def acall(self, logical_confusion_and_suggestion: Optional[str] = None, character_growth_confusion_and_suggestion: Optional[str] = None)->str:
+        """
+        Async twin of __call__.
+
+        :return: (str) The text of the expanded or rewritten story.
+        """
+        if logical_confusion_and_suggestion is None and character_growth_confusion_and_suggestion is None:
+            print(f"Expending story...")
+            if self.state['StartSign']:
+                await self.ainitial_first_outline()
+                return self.text
+            else:
+                return await self.ainitial_last_task()
+        else:
+            print(f"Editing story with reviewing...")
+            return await self.arewrite_and_update(logical_confusion_and_suggestion, character_growth_confusion_and_suggestion)
 
     def set_init_prompt(self)-> ChatPromptTemplate:
         """
@@ -149,143 +243,264 @@ class ExpenderWriterSimulator:
         )
         # to run formatted_messages
 
-    def initial_last_task(self) ->str:
+    def expansion_messages(self, outline:str):
         """
-        Execute the initial story expansion task. Invoke the language model to generate an expanded story until the story length meets the requirement.
+        Reset the conversation and format the expansion prompt for an outline.
 
-        :return: (str) The text of the expanded story.
+        :param outline: (str) The outline to expand.
+        :return: (List) The formatted chat messages.
         """
         self.set_init_prompt()
-        msg = self.sys_prompt.format_messages (
+        return self.sys_prompt.format_messages (
             topic=self.topic ,
             main_character=self.main_character ,
             main_goal=self.main_goal ,
             language=self.language ,
-            last_outline=self.last_outline ,
+            last_outline=outline ,
             length=self.length
         )
-        # Retry flag to control the loop
-        button = True
-        trying = 0
-        while button and trying < 4:
-            try:
-                # Invoke the language model to generate an expanded story based on the initial prompt
-                text = self.llm.invoke(msg).content
-                self.text = text
-                # Add the AI's response to the message list
-                self.messages.append(AIMessagePromptTemplate.from_template ( self.text ))
-                # Assert whether the length of the generated story meets the minimum length requirement
-                assert len (self.text ) >= self.length, "The length of the expended story is less than the required length" + str(self.length) + " generation retrying..."
-                # If the length meets the requirement, exit the loop
-                button = False
-                # Print the success message, including the original outline and the length of the expanded story
-
-            except:
-                # If an error occurs, issue a warning and continue retrying
-                warnings.warn ( "Error in expending story, retrying..." )
-                trying += 1
-                continue
-        if button:
-            if len(self.last_outline)>51:
-                warnings.warn ( f"Error in expending story for outline{self.last_outline[:50]}...(etc.) please try later, or change to other LLMs." )
-            else:
-                warnings.warn ( f"Error in expending story for outline{self.last_outline} please try later, or change to other LLMs." )
 
+    def change_outline_prompt(self, outline:str)->str:
+        """
+        Format the prompt asking for an outline matching the expanded story.
+
+        :param outline: (str) The outline the story was expanded from.
+        :return: (str) The rendered prompt.
+        """
+        return CHANGE_OUTLINE_PROMPT.format (
+            topic = self.topic,
+            main_character = self.main_character,
+            main_goal = self.main_goal,
+            language = self.language,
+            last_outline = outline,
+            length = self.length,
+            story = self.text
+        )
+
+    def warn_failed(self, outline:str):
+        if len(outline)>51:
+            warnings.warn ( f"Error in expending story for outline{outline[:50]}...(etc.) please try later, or change to other LLMs." )
+        else:
+            warnings.warn ( f"Error in expending story for outline{outline} please try later, or change to other LLMs." )
+
+    def continuation_messages(self, msg, text:str):
+        """
+        The expansion conversation followed by the short story part and the request to continue it.
+
+        :param msg: (List) The formatted expansion messages.
+        :param text: (str) The story part so far.
+        :return: (List) The formatted chat messages.
+        """
+        from langchain_core.messages import AIMessage, HumanMessage
+        missing = self.length - len ( text )
+        return list ( msg ) + [AIMessage ( content=text ) ,
+                               HumanMessage ( content=CONTINUE_PROMPT.format ( missing=missing , language=self.language ) )]
+
+    def continuation_llm(self, text:str):
+        """
+        The writer model limited to the output a top-up may need: the missing characters plus the allowed overshoot.
+
+        :param text: (str) The story part so far.
+        :return: (Runnable) The model, bound to max_tokens when it is a chat model.
+        """
+        from langchain_core.language_models import BaseChatModel
+        if not isinstance ( self.llm , BaseChatModel ):
+            return self.llm
+        allowed = self.length * ( 1 + settings.EXPAND_TOPUP_MAX_OVERSHOOT ) - len ( text )
+        tokens_per_char = count_tokens ( text ) / max ( len ( text ) , 1 )
+        return self.llm.bind ( max_tokens=int ( allowed * tokens_per_char ) + 64 )
+
+    def finish_topup(self, text:str, rounds:int)->Optional[str]:
+        """
+        The topped-up story part within the overshoot cap, or None when it is still too short and is generated again.
+
+        :param text: (str) The stitched story part.
+        :param rounds: (int) Continuation calls made.
+        :return: (str, optional) The story part.
+        """
+        if len ( text ) < self.length:
+            print ( f"The expanded story is still {self.length - len ( text )} characters short after {rounds} top-ups, generating it again..." )
             return None
-        llm = self.llm
-        trying = 0
-        button = True
-        while button and trying < 4:
-            try:
-                new_outline = llm.invoke(CHANGE_OUTLINE_PROMPT.format(
-                    topic = self.topic,
-                    main_character = self.main_character,
-                    main_goal = self.main_goal,
-                    language = self.language,
-                    last_outline = self.last_outline,
-                    length = self.length,
-                    story = self.text
-                )).content
-                new_outline = get_new_outline(new_outline)
-                self.state["RecentStory"][-1] = new_outline
-                self.last_outline = new_outline
-                button = False
-            except:
-                trying += 1
-                continue
+        cap = int ( self.length * ( 1 + settings.EXPAND_TOPUP_MAX_OVERSHOOT ) )
+        if rounds and len ( text ) > cap:
+            text = cap_at_sentence ( text , self.length , cap )
+        if rounds:
+            print ( f"Expanded story topped up in {rounds} continuation(s) to {len ( text )} characters." )
+            if self.sink is not None:
+                self.sink.replace ( text )
+        return text
+
+    def write_expansion(self, msg)->str:
+        """
+        Generate the expanded story part. A response shorter than self.length is continued by the writer
+        (at most settings.EXPAND_TOPUP_ROUNDS times) instead of being generated again; one shorter than
+        settings.EXPAND_TOPUP_MIN_FRACTION of it, or still short after the top-ups, is generated again.
+
+        :param msg: (List) The formatted expansion messages.
+        :return: (str) The story part, at least self.length characters.
+        :raises LLMCallError: when no long enough story part could be generated.
+        """
+        if not settings.EXPAND_TOPUP_ROUNDS:
+            return invoke_llm ( self.llm , msg , node='generate_expansion:writer' , check=require_length ( self.length ) , sink=self.sink )
+        floor = int ( self.length * settings.EXPAND_TOPUP_MIN_FRACTION )
+        text = invoke_llm ( self.llm , msg , node='generate_expansion:writer' , check=require_length ( floor ) , sink=self.sink )
+        rounds = 0
+        while len ( text ) < self.length and rounds < settings.EXPAND_TOPUP_ROUNDS:
+            rounds += 1
+            text = sentence_head ( text )
+            continuation = invoke_llm ( self.continuation_llm ( text ) , self.continuation_messages ( msg , text ) ,
+                                        node='generate_expansion:topup' )
+            text = stitch ( text , continuation )
+        finished = self.finish_topup ( text , rounds )
+        if finished is None:
+            return invoke_llm ( self.llm , msg , node='generate_expansion:writer' , check=require_length ( self.length ) , sink=self.sink )
+        return finished
+
+    async def awrite_expansion(self, msg)->str:
+        """
+        Async twin of write_expansion.
+        """
+        if not settings.EXPAND_TOPUP_ROUNDS:
+            return await ainvoke_llm ( self.llm , msg , node='generate_expansion:writer' , check=require_length ( self.length ) , sink=self.sink )
+        floor = int ( self.length * settings.EXPAND_TOPUP_MIN_FRACTION )
+        text = await ainvoke_llm ( self.llm , msg , node='generate_expansion:writer' , check=require_length ( floor ) , sink=self.sink )
+        rounds = 0
+        while len ( text ) < self.length and rounds < settings.EXPAND_TOPUP_ROUNDS:
+            rounds += 1
+            text = sentence_head ( text )
+            continuation = await ainvoke_llm ( self.continuation_llm ( text ) , self.continuation_messages ( msg , text ) ,
+                                               node='generate_expansion:topup' )
+            text = stitch ( text , continuation )
+        finished = self.finish_topup ( text , rounds )
+        if finished is None:
+            return await ainvoke_llm ( self.llm , msg , node='generate_expansion:writer' , check=require_length ( self.length ) , sink=self.sink )
+        return finished
+
+    def initial_last_task(self) ->str:
+        """
+        Execute the initial story expansion task. Invoke the language model to generate an expanded story until the story length meets the requirement.
+
+        :return: (str) The text of the expanded story.
+        """
+        msg = self.expansion_messages ( self.last_outline )
+        try:
+            # Invoke the language model to generate an expanded story based on the initial prompt,
+            # too short expansions are generated again
+            self.text = self.write_expansion ( msg )
+        except LLMCallError:
+            self.warn_failed ( self.last_outline )
+            raise
+        # Add the AI's response to the message list
+        self.messages.append(AIMessagePromptTemplate.from_template ( self.text ))
+        try:
+            new_outline = invoke_llm ( self.llm , self.change_outline_prompt ( self.last_outline ) ,
+                                       node='generate_expansion:outline' , check=get_new_outline )
+            self.state["RecentStory"][-1] = new_outline
+            self.last_outline = new_outline
+        except LLMCallError:
+            # The outline update is optional, keep the original outline
+            pass
+        return self.text
+
+    async def ainitial_last_task(self) ->str:
+        """
+        Async twin of initial_last_task.
+
+        :return: (str) The text of the expanded story.
+        """
+        msg = self.expansion_messages ( self.last_outline )
+        try:
+            self.text = await self.awrite_expansion ( msg )
+        except LLMCallError:
+            self.warn_failed ( self.last_outline )
+            raise
+        self.messages.append(AIMessagePromptTemplate.from_template ( self.text ))
+        try:
+            new_outline = await ainvoke_llm ( self.llm , self.change_outline_prompt ( self.last_outline ) ,
+                                              node='generate_expansion:outline' , check=get_new_outline )
+            self.state["RecentStory"][-1] = new_outline
+            self.last_outline = new_outline
+        except LLMCallError:
+            pass
         return self.text
 
     def initial_first_outline(self) -> str:
-        #if self.state['StartSign']:
-        self.set_init_prompt()
         # Format the prompt template and fill in specific story information
-        msg = self.sys_prompt.format_messages (
-                topic=self.topic ,
-                main_character=self.main_character ,
-                main_goal=self.main_goal ,
-                language=self.language ,
-                last_outline=self.first_line,
-                length=self.length
-            )
-        button = True
-        trying = 0
-        while button and trying < 4:
-            try:
-                # Invoke the language model to generate an expanded story based on the initial prompt
-                text = self.llm.invoke ( msg ).content
-                # Add the AI's response to the message list
-
-                # Assert whether the length of the generated story meets the minimum length requirement
-                assert len (
-                        text ) >= self.length , "The length of the expended story is less than the required length" + str (
-                        self.length ) + " generation retrying..."
-                # If the length meets the requirement, exit the loop
-                button = False
-                # Print the success message, including the original outline and the length of the expanded story
-                self.messages.append(AIMessagePromptTemplate.from_template ( text ))
-            except:
-                # If an error occurs, issue a warning and continue retrying
-                warnings.warn ( "Error in expending story, retrying..." )
-                trying += 1
-                continue
-        if button:
-            warnings.warn ( f"Error in expending story for outline{self.first_line[:50]} please try later, or change to other LLMs." )
-            return None
+        msg = self.expansion_messages ( self.first_line )
+        try:
+            # Invoke the language model to generate an expanded story based on the initial prompt,
+            # too short expansions are generated again
+            text = self.write_expansion ( msg )
+        except LLMCallError:
+            self.warn_failed ( self.first_line )
+            raise
+        # Add the AI's response to the message list
+        self.messages.append(AIMessagePromptTemplate.from_template ( text ))
+        self.text = text
+        try:
+            new_outline = invoke_llm ( self.llm , self.change_outline_prompt ( self.first_line ) ,
+                                       node='generate_expansion:outline' , check=get_new_outline )
+            self.state["RecentStory"][0] = new_outline
+        except LLMCallError:
+            # The outline update is optional, keep the original outline
+            pass
+        return text
 
+    async def ainitial_first_outline(self) -> str:
+        """
+        Async twin of initial_first_outline.
+
+        :return: (str) The text of the expanded story.
+        """
+        msg = self.expansion_messages ( self.first_line )
+        try:
+            text = await self.awrite_expansion ( msg )
+        except LLMCallError:
+            self.warn_failed ( self.first_line )
+            raise
+        self.messages.append(AIMessagePromptTemplate.from_template ( text ))
         self.text = text
-        trying = 0
-        button = True
-        while button and trying < 4:
-            try:
-                new_outline = self.llm.invoke ( CHANGE_OUTLINE_PROMPT.format (
-                        topic=self.topic ,
-                        main_character=self.main_character ,
-                        main_goal=self.main_goal ,
-                        language=self.language ,
-                        last_outline=self.first_line ,
-                        length=self.length ,
-                        story=self.text
-                    ) ).content
-                new_outline = get_new_outline ( new_outline )
-                self.state["RecentStory"][0] = new_outline
-                button = False
-            except:
-                trying += 1
-                continue
+        try:
+            new_outline = await ainvoke_llm ( self.llm , self.change_outline_prompt ( self.first_line ) ,
+                                              node='generate_expansion:outline' , check=get_new_outline )
+            self.state["RecentStory"][0] = new_outline
+        except LLMCallError:
+            pass
         return text
 
     def set_startsign_to_false(self):
         self.state['StartSign'] = False
 
 
-    def rewrite(self, logical_confusion_and_suggestion:str, character_growth_confusion_and_suggestion:str):
+    def rewrite(self, logical_confusion_and_suggestion:str, character_growth_confusion_and_suggestion:str, pacing_confusion_and_suggestion:str = ''):
         """
         Rewrite the story based on logical and character_growth suggestions.
 
         :param logical_confusion_and_suggestion: (str) Logical issues and suggestions.
         :param character_growth_confusion_and_suggestion: (str) character_growth issues and suggestions.
+        :param pacing_confusion_and_suggestion: (str) Pacing issues and suggestions, empty when there are none.
         :return: (str) The text of the rewritten story.
         """
+        formatted_messages = self.rewrite_messages ( logical_confusion_and_suggestion , character_growth_confusion_and_suggestion , pacing_confusion_and_suggestion )
+        self.text = invoke_llm ( self.llm , formatted_messages , node='generate_expansion:rewrite' , sink=self.sink )
+
+    async def arewrite(self, logical_confusion_and_suggestion:str, character_growth_confusion_and_suggestion:str, pacing_confusion_and_suggestion:str = ''):
+        """
+        Async twin of rewrite.
+        """
+        formatted_messages = self.rewrite_messages ( logical_confusion_and_suggestion , character_growth_confusion_and_suggestion , pacing_confusion_and_suggestion )
+        self.text = await ainvoke_llm ( self.llm , formatted_messages , node='generate_expansion:rewrite' , sink=self.sink )
+
+    def rewrite_messages(self, logical_confusion_and_suggestion:str, character_growth_confusion_and_suggestion:str, pacing_confusion_and_suggestion:str = ''):
+        """
+        Add the reader's suggestions to the conversation and format it.
+
+        :param logical_confusion_and_suggestion: (str) Logical issues and suggestions.
+        :param character_growth_confusion_and_suggestion: (str) character_growth issues and suggestions.
+        :param pacing_confusion_and_suggestion: (str) Pacing issues and suggestions, empty when there are none.
+        :return: (List) The formatted chat messages.
+        """
+        pacing_suggestion = f"And here's my pacing suggestion:{pacing_confusion_and_suggestion}." if pacing_confusion_and_suggestion else ''
         # Format the user rewrite prompt template
         human_template = HUMAN_REWRITE_PROMPT
         # Add the user rewrite prompt to the message list
@@ -303,7 +518,8 @@ class ExpenderWriterSimulator:
                 last_outline=self.first_line ,
                 length=self.length ,
                 logical_confusion_and_suggestion=logical_confusion_and_suggestion ,
-                character_growth_confusion_and_suggestion=character_growth_confusion_and_suggestion
+                character_growth_confusion_and_suggestion=character_growth_confusion_and_suggestion ,
+                pacing_suggestion=pacing_suggestion
             )
 
         else:
@@ -315,9 +531,10 @@ class ExpenderWriterSimulator:
             last_outline = self.last_outline,
             length = self.length,
             logical_confusion_and_suggestion = logical_confusion_and_suggestion,
-            character_growth_confusion_and_suggestion = character_growth_confusion_and_suggestion
+            character_growth_confusion_and_suggestion = character_growth_confusion_and_suggestion,
+            pacing_suggestion = pacing_suggestion
         )
-        self.text = self.llm.invoke(formatted_messages).content
+        return formatted_messages
 
 
 
@@ -347,7 +564,7 @@ class ExpenderWriterSimulator:
             ]
 
 
-    def rewrite_and_update(self,logical_confusion_and_suggestion:str, character_growth_confusion_and_suggestion:str)->str:
+    def rewrite_and_update(self,logical_confusion_and_suggestion:str, character_growth_confusion_and_suggestion:str, pacing_confusion_and_suggestion:str = '', commit:bool = True)->str:
         """
         Rewrite the story based on logical and emotional suggestions and then update the message list.
         This method first checks if the message list is in the expected format, then triggers the story rewrite process.
@@ -356,6 +573,8 @@ class ExpenderWriterSimulator:
 
         :param logical_confusion_and_suggestion: (str) Logical issues and suggestions for rewriting the story.
         :param character_growth_confusion_and_suggestion: (str) Character growth issues and suggestions for rewriting the story.
+        :param pacing_confusion_and_suggestion: (str) Pacing issues and suggestions, empty when there are none.
+        :param commit: (bool) Keep the streamed rewrite in the story file; False when another review round may replace it.
         :return: (str) The text of the rewritten story.
         """
         self.update_msg_list()
@@ -363,12 +582,30 @@ class ExpenderWriterSimulator:
         # Expected format: [system prompt, initial human prompt, AI response]
         assert len(self.messages) == 3, "The message list is not in the correct format. It should be [sys_prompt, human_init_prompt, AI_response]."
         # Call the rewrite method to rewrite the story based on the provided suggestions.
-        self.rewrite(logical_confusion_and_suggestion, character_growth_confusion_and_suggestion)
+        self.rewrite(logical_confusion_and_suggestion, character_growth_confusion_and_suggestion, pacing_confusion_and_suggestion)
         # Update the message list after the story has been rewritten.
         # Remove the temporary user feedback and add the new AI response.
         self.update_msg_list()
+        if self.sink is not None and commit:
+            # The rewrite is the final text of this part, keep it in the story file
+            self.sink.commit(self.text)
         # Ensure that the message list is back in the correct format after the update.
         # Expected format: [system prompt, initial human prompt, new AI response]
         assert len (self.messages ) == 3 , "The message list is not in the correct format. It should be [sys_prompt, human_init_prompt, AI_response]."
         # Return the text of the rewritten story.
-        return self.text
\ No newline at end of file
+        return self.text
+
+    async def arewrite_and_update(self,logical_confusion_and_suggestion:str, character_growth_confusion_and_suggestion:str, pacing_confusion_and_suggestion:str = '', commit:bool = True)->str:
+        """
+        Async twin of rewrite_and_update.
+
+        :return: (str) The text of the rewritten story.
+        """
+        self.update_msg_list()
+        assert len(self.messages) == 3, "The message list is not in the correct format. It should be [sys_prompt, human_init_prompt, AI_response]."
+        await self.arewrite(logical_confusion_and_suggestion, character_growth_confusion_and_suggestion, pacing_confusion_and_suggestion)
+        self.update_msg_list()
+        if self.sink is not None and commit:
+            self.sink.commit(self.text)
+        assert len (self.messages ) == 3 , "The message list is not in the correct format. It should be [sys_prompt, human_init_prompt, AI_response]."
+        return self.text
@@ -7,22 +7,27 @@
 from Expander.ReaderSimulator import ReaderSimulator
 from Expander.ExpanderWriterSimulator import ExpenderWriterSimulator
 import os
-from langchain_anthropic import ChatAnthropic
+import json
+import asyncio
+import contextvars
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
-
-# Load pre-trained model for sentence embedding
-model = SentenceTransformer('all-MiniLM-L6-v2')
 
 import os, sys
 current_dir = os.getcwd()
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
-from utils import set_env, get_content_between_a_b
+from utils import get_content_between_a_b
 from StoryState import StoryState
-from settings import EXPEND_LEN , FINAL_STORY_PATH
+import settings
+from settings import EXPEND_LEN
+from Embedding import story_index, similarity_cascade, embed_outlines
 from memory_storage.MemoryStore import MemoryStore
+from memory_storage.MemoryWriter import memory_writer
+from LLM import story_sink
+from TwistGenerator.KnowledgeGraphProcess import speculate_twist
+from PlainGenerator.PlainGenerate import prefetch_plain_story
 
 # Prompt template for completing incomplete story endings
 FINISH_SENTENCE_PROMPT = """
@@ -46,94 +51,314 @@ def get_whole_story(story: str):
     return get_content_between_a_b('## whole story:', '## END', story)
 
 
-# Set environment variables required for the application
-set_env()
+def review(expender: ExpenderWriterSimulator, text: str, rounds: Optional[int] = None) -> str:
+    """
+    Reader review and rewrite of one expanded part, for up to settings.REVIEW_ROUNDS rounds.
+    With settings.REVIEW_SKIP_EMPTY a review where the reader (or every critic of settings.REVIEW_CRITICS) has nothing
+    to say ends the rounds, and the current text is kept without a rewrite.
+    :param expender: (ExpenderWriterSimulator) Writer that expanded the part.
+    :param text: (str) The expanded part.
+    :param rounds: (int, optional) Review rounds (default: settings.REVIEW_ROUNDS).
+    :return: (str) The reviewed part.
+    """
+    for _ in range(settings.REVIEW_ROUNDS if rounds is None else rounds):
+        reader = ReaderSimulator(expender.state, text)
+        logical, emotional, _ = reader()
+        if settings.REVIEW_SKIP_EMPTY and reader.nothing_to_say():
+            print("Reader has nothing to criticize, keeping the story.")
+            break
+        print(f"Editing story with reviewing...")
+        # Streamed rewrites stay provisional until the last round, a later rewrite replaces them
+        text = expender.rewrite_and_update(logical, emotional, reader.pacing_response, commit=False)
+    if expender.sink is not None:
+        expender.sink.commit(text)
+    return text
+
+
+async def areview(expender: ExpenderWriterSimulator, text: str, rounds: Optional[int] = None) -> str:
+    """
+    Async twin of review.
+    :return: (str) The reviewed part.
+    """
+    for _ in range(settings.REVIEW_ROUNDS if rounds is None else rounds):
+        reader = ReaderSimulator(expender.state, text)
+        logical, emotional, _ = await reader.acall()
+        if settings.REVIEW_SKIP_EMPTY and reader.nothing_to_say():
+            print("Reader has nothing to criticize, keeping the story.")
+            break
+        print(f"Editing story with reviewing...")
+        text = await expender.arewrite_and_update(logical, emotional, reader.pacing_response, commit=False)
+    if expender.sink is not None:
+        expender.sink.commit(text)
+    return text
+
+
+def expand_first(expender: ExpenderWriterSimulator) -> str:
+    """
+    Expand and review the first outline of the story's first round.
+    :param expender: (ExpenderWriterSimulator) Writer of a state with StartSign.
+    :return: (str) The reviewed part.
+    """
+    return review(expender, expender.initial_first_outline())
+
+
+async def aexpand_first(expender: ExpenderWriterSimulator) -> str:
+    """
+    Async twin of expand_first.
+    """
+    return await areview(expender, await expender.ainitial_first_outline())
 
 
-def interact(state: StoryState, length: int = EXPEND_LEN, llm=ChatAnthropic(model_name="claude-3-opus-20240229")):
+def expand_last(expender: ExpenderWriterSimulator) -> str:
+    """
+    Expand and review the round's (last) outline.
+    :param expender: (ExpenderWriterSimulator) Writer of a state without StartSign.
+    :return: (str) The reviewed part.
+    """
+    last_first_outline = expender.initial_last_task()
+    # The round's outline is final now, a likely twist's KG extraction runs during the review and rewrite
+    speculate_twist(expender.state)
+    return review(expender, last_first_outline)
+
+
+async def aexpand_last(expender: ExpenderWriterSimulator) -> str:
+    """
+    Async twin of expand_last.
+    """
+    last_first_outline = await expender.ainitial_last_task()
+    speculate_twist(expender.state)
+    return await areview(expender, last_first_outline)
+
+
+def last_part_writer(state: StoryState, llm, length: int) -> ExpenderWriterSimulator:
+    """
+    Writer of the last outline running next to the first one (settings.EXPAND_START_PARALLEL).
+    Its state is a copy without StartSign sharing RecentStory, so its outline update reaches the story's state,
+    and it does not stream: its part is written after the first one.
+    :return: (ExpenderWriterSimulator) The writer.
+    """
+    return ExpenderWriterSimulator({**state, 'StartSign': False}, llm, length)
+
+
+def append_to_sink(sink, text: str):
+    # The last part, generated next to the streamed first one, reaches the story file behind it
+    if sink is not None:
+        sink.replace(text)
+        sink.commit(text)
+
+
+def interact(state: StoryState, length: int = EXPEND_LEN, llm=None, sink=None):
     """
     Facilitates interaction between the story expander and reader simulator to generate story content.
     Handles both initial story generation (when StartSign is True) and subsequent expansions (when StartSign is False).
+    With settings.EXPAND_START_PARALLEL the first and the last outline of the initial round are expanded and reviewed concurrently.
     :param state: (StoryState) Object containing current story state and metadata.
     :param length: (int) Target length for the generated story content (default from EXPEND_LEN).
-    :param llm: (ChatAnthropic) Language model instance used for generation (default: claude-3-opus-20240229).
+    :param llm: (ChatAnthropic) Language model instance used for generation (default: settings.EXPAND_LLM, claude-3-opus-20240229).
+    :param sink: (LLM.StreamSink, optional) Streams the writer's tokens as they are generated.
     :return: (tuple) Generated text content and updated StoryState object.
     """
-    if state['StartSign']:
-        # Initialize expander for the first story generation
-        expender = ExpenderWriterSimulator(state, llm, length)
-        initial_first_outline = expender.initial_first_outline()
-        # Simulate reader feedback on the initial outline
-        reader = ReaderSimulator(expender.state, initial_first_outline)
-        logical, emotional, state = reader()
-        # Generate expanded content based on reader feedback
-        initial_second_outline = expender(logical, emotional)
-        # Switch to non-initial mode for subsequent generations
+    if llm is None:
+        llm = settings.get_llm('EXPAND_LLM')
+    # Initialize expander for the first story generation, or for subsequent expansions (non-initial mode)
+    expender = ExpenderWriterSimulator(state, llm, length, sink)
+    if state['StartSign'] and settings.EXPAND_START_PARALLEL:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='expand-last') as pool:
+            # In a copy of the context, so the part sees the story's settings.OUTPUT_DIR
+            last = pool.submit(contextvars.copy_context().run, expand_last, last_part_writer(state, llm, length))
+            initial_second_outline = expand_first(expender)
+            last_second_outline = last.result()
         expender.set_startsign_to_false()
-        # Generate final part of the initial story
-        last_first_outline = expender.initial_last_task()
-        reader = ReaderSimulator(expender.state, last_first_outline)
-        logical, emotional, state = reader()
-        last_second_outline = expender(logical, emotional)
+        append_to_sink(sink, last_second_outline)
         # Combine all parts for the initial full story
         text = initial_second_outline + last_second_outline
+    elif state['StartSign']:
+        # Expand and review the first outline, then switch to non-initial mode for the final part of the initial story
+        initial_second_outline = expand_first(expender)
+        expender.set_startsign_to_false()
+        text = initial_second_outline + expand_last(expender)
     else:
-        # Generate subsequent story expansions (non-initial mode)
-        expender = ExpenderWriterSimulator(state, llm, length)
-        last_first_outline = expender.initial_last_task()
-        reader = ReaderSimulator(expender.state, last_first_outline)
-        logical, emotional, state = reader()
-        last_second_outline = expender(logical, emotional)
-        text = last_second_outline
+        text = expand_last(expender)
     return text, state
 
 
+async def ainteract(state: StoryState, length: int = EXPEND_LEN, llm=None, sink=None):
+    """
+    Async twin of interact.
+    :return: (tuple) Generated text content and updated StoryState object.
+    """
+    if llm is None:
+        llm = settings.get_llm('EXPAND_LLM')
+    expender = ExpenderWriterSimulator(state, llm, length, sink)
+    if state['StartSign'] and settings.EXPAND_START_PARALLEL:
+        initial_second_outline, last_second_outline = await asyncio.gather(
+            aexpand_first(expender), aexpand_last(last_part_writer(state, llm, length)))
+        expender.set_startsign_to_false()
+        await asyncio.to_thread(append_to_sink, sink, last_second_outline)
+        text = initial_second_outline + last_second_outline
+    elif state['StartSign']:
+        initial_second_outline = await aexpand_first(expender)
+        expender.set_startsign_to_false()
+        text = initial_second_outline + await aexpand_last(expender)
+    else:
+        text = await aexpand_last(expender)
+    return text, state
+
+
+def save_expansion(final_generated: str, write_to_json: Optional[str]):
+    """
+    Appends the generated content to the story file, or prints it when no path is given.
+    :param final_generated: (str) Generated content.
+    :param write_to_json: (Optional[str]) Path to save the generated content.
+    """
+    if write_to_json:
+        print(f"Saving story at your storage path...")
+        with open(write_to_json, "a", encoding="utf-8") as f:
+            f.write(final_generated)
+    else:
+        print(f"generating {len(final_generated)} words storyline:\n", final_generated)
+
+
+# Default story file of generate_expansion, settings.FINAL_STORY_PATH read at call time so each batch job gets its own
+STORY_FILE = object()
+
+
 # Core node function for story expansion
-def generate_expansion(state: StoryState, length: int = EXPEND_LEN, write_to_json: Optional[str] = FINAL_STORY_PATH):
+def generate_expansion(state: StoryState, length: int = EXPEND_LEN, write_to_json: Optional[str] = STORY_FILE):
     """
     Generates expanded story content, updates the story state, and optionally saves to a file.
     :param state: (StoryState) Current story state.
     :param length: (int) Target length for the expansion (default from EXPEND_LEN).
     :param write_to_json: (Optional[str]) Path to save the generated content (default from FINAL_STORY_PATH).
     :return: (StoryState) Updated story state with new content and length.
+    With settings.STREAM_STORY the content reaches the file and the console token by token instead of at the end.
     """
-    final_generated, state = interact(state, length=length)
+    if write_to_json is STORY_FILE:
+        write_to_json = settings.FINAL_STORY_PATH
+    # With settings.PREFETCH_PLAIN the next plain outline is generated meanwhile
+    prefetch_plain_story(state)
+    sink = story_sink(write_to_json)
+    final_generated, state = interact(state, length=length, sink=sink)
     # Ensure generated content is not empty
     assert len(final_generated) > 0, "The generated text is empty."
     # Update total story length in state
     state['TotalStoryLength'] += len(final_generated)
-    # Save to file if path is provided, otherwise print
-    if write_to_json:
-        print(f"Saving story at your storage path...")
-        with open(write_to_json, "a", encoding="utf-8") as f:
-            f.write(final_generated)
-    else:
-        print(f"generating {len(final_generated)} words storyline:\n", final_generated)
+    # Save to file if path is provided, otherwise print (already done token by token when streaming)
+    if sink is None:
+        save_expansion(final_generated, write_to_json)
     return state
 
 
+async def agenerate_expansion(state: StoryState, length: int = EXPEND_LEN, write_to_json: Optional[str] = STORY_FILE):
+    """
+    Async twin of generate_expansion, the story file is written in a worker thread.
+    :return: (StoryState) Updated story state with new content and length.
+    """
+    if write_to_json is STORY_FILE:
+        write_to_json = settings.FINAL_STORY_PATH
+    prefetch_plain_story(state)
+    sink = story_sink(write_to_json)
+    final_generated, state = await ainteract(state, length=length, sink=sink)
+    assert len(final_generated) > 0, "The generated text is empty."
+    state['TotalStoryLength'] += len(final_generated)
+    if sink is None:
+        await asyncio.to_thread(save_expansion, final_generated, write_to_json)
+    return state
+
+
+def log_outline_pair(previous: str, new: str, path: Optional[str] = None):
+    """
+    Append the outline pair the router scores to the similarity log, the pairs Embedding.BackendCheck and
+    Embedding.CascadeCheck replay.
+    :param previous: (str) Previous outline.
+    :param new: (str) Newest outline.
+    :param path: (str, optional) JSONL file (default: settings.SIMILARITY_LOG_PATH).
+    """
+    path = path or settings.SIMILARITY_LOG_PATH
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'previous': previous, 'new': new}, ensure_ascii=False) + '\n')
+    except OSError:
+        warnings.warn(f"The outline pair could not be logged to {path}.")
+
+
 def calculate_similarity(state):
     """
     Calculates cosine similarity between the two most recent story outlines in the state.
     Updates the state with the similarity score.
+    With settings.SIMILARITY_CASCADE (and without TWIST_ON_HISTORY, which needs the embeddings), a cheap lexical score
+    decides clear cases and the embedding model only runs inside the uncertainty band around SIMILARITY_THRESHOLD.
+    The lexical score is stored as 'LexicalSimilarity'; 'similarity' is None when the lexical tier decided.
+    With settings.TWIST_ON_HISTORY, the newest outline is also compared with every earlier outline of the story
+    through the story's novelty index, and the highest score is stored as 'HistorySimilarity'.
+    The newest outline is added to the index whenever TWIST_ON_HISTORY or a local PLAIN_SELECTOR reads it, so with a
+    local selector the cascade's lexical tier saves the twist check's encode but not the index's.
     :param state: (dict) Story state containing 'RecentStory' list.
-    :return: (dict) Updated state with 'similarity' key.
+    :return: (dict) Updated state with 'similarity' (and 'HistorySimilarity' or 'LexicalSimilarity') key.
     """
     # Extract recent story outlines from state
     recent_story = state['RecentStory']
     # Validate input format
     if not isinstance(recent_story, list):
         raise ValueError("recent_story must be a list")
-    # Generate embeddings for the two most recent outlines
-    emb1 = model.encode([recent_story[0]])
-    emb2 = model.encode([recent_story[1]])
-    # Compute cosine similarity
-    similarity = cosine_similarity(emb1, emb2)[0][0]
+    log_outline_pair(recent_story[0], recent_story[1])
+    if settings.SIMILARITY_CASCADE and not settings.TWIST_ON_HISTORY:
+        cascade = similarity_cascade()
+        lexical, embeddings, tier = cascade.compare(recent_story[0], recent_story[1])
+        similarity = None if embeddings is None else float(embeddings[0] @ embeddings[1])
+        state['LexicalSimilarity'] = lexical
+        state['similarity'] = similarity
+        decided = cascade.report()
+        print(f"lexical {lexical:.3f}, embedding {'-' if similarity is None else f'{similarity:.3f}'} "
+              f"(decided by {tier} tier; so far lexical {decided['lexical']}, embedding {decided['embedding']})")
+        if settings.PLAIN_SELECTOR != 'llm':
+            # The embedding tier's vectors are the index's (same model), only a lexical decision still needs the encode
+            index_outline(*(embed_outlines(recent_story[0], recent_story[1]) if embeddings is None else embeddings))
+        return state
+    emb1, emb2 = embed_outlines(recent_story[0], recent_story[1])
+    # Compute cosine similarity (embeddings are already normalised)
+    similarity = float(emb1 @ emb2)
     state['similarity'] = similarity
     print(similarity)
+    if settings.TWIST_ON_HISTORY:
+        index = story_index()
+        if len(index) == 0:
+            index.add(emb1)
+        history_similarity, top_scores, top_rows = index.query(emb2, settings.NOVELTY_TOP_K)
+        index_outline(emb1, emb2)
+        state['HistorySimilarity'] = history_similarity
+        # Row 0 is the outline the story opened with, row r the outline of the story's r-th round
+        print(f"Round {len(index) - 1}, most similar earlier outlines: "
+              + ", ".join(f"{'opening' if r == 0 else f'round {int(r)}'}: {s:.3f}" for r, s in zip(top_rows, top_scores)))
+    elif settings.PLAIN_SELECTOR != 'llm':
+        index_outline(emb1, emb2)
     return state
 
 
+def index_outline(emb1, emb2):
+    """
+    Add the newest outline to the story's novelty index, which the twist check of settings.TWIST_ON_HISTORY and the
+    local outline selector (settings.PLAIN_SELECTOR 'local' or 'local+llm') compare new outlines with.
+    The first round also adds the outline the story opened with, so row r holds the outline of round r.
+    The index file grows by the new row only, see NoveltyIndex.save.
+    :param emb1: (numpy.ndarray) Embedding of the previous outline.
+    :param emb2: (numpy.ndarray) Embedding of the newest outline.
+    """
+    index = story_index()
+    if len(index) == 0:
+        index.add(emb1)
+    index.add(emb2)
+    index.save()
+
+
+async def acalculate_similarity(state):
+    """
+    Async twin of calculate_similarity, the embedding model runs in a worker thread.
+    """
+    return await asyncio.to_thread(calculate_similarity, state)
+
+
 def clean_outline(state: StoryState) -> StoryState:
     """
     Cleans up the story outline by resetting StartSign and retaining only the latest story in RecentStory.
@@ -147,13 +372,52 @@ def clean_outline(state: StoryState) -> StoryState:
     return state
 
 
+def store_memory(state: StoryState):
+    """
+    Summarizes the newest outline into the memory file using MemoryStore.
+    :param state: (StoryState) Story state whose latest outline is stored.
+    """
+    memory_store = MemoryStore(state)
+    memory_store.normal_store()
+    memory_store.write_down_memory()
+
+
+def memory_snapshot(state: StoryState) -> StoryState:
+    """
+    Copy of the state for a background memory write, unaffected by the nodes that run meanwhile.
+    :param state: (StoryState) Current story state.
+    :return: (StoryState) The copy.
+    """
+    return {**state, 'RecentStory': list(state['RecentStory'])}
+
+
 def write_to_memory(state: StoryState) -> StoryState:
     """
     Saves the current story state to memory using MemoryStore.
+    With settings.MEMORY_BACKGROUND the write is queued behind the pending ones and the next round starts at once;
+    readers of the memory file wait for it through memory_storage.MemoryWriter.flush_memory.
+    :param state: (StoryState) Current story state to be stored.
+    :return: (StoryState) Updated story state after memory storage.
+    """
+    if settings.MEMORY_BACKGROUND:
+        snapshot = memory_snapshot(state)
+        memory_writer().submit(lambda: store_memory(snapshot))
+    else:
+        store_memory(state)
+    return state
+
+
+async def awrite_to_memory(state: StoryState) -> StoryState:
+    """
+    Async twin of write_to_memory.
     :param state: (StoryState) Current story state to be stored.
     :return: (StoryState) Updated story state after memory storage.
     """
+    if settings.MEMORY_BACKGROUND:
+        snapshot = memory_snapshot(state)
+        await memory_writer().asubmit(lambda: store_memory(snapshot))
+        return state
     memory_store = MemoryStore(state)
-    memory_store.normal_store()
-    memory_store.write_down_memory()
-    return state
\ No newline at end of file
+    await memory_store.anormal_store()
+    await memory_store.awrite_down_memory()
+    return state
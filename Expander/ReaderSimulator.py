@@ -5,20 +5,21 @@
 -- @IDE     : PyCharm
 '''
 import os
+import re
+import asyncio
+import contextvars
 import warnings
-from typing import Tuple , Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple , Dict , Optional , Sequence
 
-from langchain_anthropic import ChatAnthropic
 from langchain_core.prompts import ChatPromptTemplate
 import os,sys
 current_dir = os.getcwd()
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
-from utils import set_env,get_content_between_a_b
 from StoryState import StoryState
-from settings import UTIL_LLM, WRITE_LLM
-# Set environment variables
-set_env()
+import settings
+from LLM import invoke_sections, ainvoke_sections, LLMCallError
 
 # System prompt
 CHECK_SYS_PRMPT = """
@@ -40,6 +41,43 @@ Give me your response in the following format:
 <here, put your confusion and suggestion in the character growth of the part story in {language} you find in step 3>
 ## END
 """
+# Sections of the reader's response
+READER_MARKERS = ["## logical detail confusion:", "## character growth confusion:"]
+
+# One critic per aspect (settings.REVIEW_CRITICS), asked in concurrent calls
+CRITIC_ASK_PRMPT = """
+I'm writing a story based on the following information:
+topic: {topic}, Main character: {main_character}, Main Goal:{main_goal} language: {language}.
+Now here's a part of my story: {story}.
+Read this part of the story CAREFULLY and review only its {aspect}: {question}
+If you have no confusion about its {aspect}, then just give an empty response.
+Give me your response in the following format:
+{marker}
+<here, put your confusion and suggestion in the {aspect} of the part story in {language}>
+## END
+"""
+# Critic -> (section marker, aspect, question, attribute holding its critique)
+CRITICS = {
+    'logic': ("## logical detail confusion:", "logic",
+              "Is there any part you find hard to logically understand? Do the details logically make sense? Give me your confusion and suggestions.",
+              'logical_response'),
+    'character': ("## character growth confusion:", "character growth",
+                  "Is the character growth of {main_character} detailed enough for you to understand it? If not, give me your suggestion.",
+                  'emotion_response'),
+    'pacing': ("## pacing confusion:", "pacing",
+               "Does the story move too fast or too slow, skip important moments or linger on unimportant ones? Give me your confusion and suggestions.",
+               'pacing_response'),
+}
+# A critique saying there is nothing to criticize
+EMPTY_CRITIQUE = re.compile ( r'^\W*(none|nothing|n/?a|no( confusions?| issues?| suggestions?| problems?)?|empty( response)?|无|没有)?\W*$' , re.IGNORECASE )
+
+
+def is_empty_critique(critique:Optional[str])->bool:
+    """
+    :param critique: (str, optional) A reader's confusion and suggestion.
+    :return: (bool) True when it is empty or only says there is nothing to criticize ("None", "N/A", "<empty>"...).
+    """
+    return critique is None or EMPTY_CRITIQUE.match ( critique.strip() ) is not None
 
 # Single LLM, rewrite prompt
 REWRITE_PROMPT = """
@@ -49,19 +87,28 @@ Your job now is to rewrite this story based on the following reader's suggestion
 logical detail confusion and suggestion: {logical_confusion_and_suggestion}
 main character of this story's character growth confusion: {character_growth_confusion_and_suggestion}
 """
-from settings import WRITE_LLM
 class ReaderSimulator:
-    def __init__(self, state:StoryState, text:str, llm = WRITE_LLM):
+    def __init__(self, state:StoryState, text:str, llm = None, critics:Optional[Sequence[str]] = None):
         """
         Initialize an instance of the ReaderSimulator class.
 
         :param state: (StoryState) Object containing story metadata (topic, main characters, goal, language).
         :param text: (str) Segment of the story to be evaluated by the reader.
-        :param llm: (ChatAnthropic) Language model instance for generating feedback (default: claude-sonnet-4-20250514).
+        :param llm: (ChatAnthropic) Language model instance for generating feedback (default: settings.WRITE_LLM).
+        :param critics: (Sequence[str], optional) Critics of CRITICS asked in concurrent calls, empty for one reader call
+            reviewing logic and character growth together (default: settings.REVIEW_CRITICS).
         """
+        self.critics = tuple ( settings.REVIEW_CRITICS if critics is None else critics )
+        for critic in self.critics:
+            if critic not in CRITICS:
+                raise ValueError ( f"Unknown critic '{critic}', choose from {tuple(CRITICS)}" )
+        self.logical_response = ''
+        self.emotion_response = ''
+        self.pacing_response = ''
+        self.failed_critics = []
         self.state = state
         self.text = text
-        self.llm = llm
+        self.llm = llm if llm is not None else settings.get_llm('WRITE_LLM')
         self.topic = self.state['Topic']
         self.main_character = self.state['MainCharacter']
         self.main_goal = self.state['MainGoal']
@@ -94,45 +141,112 @@ class ReaderSimulator:
             return None
         return chain
 
-    def run(self):
+    def chain_input(self) -> Dict[str, str]:
+        """
+        Input of the reader chain: the question about the story segment.
+
+        :return: (Dict) Chain input.
+        """
+        return {
+            "input":
+                WRITER_ASK_PRMPT.format(
+                    topic = self.topic,
+                    main_character = self.main_character,
+                    main_goal = self.main_goal,
+                    language = self.language,
+                    story = self.text
+                )
+            }
+
+    def critic_input(self, critic:str) -> Dict[str, str]:
+        """
+        Input of the reader chain for one critic.
+
+        :param critic: (str) Critic of CRITICS.
+        :return: (Dict) Chain input.
+        """
+        marker, aspect, question, _ = CRITICS[critic]
+        return {
+            "input":
+                CRITIC_ASK_PRMPT.format(
+                    topic = self.topic,
+                    main_character = self.main_character,
+                    main_goal = self.main_goal,
+                    language = self.language,
+                    story = self.text,
+                    aspect = aspect,
+                    question = question.format(main_character = self.main_character),
+                    marker = marker
+                )
+            }
+
+    def keep_critiques(self, results):
+        """
+        Store each critic's critique; a critic whose call gave up is recorded in self.failed_critics.
+
+        :param results: (List) Section contents per critic in self.critics order, or the LLMCallError of the critic.
         """
-        Execute the LLM chain to generate feedback on the story segment.
+        for critic, result in zip(self.critics, results):
+            if isinstance(result, BaseException):
+                if not isinstance(result, LLMCallError):
+                    raise result
+                warnings.warn(f"The {critic} critic failed and is skipped: {result}")
+                self.failed_critics.append(critic)
+                continue
+            setattr(self, CRITICS[critic][3], result[0])
 
-        :return: (str) Feedback content from the LLM, or None if execution fails.
+    def review_critics(self):
+        """
+        Ask every critic in concurrent calls, one review aspect each.
         """
         chain = self.set_sys()
-        try:
-            # Invoke the chain with the story segment and metadata
-            self.response = chain.invoke(
-                {
-                    "input":
-                        WRITER_ASK_PRMPT.format(
-                            topic = self.topic,
-                            main_character = self.main_character,
-                            main_goal = self.main_goal,
-                            language = self.language,
-                            story = self.text
-                        )
-                    }
-            ).content
-        except:
-            return None
-        return self.response
+        def one(critic):
+            try:
+                return invoke_sections(chain, self.critic_input(critic), node=f'generate_expansion:reader:{critic}', markers=[CRITICS[critic][0]])
+            except LLMCallError as e:
+                return e
+        with ThreadPoolExecutor(max_workers=len(self.critics)) as pool:
+            # Each call in a copy of the caller's context, so LangGraph's stream writer and callbacks find their run
+            futures = [pool.submit(contextvars.copy_context().run, one, critic) for critic in self.critics]
+            self.keep_critiques([future.result() for future in futures])
+
+    async def areview_critics(self):
+        """
+        Async twin of review_critics.
+        """
+        chain = self.set_sys()
+        self.keep_critiques(await asyncio.gather(*(ainvoke_sections(chain, self.critic_input(critic), node=f'generate_expansion:reader:{critic}', markers=[CRITICS[critic][0]])
+                                                   for critic in self.critics), return_exceptions=True))
+
+    def nothing_to_say(self)->bool:
+        """
+        :return: (bool) True when no critic found anything to criticize, so a rewrite is not needed;
+            never when a critic failed, its silence says nothing about the story.
+        """
+        if self.failed_critics:
+            return False
+        return all(is_empty_critique(critique) for critique in (self.logical_response, self.emotion_response, self.pacing_response))
 
     def response_parser(self):
         """
-        Parse the LLM's feedback to extract logical and emotional critiques.
-        Uses helper function to extract content between predefined markers.
+        Ask for the feedback and extract logical and emotional critiques, or those of the critics in concurrent calls.
+        A response missing one of them is kept, only the missing one is asked for again.
         """
-        response = self.run()
-        if response:
-            # Extract logical confusion and suggestions
-            self.logical_response = get_content_between_a_b("## logical detail confusion:","## character growth confusion:", response)
-            # Extract emotional confusion and suggestions
-            self.emotion_response = get_content_between_a_b("## character growth confusion:","## END", response)
-        else:
-            warnings.warn("In reader, the generation response is empty.")
-            sys.exit()
+        if self.critics:
+            self.review_critics()
+            return
+        self.logical_response, self.emotion_response = invoke_sections(
+            self.set_sys(), self.chain_input(), node='generate_expansion:reader', markers=READER_MARKERS)
+
+    async def aresponse_parser(self):
+        """
+        Async twin of response_parser.
+        """
+        if self.critics:
+            await self.areview_critics()
+            return
+        self.logical_response, self.emotion_response = await ainvoke_sections(
+            self.set_sys(), self.chain_input(), node='generate_expansion:reader', markers=READER_MARKERS)
 
     def __call__(self)->Tuple[str, str, StoryState]:
         """
@@ -142,4 +256,14 @@ class ReaderSimulator:
         """
         print(f"Reader is reading...")
         self.response_parser()
+        return self.logical_response, self.emotion_response,self.state
+
+    async def acall(self)->Tuple[str, str, StoryState]:
+        """
+        Async twin of __call__.
+
+        :return: (Tuple) Contains logical feedback (str), emotional feedback (str), and updated StoryState.
+        """
+        print(f"Reader is reading...")
+        await self.aresponse_parser()
         return self.logical_response, self.emotion_response,self.state
\ No newline at end of file
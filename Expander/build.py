@@ -4,7 +4,9 @@
 -- @Project : StoryGenerator
 -- @IDE     : PyCharm
 '''
-from Expander.Interact import calculate_similarity,generate_expansion, write_to_memory, clean_outline
+from Expander.Interact import calculate_similarity,generate_expansion, write_to_memory, clean_outline, \
+    acalculate_similarity, agenerate_expansion, awrite_to_memory
+from langchain_core.runnables import RunnableLambda
 
 '''
 from Expander import generate_expansion, write_to_memory, clean_outline,calculate_similarity
@@ -15,20 +17,17 @@ state = write_to_memory(state)
 connect as
 generate_expansion --> calculate_similarity --> clean_outline --> write_to_memory
 '''
-from utils import set_env
-set_env()
 from langgraph.constants import START , END
 from langgraph.graph import StateGraph
 from StoryState import StoryState
-from utils import set_env
-set_env()
 import warnings
 warnings.filterwarnings("ignore")
 
 Expender_subgraph = StateGraph(StoryState, output = StoryState)
-Expender_subgraph.add_node('calculate_similarity',calculate_similarity)
-Expender_subgraph.add_node('generate_expansion',generate_expansion)
-Expender_subgraph.add_node('write_to_memory',write_to_memory)
+# Nodes with an async twin run it under ainvoke / astream
+Expender_subgraph.add_node('calculate_similarity',RunnableLambda(calculate_similarity, afunc=acalculate_similarity, name='calculate_similarity'))
+Expender_subgraph.add_node('generate_expansion',RunnableLambda(generate_expansion, afunc=agenerate_expansion, name='generate_expansion'))
+Expender_subgraph.add_node('write_to_memory',RunnableLambda(write_to_memory, afunc=awrite_to_memory, name='write_to_memory'))
 Expender_subgraph.add_node('clean_outline',clean_outline)
 Expender_subgraph.add_edge(START,'generate_expansion')
 Expender_subgraph.add_edge('generate_expansion','calculate_similarity')
@@ -0,0 +1,551 @@
+'''
+-- @Time    : 2025/7/24 15:30
+-- @File    : Invoker.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from LLM.ResponseCache import ResponseCache, response_key
+from LLM.StreamSink import StreamSink, chunk_text
+from LLM.RateLimiter import RateLimiter, usage_tokens, estimate_prompt_tokens, model_name
+
+# HTTP statuses worth retrying: timeouts, conflicts, throttling and server-side failures (529 is Anthropic "overloaded")
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# Provider SDK exception names (openai, anthropic, httpx) for errors raised without a status code
+RETRYABLE_ERRORS = {'APITimeoutError', 'APIConnectionError', 'RateLimitError', 'InternalServerError',
+                    'OverloadedError', 'ServiceUnavailableError', 'TimeoutException', 'ConnectError',
+                    'ReadTimeout', 'RemoteProtocolError'}
+FATAL_ERRORS = {'AuthenticationError', 'PermissionDeniedError', 'BadRequestError', 'NotFoundError',
+                'UnprocessableEntityError'}
+# Chat models whose SDK takes a per-request timeout: the deadline cancels the HTTP request itself
+REQUEST_TIMEOUT_MODELS = {'ChatOpenAI', 'AzureChatOpenAI', 'ChatAnthropic'}
+# Errors of a check that mean the response was unusable; anything else is a bug in the parser and fails at once
+CHECK_ERRORS = (ValueError, AssertionError, KeyError)
+
+
+class LLMCallError(RuntimeError):
+    def __init__(self, node: str, attempts: int, cause: BaseException):
+        """
+        Raised when an LLM call fails for good: a fatal error, or every attempt used up.
+
+        :param node: (str) Graph node that made the call.
+        :param attempts: (int) Number of attempts made.
+        :param cause: (BaseException) Last error.
+        """
+        super().__init__(f"LLM call of {node} failed after {attempts} attempt(s): {type(cause).__name__}: {cause}")
+        self.node = node
+        self.attempts = attempts
+        self.cause = cause
+
+
+class LLMTimeout(TimeoutError):
+    """The call did not return before its deadline."""
+
+
+class InvalidOutput(ValueError):
+    """The response could not be parsed or failed a check, a new sample may pass."""
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    Tell transient failures (timeouts, throttling, overload, connection errors, unparsable output)
+    from fatal ones (bad credentials, invalid requests, programming errors).
+
+    :param exc: (BaseException) Error raised by a call.
+    :return: (bool) True when trying again can succeed.
+    """
+    if isinstance(exc, (LLMTimeout, InvalidOutput, TimeoutError, ConnectionError)):
+        return True
+    name = type(exc).__name__
+    if name in FATAL_ERRORS:
+        return False
+    if name in RETRYABLE_ERRORS:
+        return True
+    status = _status_code(exc)
+    return status in RETRYABLE_STATUS if status is not None else False
+
+
+def is_throttled(exc: BaseException) -> bool:
+    """
+    :param exc: (BaseException) Error raised by a call.
+    :return: (bool) True for rate limit and overload errors, which get more attempts than other failures.
+    """
+    return type(exc).__name__ in ('RateLimitError', 'OverloadedError') or _status_code(exc) in (429, 529)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """
+    :param exc: (BaseException) Error raised by a call.
+    :return: (float, optional) Seconds the provider asked us to wait (Retry-After header), if any.
+    """
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    try:
+        return float(headers.get('retry-after')) if headers is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _content(response: Any) -> Any:
+    return getattr(response, 'content', response)
+
+
+def _stream(llm, prompt, emit: Callable[[str], None]) -> str:
+    parts = []
+    for chunk in llm.stream(prompt):
+        text = chunk_text(chunk)
+        if text:
+            parts.append(text)
+            emit(text)
+    return ''.join(parts)
+
+
+async def _astream(llm, prompt, emit: Callable[[str], None], idle: Optional[float] = None) -> str:
+    # With idle, a stream that sends nothing for that many seconds times out
+    parts = []
+    chunks = llm.astream(prompt).__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), idle) if idle else await chunks.__anext__()
+        except StopAsyncIteration:
+            break
+        except asyncio.TimeoutError:
+            await chunks.aclose()
+            raise LLMTimeout(f"no streamed text for {idle:.0f}s") from None
+        text = chunk_text(chunk)
+        if text:
+            parts.append(text)
+            emit(text)
+    return ''.join(parts)
+
+
+def with_request_timeout(llm, timeout: Optional[float]):
+    """
+    Pass the deadline to the provider SDK when the model (or the chain's last step) supports a per-request timeout,
+    so a timed-out request is cancelled instead of running on in the background. For a streamed call the SDK timeout
+    applies to each read, i.e. it is an inactivity timeout.
+
+    :param llm: (Runnable) Chat model, bound chat model or chain ending with one.
+    :param timeout: (float, optional) Seconds.
+    :return: (Tuple[Runnable, bool]) The model with the timeout bound, and True when the SDK enforces it.
+    """
+    if not timeout:
+        return llm, False
+    from langchain_core.runnables import RunnableBinding, RunnableSequence
+    last = llm.last if isinstance(llm, RunnableSequence) else llm
+    model = last.bound if isinstance(last, RunnableBinding) else last
+    if type(model).__name__ not in REQUEST_TIMEOUT_MODELS:
+        return llm, False
+    bound = last.bind(timeout=timeout)
+    if isinstance(llm, RunnableSequence):
+        return RunnableSequence(*llm.steps[:-1], bound), True
+    return bound, True
+
+
+def _sdk_timeout(exc: BaseException, timeout: float) -> BaseException:
+    # A request cancelled by its SDK timeout counts as a timeout of the attempt
+    if type(exc).__name__ in ('APITimeoutError', 'TimeoutException', 'ReadTimeout'):
+        return LLMTimeout(f"no response within {timeout:.0f}s")
+    return exc
+
+
+def _call_with_deadline(llm, prompt, timeout: Optional[float], emit: Optional[Callable[[str], None]] = None):
+    # With emit, the response is streamed, every text chunk passed to emit, and timeout is an inactivity timeout.
+    # Models whose SDK takes a request timeout get it, the request is then cancelled on time;
+    # other clients cannot be interrupted, so they run in a daemon thread that is abandoned on timeout
+    llm, enforced = with_request_timeout(llm, timeout)
+    if enforced or not timeout:
+        try:
+            return llm.invoke(prompt) if emit is None else _stream(llm, prompt, emit)
+        except Exception as exc:
+            converted = _sdk_timeout(exc, timeout) if timeout else exc
+            if converted is exc:
+                raise
+            raise converted from exc
+    activity = [time.monotonic()]
+    if emit is not None:
+        def emit(text, forward=emit):
+            activity[0] = time.monotonic()
+            forward(text)
+    call = (lambda: llm.invoke(prompt)) if emit is None else (lambda: _stream(llm, prompt, emit))
+    outcome = {}
+
+    def target():
+        try:
+            outcome['value'] = call()
+        except BaseException as exc:
+            outcome['error'] = exc
+
+    # The thread runs in the caller's context, so LangGraph's stream writer and callbacks still find their run
+    worker = threading.Thread(target=contextvars.copy_context().run, args=(target,), daemon=True)
+    worker.start()
+    if emit is None:
+        worker.join(timeout)
+    else:
+        # A stream times out only when it stops sending text
+        while worker.is_alive() and time.monotonic() - activity[0] < timeout:
+            worker.join(min(1., timeout))
+    if worker.is_alive():
+        raise LLMTimeout(f"no response within {timeout:.0f}s" if emit is None else f"no streamed text for {timeout:.0f}s")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['value']
+
+
+async def _acall_with_deadline(llm, prompt, timeout: Optional[float], emit: Optional[Callable[[str], None]] = None):
+    # Cancelling the task cancels the request; the SDK timeout, when supported, is bound as well
+    llm, enforced = with_request_timeout(llm, timeout)
+    try:
+        if emit is not None:
+            return await _astream(llm, prompt, emit, timeout)
+        if not timeout:
+            return await llm.ainvoke(prompt)
+        return await asyncio.wait_for(llm.ainvoke(prompt), timeout)
+    except asyncio.TimeoutError:
+        raise LLMTimeout(f"no response within {timeout:.0f}s") from None
+    except Exception as exc:
+        converted = _sdk_timeout(exc, timeout) if timeout else exc
+        if converted is exc:
+            raise
+        raise converted from exc
+
+
+class Invoker:
+    def __init__(self, max_attempts: int = 4, throttled_attempts: int = 8, timeout: Optional[float] = 120.,
+                 backoff_base: float = 1., backoff_cap: float = 30., cache: Optional[ResponseCache] = None,
+                 cache_nodes: Iterable[str] = (), limiter: Optional[RateLimiter] = None,
+                 node_timeouts: Optional[Dict[str, Optional[float]]] = None, stream_timeout: Optional[float] = 60.):
+        """
+        The single path every graph node takes to call a language model:
+        per-call deadline, exponential backoff with full jitter, retryable / fatal error classification
+        and per-node latency and retry counters.
+
+        :param max_attempts: (int) Attempts for ordinary transient failures.
+        :param throttled_attempts: (int) Attempts when the provider throttles (429 / overloaded),
+            so a throttled run slows down instead of failing.
+        :param timeout: (float, optional) Seconds one attempt may take, None for no deadline.
+        :param backoff_base: (float) Backoff of the first retry in seconds, doubled at every retry.
+        :param backoff_cap: (float) Maximum backoff in seconds.
+        :param cache: (ResponseCache, optional) Persistent response cache.
+        :param cache_nodes: (Iterable[str]) Nodes whose calls use the cache; 'node' also covers its sub-calls 'node:part'.
+        :param limiter: (RateLimiter, optional) Requests / tokens per minute per model; every attempt waits for capacity.
+        :param node_timeouts: (Dict[str, float], optional) Deadline per node ('node:part' or 'node') replacing timeout,
+            None for no deadline, e.g. for the long writer calls.
+        :param stream_timeout: (float, optional) Streamed calls time out after this many seconds without text,
+            however long the whole response takes; None for no limit.
+        """
+        self.max_attempts = max_attempts
+        self.throttled_attempts = throttled_attempts
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.cache = cache
+        self.cache_nodes = set(cache_nodes)
+        self.limiter = limiter
+        self.node_timeouts = dict(node_timeouts or {})
+        self.stream_timeout = stream_timeout
+        self._lock = threading.Lock()
+        self._metrics = defaultdict(lambda: {'calls': 0, 'attempts': 0, 'retries': 0, 'timeouts': 0, 'failures': 0,
+                                             'latency_total': 0., 'latency_max': 0., 'wait_total': 0., 'wait_max': 0.,
+                                             'prompt_tokens': 0, 'prompt_max': 0})
+
+    def backoff(self, retry: int, exc: Optional[BaseException] = None) -> float:
+        """
+        Seconds to wait before a retry: full jitter over an exponentially growing window,
+        never less than the provider's Retry-After.
+
+        :param retry: (int) Retry number, starting at 0.
+        :param exc: (BaseException, optional) Error that caused the retry.
+        :return: (float) Delay in seconds.
+        """
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** retry))
+        asked = retry_after(exc) if exc is not None else None
+        return max(delay, asked or 0.)
+
+    def deadline(self, node: str, streamed: bool = False) -> Optional[float]:
+        """
+        :param node: (str) Node name, possibly 'node:part'.
+        :param streamed: (bool) The call is streamed.
+        :return: (float, optional) Timeout of one attempt of the node: the inactivity timeout for streamed calls,
+            otherwise the node's own deadline or the default one.
+        """
+        if streamed:
+            return self.stream_timeout
+        for name in (node, node.split(':')[0]):
+            if name in self.node_timeouts:
+                return self.node_timeouts[name]
+        return self.timeout
+
+    def invoke(self, llm, prompt, node: str, check: Optional[Callable[[str], Any]] = None,
+               timeout: Optional[float] = None, max_attempts: Optional[int] = None, sink: Optional[StreamSink] = None,
+               markers: Optional[Tuple[Optional[str], Optional[str]]] = None):
+        """
+        Call llm.invoke(prompt) and return the response content, optionally parsed by check.
+
+        :param llm: (Runnable) Chat model or chain.
+        :param prompt: Prompt string, message list or chain input.
+        :param node: (str) Name the call is counted under, usually the graph node.
+        :param check: (Callable, optional) Parser / validator applied to the content; when it raises,
+            the call is retried like a transient failure.
+        :param timeout: (float, optional) Deadline of one attempt (default: see deadline).
+        :param max_attempts: (int, optional) Attempts for ordinary failures (default: the invoker's).
+        :param sink: (StreamSink, optional) Stream the response into this sink; the text of a failed attempt is rolled back.
+            Streamed calls skip the response cache.
+        :param markers: (Tuple, optional) Start and end markers around the part of the response the sink shows.
+        :return: The response content, or check(content).
+        :raises LLMCallError: On a fatal error or when attempts run out.
+        """
+        self._record(node, prompt=estimate_prompt_tokens(prompt, model_name(llm)), calls=1)
+        if sink is not None or not self.caches(node):
+            return self._invoke(llm, prompt, node, check, timeout, max_attempts, sink, markers)[1]
+        key = response_key(llm, prompt)
+        content = self.cache.fetch(key, node, lambda: self._invoke(llm, prompt, node, check, timeout, max_attempts)[0])
+        if check is None:
+            return content
+        try:
+            return check(content)
+        except Exception:
+            # A cached response no longer passes the check (e.g. the parser changed), ask again
+            self.cache.delete(key)
+            content, parsed = self._invoke(llm, prompt, node, check, timeout, max_attempts)
+            self.cache.put(key, node, content)
+            return parsed
+
+    async def ainvoke(self, llm, prompt, node: str, check: Optional[Callable[[str], Any]] = None,
+                      timeout: Optional[float] = None, max_attempts: Optional[int] = None,
+                      sink: Optional[StreamSink] = None, markers: Optional[Tuple[Optional[str], Optional[str]]] = None):
+        """
+        Async twin of invoke: awaits llm.ainvoke(prompt) and sleeps between retries without blocking the event loop.
+
+        :param llm: (Runnable) Chat model or chain.
+        :param prompt: Prompt string, message list or chain input.
+        :param node: (str) Name the call is counted under, usually the graph node.
+        :param check: (Callable, optional) Parser / validator applied to the content, retried when it raises.
+        :param timeout: (float, optional) Deadline of one attempt (default: see deadline).
+        :param max_attempts: (int, optional) Attempts for ordinary failures (default: the invoker's).
+        :param sink: (StreamSink, optional) Stream the response into this sink, see invoke.
+        :param markers: (Tuple, optional) Start and end markers around the part of the response the sink shows.
+        :return: The response content, or check(content).
+        :raises LLMCallError: On a fatal error or when attempts run out.
+        """
+        self._record(node, prompt=estimate_prompt_tokens(prompt, model_name(llm)), calls=1)
+        if sink is not None or not self.caches(node):
+            return (await self._ainvoke(llm, prompt, node, check, timeout, max_attempts, sink, markers))[1]
+        key = response_key(llm, prompt)
+
+        async def compute():
+            return (await self._ainvoke(llm, prompt, node, check, timeout, max_attempts))[0]
+
+        content = await self.cache.afetch(key, node, compute)
+        if check is None:
+            return content
+        try:
+            return check(content)
+        except Exception:
+            await asyncio.to_thread(self.cache.delete, key)
+            content, parsed = await self._ainvoke(llm, prompt, node, check, timeout, max_attempts)
+            await asyncio.to_thread(self.cache.put, key, node, content)
+            return parsed
+
+    def caches(self, node: str) -> bool:
+        """
+        :param node: (str) Node name, possibly 'node:part'.
+        :return: (bool) True when the node opted in to the response cache.
+        """
+        return self.cache is not None and (node in self.cache_nodes or node.split(':')[0] in self.cache_nodes)
+
+    def _invoke(self, llm, prompt, node: str, check: Optional[Callable[[str], Any]],
+                timeout: Optional[float], max_attempts: Optional[int], sink: Optional[StreamSink] = None,
+                markers: Optional[Tuple[Optional[str], Optional[str]]] = None) -> Tuple[Any, Any]:
+        # Returns (raw content, checked content)
+        timeout = self.deadline(node, sink is not None) if timeout is None else timeout
+        max_attempts = max_attempts or self.max_attempts
+        attempt = 0
+        model, tokens = self.limiter.reserve(llm, prompt) if self.limiter is not None else (None, 0)
+        while True:
+            attempt += 1
+            if model is not None:
+                self._record(node, wait=self.limiter.acquire(model, tokens))
+            start = time.perf_counter()
+            emit = None
+            if sink is not None:
+                generation = sink.begin(node, markers)
+                emit = lambda text, generation=generation: sink.write(generation, text)
+            try:
+                response = _call_with_deadline(llm, prompt, timeout, emit)
+                if model is not None:
+                    self.limiter.settle(model, tokens, usage_tokens(response))
+                content = _content(response)
+                if sink is not None:
+                    sink.finish(generation)
+                return content, self._checked(node, content, check, start)
+            except Exception as exc:
+                if sink is not None:
+                    sink.rollback(f"{node}: {type(exc).__name__}")
+                time.sleep(self._failed(node, attempt, max_attempts, exc, start))
+
+    async def _ainvoke(self, llm, prompt, node: str, check: Optional[Callable[[str], Any]],
+                       timeout: Optional[float], max_attempts: Optional[int], sink: Optional[StreamSink] = None,
+                       markers: Optional[Tuple[Optional[str], Optional[str]]] = None) -> Tuple[Any, Any]:
+        timeout = self.deadline(node, sink is not None) if timeout is None else timeout
+        max_attempts = max_attempts or self.max_attempts
+        attempt = 0
+        model, tokens = self.limiter.reserve(llm, prompt) if self.limiter is not None else (None, 0)
+        while True:
+            attempt += 1
+            if model is not None:
+                self._record(node, wait=await self.limiter.aacquire(model, tokens))
+            start = time.perf_counter()
+            emit = None
+            if sink is not None:
+                generation = sink.begin(node, markers)
+                emit = lambda text, generation=generation: sink.write(generation, text)
+            try:
+                response = await _acall_with_deadline(llm, prompt, timeout, emit)
+                if model is not None:
+                    self.limiter.settle(model, tokens, usage_tokens(response))
+                content = _content(response)
+                if sink is not None:
+                    sink.finish(generation)
+                return content, self._checked(node, content, check, start)
+            except Exception as exc:
+                if sink is not None:
+                    sink.rollback(f"{node}: {type(exc).__name__}")
+                await asyncio.sleep(self._failed(node, attempt, max_attempts, exc, start))
+
+    def _checked(self, node: str, content: Any, check: Optional[Callable[[str], Any]], start: float) -> Any:
+        # Parse a response, an unparsable one counts as a failed attempt
+        parsed = content
+        if check is not None:
+            try:
+                parsed = check(content)
+            except CHECK_ERRORS as exc:
+                raise InvalidOutput(f"{type(exc).__name__}: {exc}") from exc
+        self._record(node, attempts=1, latency=time.perf_counter() - start)
+        return parsed
+
+    def _failed(self, node: str, attempt: int, max_attempts: int, exc: Exception, start: float) -> float:
+        # Record a failed attempt, raise LLMCallError when giving up, otherwise return the backoff delay
+        self._record(node, attempts=1, timeouts=int(isinstance(exc, LLMTimeout)),
+                     latency=time.perf_counter() - start)
+        limit = self.throttled_attempts if is_throttled(exc) else max_attempts
+        if not is_retryable(exc) or attempt >= limit:
+            self._record(node, failures=1)
+            raise LLMCallError(node, attempt, exc) from exc
+        delay = self.backoff(attempt - 1, exc)
+        print(f"{node}: {type(exc).__name__}, retrying in {delay:.1f}s ({attempt}/{limit})...")
+        self._record(node, retries=1)
+        return delay
+
+    def _record(self, node: str, latency: Optional[float] = None, wait: Optional[float] = None,
+                prompt: Optional[int] = None, **counts):
+        with self._lock:
+            metrics = self._metrics[node]
+            for key, value in counts.items():
+                metrics[key] += value
+            if latency is not None:
+                metrics['latency_total'] += latency
+                metrics['latency_max'] = max(metrics['latency_max'], latency)
+            if wait is not None:
+                metrics['wait_total'] += wait
+                metrics['wait_max'] = max(metrics['wait_max'], wait)
+            if prompt is not None:
+                metrics['prompt_tokens'] += prompt
+                metrics['prompt_max'] = max(metrics['prompt_max'], prompt)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """
+        Counters per node: calls, attempts, retries, timeouts, failures, total / mean / max attempt latency (s)
+        total / mean / max time spent waiting for the rate limiter (s), and total / mean / max prompt tokens.
+        Calls answered by the response cache count as calls without attempts.
+
+        :return: (Dict) Node name -> counters.
+        """
+        with self._lock:
+            report = {node: dict(metrics) for node, metrics in self._metrics.items()}
+        for metrics in report.values():
+            metrics['latency_mean'] = metrics['latency_total'] / max(metrics['attempts'], 1)
+            metrics['wait_mean'] = metrics['wait_total'] / max(metrics['attempts'], 1)
+            metrics['prompt_mean'] = metrics['prompt_tokens'] / max(metrics['calls'], 1)
+        return report
+
+    def print_report(self):
+        """Print the per-node counters as a table."""
+        report = self.report()
+        if not report:
+            return
+        print(f"{'node':<36}{'calls':>6}{'retries':>8}{'timeouts':>9}{'failures':>9}{'mean s':>8}{'max s':>8}"
+              f"{'wait s':>8}{'prompt':>8}{'max':>7}")
+        for node, m in sorted(report.items()):
+            print(f"{node:<36}{m['calls']:>6}{m['retries']:>8}{m['timeouts']:>9}{m['failures']:>9}"
+                  f"{m['latency_mean']:>8.1f}{m['latency_max']:>8.1f}{m['wait_total']:>8.1f}"
+                  f"{m['prompt_mean']:>8.0f}{m['prompt_max']:>7}")
+        if self.cache is not None:
+            stats = self.cache.stats
+            print(f"response cache: {stats['hits']} hits, {stats['misses']} misses, {stats['coalesced']} coalesced")
+
+
+_invoker = None
+_invoker_lock = threading.Lock()
+
+
+def get_invoker() -> Invoker:
+    """
+    Process-wide invoker configured from settings (LLM_MAX_ATTEMPTS, LLM_THROTTLED_ATTEMPTS, LLM_TIMEOUT, LLM_NODE_TIMEOUTS,
+    LLM_STREAM_IDLE_TIMEOUT, LLM_BACKOFF_BASE, LLM_BACKOFF_CAP, LLM_CACHE_* for the response cache and LLM_RATE_* for the rate limiter).
+
+    :return: (Invoker) Shared invoker, created on first use.
+    """
+    global _invoker
+    with _invoker_lock:
+        if _invoker is None:
+            import settings
+            cache = None
+            if settings.LLM_CACHE_NODES:
+                cache = ResponseCache(settings.LLM_CACHE_PATH, settings.LLM_CACHE_TTL, settings.LLM_CACHE_MAX_ENTRIES)
+            limiter = None
+            if settings.LLM_RATE_LIMITS:
+                limiter = RateLimiter(settings.LLM_RATE_LIMITS, settings.LLM_RATE_STATE_DIR, settings.LLM_RATE_OUTPUT_TOKENS)
+            _invoker = Invoker(settings.LLM_MAX_ATTEMPTS, settings.LLM_THROTTLED_ATTEMPTS, settings.LLM_TIMEOUT,
+                               settings.LLM_BACKOFF_BASE, settings.LLM_BACKOFF_CAP, cache, settings.LLM_CACHE_NODES,
+                               limiter, settings.LLM_NODE_TIMEOUTS, settings.LLM_STREAM_IDLE_TIMEOUT)
+        return _invoker
+
+
+def invoke_llm(llm, prompt, node: str, check: Optional[Callable[[str], Any]] = None, **kwargs):
+    """
+    Shortcut for get_invoker().invoke.
+
+    :param llm: (Runnable) Chat model or chain.
+    :param prompt: Prompt string, message list or chain input.
+    :param node: (str) Name the call is counted under.
+    :param check: (Callable, optional) Parser / validator of the content, retried when it raises.
+    :return: The response content, or check(content).
+    """
+    return get_invoker().invoke(llm, prompt, node, check, **kwargs)
+
+
+async def ainvoke_llm(llm, prompt, node: str, check: Optional[Callable[[str], Any]] = None, **kwargs):
+    """
+    Shortcut for get_invoker().ainvoke.
+
+    :param llm: (Runnable) Chat model or chain.
+    :param prompt: Prompt string, message list or chain input.
+    :param node: (str) Name the call is counted under.
+    :param check: (Callable, optional) Parser / validator of the content, retried when it raises.
+    :return: The response content, or check(content).
+    """
+    return await get_invoker().ainvoke(llm, prompt, node, check, **kwargs)
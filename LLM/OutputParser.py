@@ -0,0 +1,287 @@
+'''
+-- @Time    : 2025/7/31 10:20
+-- @File    : OutputParser.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import json
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+## Parse the '## Section:' ... '## END' responses of every node
+#Invocation method:
+"""
+outline = between('## outline:', '## END', response)  # case and whitespace tolerant, END may be missing
+reason, selected = invoke_sections(llm, prompt, node='generate_plain_story:select',
+                                   markers=['## Reason:', '## Selected Outline:'])  # asks again only for missing sections
+kg = parse_kg(response)  # repaired and validated {'entities': [...], 'relations': [...]}
+"""
+
+SALVAGE_PROMPT = """
+Your answer is missing the section(s) {names}. Don't repeat the rest of your answer, output only the missing section(s) in this format:
+{format}"""
+
+# Any '## Header:' line, where a section without its end marker stops
+_ANY_HEADER = re.compile(r'^[ \t]*#{1,6}[ \t]*[^\n#:]{1,60}:', re.MULTILINE)
+_LABEL_TOKENS = re.compile(r'\d+|[^\W\d_]+|[^\w\s]')
+
+
+class SectionMissing(ValueError):
+    def __init__(self, missing: Sequence[str], found: Optional[Dict[str, str]] = None):
+        """
+        A response lacks some sections.
+
+        :param missing: (Sequence[str]) Markers of the missing sections.
+        :param found: (Dict[str, str], optional) Marker -> content of the sections that were found.
+        """
+        self.missing = list(missing)
+        self.found = dict(found or {})
+        super().__init__(f"Missing section(s) {', '.join(repr(m) for m in self.missing)}")
+
+
+class InvalidKG(ValueError):
+    """The knowledge graph of a response could not be repaired into a valid one."""
+
+
+@lru_cache(maxsize=None)
+def marker_pattern(marker: str) -> re.Pattern:
+    """
+    Compiled, cached pattern of a section marker such as '## Selected Outline:' or '##END': case-insensitive,
+    any number of '#' or a bold '**Label:**' instead, flexible whitespace ('Outline1' matches 'Outline 1'), colon optional.
+
+    :param marker: (str) Marker as written in the prompt.
+    :return: (re.Pattern) Its pattern.
+    """
+    label = marker.strip().lstrip('#').strip().rstrip(':').strip()
+    body = r'[ \t_-]*'.join(re.escape(token) for token in _LABEL_TOKENS.findall(label))
+    # The label must not continue ('## END' is not '## ENDING', 'Outline1' is not 'Outline10')
+    body += r'(?![^\W_])'
+    return re.compile(rf'(?:#{{1,6}}[ \t]*\**|\*\*)[ \t]*{body}[ \t]*\**[ \t]*:?\**[ \t]*|^[ \t]*{body}[ \t]*:[ \t]*',
+                      re.IGNORECASE | re.MULTILINE)
+
+
+def _clean(content: str) -> str:
+    return content.strip().strip('*').strip()
+
+
+def between(a: str, b: str, text: str) -> str:
+    """
+    Content between a start and an end marker of a response. Without the end marker the content runs
+    to the next '## Header:' line or the end of the response.
+
+    :param a: (str) Start marker, e.g. '## outline:'.
+    :param b: (str) End marker, e.g. '## END'.
+    :param text: (str) Response.
+    :return: (str) The content, stripped.
+    :raises SectionMissing: when the start marker is missing.
+    """
+    start = marker_pattern(a).search(text)
+    if start is None:
+        raise SectionMissing([a])
+    end = marker_pattern(b).search(text, start.end()) or _ANY_HEADER.search(text, start.end())
+    return _clean(text[start.end():end.start() if end else len(text)])
+
+
+def parse_sections(text: str, markers: Sequence[str], end: str = '## END', partial: bool = False) -> Dict[str, str]:
+    """
+    Contents of several sections; each runs to the next of the later markers found, the end marker,
+    a '## Header:' line or the end of the response.
+
+    :param text: (str) Response.
+    :param markers: (Sequence[str]) Section markers in their expected order.
+    :param end: (str) End marker.
+    :param partial: (bool) Return the sections found instead of raising when some are missing.
+    :return: (Dict[str, str]) Marker -> content.
+    :raises SectionMissing: when sections are missing (and not partial).
+    """
+    starts = {}
+    for marker in markers:
+        match = marker_pattern(marker).search(text)
+        if match is not None:
+            starts[marker] = match
+    found = {}
+    for marker, match in starts.items():
+        stops = [other.start() for other in starts.values() if other.start() >= match.end()]
+        stop = marker_pattern(end).search(text, match.end()) or _ANY_HEADER.search(text, match.end())
+        if stop is not None:
+            stops.append(stop.start())
+        found[marker] = _clean(text[match.end():min(stops, default=len(text))])
+    missing = [marker for marker in markers if marker not in found]
+    if missing and not partial:
+        raise SectionMissing(missing, found)
+    return found
+
+
+def _json_block(text: str) -> str:
+    # The outermost {...} of a response, unclosed brackets closed at the end
+    text = re.sub(r'```(?:json)?', '', text)
+    start = text.find('{')
+    if start < 0:
+        raise InvalidKG("No JSON object in the knowledge graph section")
+    stack, in_string, escaped = [], False, False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            escaped = char == '\\' and not escaped
+            if char == '"' and not escaped:
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+            if not stack:
+                return text[start:index + 1]
+    # Truncated response: close what is open
+    return text[start:].rstrip().rstrip(',') + ('"' if in_string else '') + ''.join(reversed(stack))
+
+
+def repair_json(text: str) -> Any:
+    """
+    Load the JSON object of a response, repairing what LLMs commonly get wrong: code fences, surrounding prose,
+    smart or single quotes, trailing commas, unquoted keys, Python literals and a truncated end.
+
+    :param text: (str) Text containing a JSON object.
+    :return: (Any) The loaded object.
+    :raises InvalidKG: when it cannot be repaired.
+    """
+    block = _json_block(text)
+    try:
+        return json.loads(block)
+    except json.JSONDecodeError:
+        pass
+    fixed = block.translate(str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"}))
+    # Single-quoted keys and values, apostrophes inside words are left alone
+    fixed = re.sub(r"(?<=[{\[,:\s])'([^'\"\n]*)'(?=\s*[:,}\]])", r'"\1"', fixed)
+    fixed = re.sub(r'([{,]\s*)([A-Za-z_][\w-]*)(\s*:)', r'\1"\2"\3', fixed)
+    fixed = re.sub(r',(\s*[}\]])', r'\1', fixed)
+    fixed = re.sub(r'(?<=[:\[,\s])(True|False|None)(?=\s*[,}\]])',
+                   lambda m: {'True': 'true', 'False': 'false', 'None': 'null'}[m.group(1)], fixed)
+    try:
+        return json.loads(fixed)
+    except json.JSONDecodeError as e:
+        raise InvalidKG(f"Unrepairable knowledge graph JSON: {e}") from e
+
+
+def validate_kg(data: Any) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Check a knowledge graph against the ER format of the prompts and normalize it: entities with id, name and type,
+    relations with id, subject, predicate and object referring to entity ids (names are accepted and mapped).
+    Missing ids are numbered, relations to unknown entities are dropped.
+
+    :param data: (Any) Loaded JSON.
+    :return: (Dict) {'entities': [...], 'relations': [...]}.
+    :raises InvalidKG: when it has no usable entity.
+    """
+    if not isinstance(data, dict):
+        raise InvalidKG(f"The knowledge graph is a {type(data).__name__}, not an object")
+    entities, ids = [], {}
+    for number, entity in enumerate(data.get('entities') or [], 1):
+        if isinstance(entity, str):
+            entity = {'name': entity}
+        if not isinstance(entity, dict) or not str(entity.get('name') or '').strip():
+            continue
+        entity = {'id': str(entity.get('id') or f'e{number}'), 'name': str(entity['name']).strip(),
+                  'type': str(entity.get('type') or 'Unknown')}
+        entities.append(entity)
+        ids[entity['id'].lower()] = ids[entity['name'].lower()] = entity['id']
+    if not entities:
+        raise InvalidKG("The knowledge graph has no entities")
+    relations = []
+    for relation in data.get('relations') or []:
+        if not isinstance(relation, dict):
+            continue
+        subject = ids.get(str(relation.get('subject', '')).strip().lower())
+        target = ids.get(str(relation.get('object', '')).strip().lower())
+        predicate = str(relation.get('predicate') or relation.get('relation') or '').strip()
+        if subject and target and predicate:
+            relations.append({'id': str(relation.get('id') or f'r{len(relations) + 1}'), 'subject': subject,
+                              'predicate': predicate, 'object': target})
+    return {'entities': entities, 'relations': relations}
+
+
+def parse_kg(text: str) -> Dict[str, List[Dict[str, str]]]:
+    """
+    :param text: (str) Knowledge graph section of a response.
+    :return: (Dict) The repaired and validated knowledge graph, see validate_kg.
+    :raises InvalidKG: when it cannot be repaired or validated.
+    """
+    return validate_kg(repair_json(text))
+
+
+def _salvage_prompt(prompt, response: str, missing: Sequence[str], end: str):
+    # The original request, the incomplete answer and the request for the missing sections only
+    request = SALVAGE_PROMPT.format(names=', '.join(repr(m) for m in missing),
+                                    format='\n'.join(f"{marker}\n<...>" for marker in missing) + f"\n{end}")
+    if hasattr(prompt, 'to_messages'):
+        prompt = prompt.to_messages()
+    if isinstance(prompt, (list, tuple)):
+        from langchain_core.messages import AIMessage, HumanMessage
+        return list(prompt) + [AIMessage(content=response), HumanMessage(content=request)]
+    if isinstance(prompt, dict) and len(prompt) == 1:
+        (key, value), = prompt.items()
+        return {key: _salvage_prompt(value, response, missing, end)}
+    return f"{prompt}\n\nYour answer was:\n{response}\n{request}"
+
+
+def _first_check(markers: Sequence[str], end: str):
+    def check(content: str):
+        found = parse_sections(content, markers, end, partial=True)
+        if not found:
+            raise SectionMissing(markers)
+        return content, found
+    return check
+
+
+def invoke_sections(llm, prompt, node: str, markers: Sequence[str], end: str = '## END',
+                    check: Optional[Callable[[List[str]], Any]] = None) -> Any:
+    """
+    Ask for a response with several sections. A response with some sections missing is not thrown away:
+    only the missing ones are asked for ('<node>:salvage'); when that fails too, the whole call is repeated.
+
+    :param llm: (Runnable) Chat model or chain.
+    :param prompt: Prompt string, message list or single-key chain input.
+    :param node: (str) Node name of the calls.
+    :param markers: (Sequence[str]) Section markers in their expected order.
+    :param end: (str) End marker.
+    :param check: (Callable, optional) Applied to the section contents; when it raises, the whole call is repeated.
+    :return: The section contents in marker order, or check(contents).
+    :raises LLMCallError: when no complete response could be obtained.
+    """
+    from LLM.Invoker import invoke_llm, LLMCallError
+    complete = lambda content: _finish(parse_sections(content, markers, end), markers, check)
+    content, found = invoke_llm(llm, prompt, node=node, check=_first_check(markers, end))
+    missing = [marker for marker in markers if marker not in found]
+    try:
+        if missing:
+            found.update(invoke_llm(llm, _salvage_prompt(prompt, content, missing, end), node=f'{node}:salvage',
+                                    check=lambda extra: parse_sections(extra, missing, end)))
+        return _finish(found, markers, check)
+    except (LLMCallError, ValueError, AssertionError):
+        return invoke_llm(llm, prompt, node=node, check=complete)
+
+
+async def ainvoke_sections(llm, prompt, node: str, markers: Sequence[str], end: str = '## END',
+                           check: Optional[Callable[[List[str]], Any]] = None) -> Any:
+    """
+    Async twin of invoke_sections.
+    """
+    from LLM.Invoker import ainvoke_llm, LLMCallError
+    complete = lambda content: _finish(parse_sections(content, markers, end), markers, check)
+    content, found = await ainvoke_llm(llm, prompt, node=node, check=_first_check(markers, end))
+    missing = [marker for marker in markers if marker not in found]
+    try:
+        if missing:
+            found.update(await ainvoke_llm(llm, _salvage_prompt(prompt, content, missing, end), node=f'{node}:salvage',
+                                           check=lambda extra: parse_sections(extra, missing, end)))
+        return _finish(found, markers, check)
+    except (LLMCallError, ValueError, AssertionError):
+        return await ainvoke_llm(llm, prompt, node=node, check=complete)
+
+
+def _finish(found: Dict[str, str], markers: Sequence[str], check: Optional[Callable[[List[str]], Any]]) -> Any:
+    contents = [found[marker] for marker in markers]
+    return check(contents) if check is not None else contents
@@ -0,0 +1,178 @@
+'''
+-- @Time    : 2025/7/30 10:05
+-- @File    : PromptBudget.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import re
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+# Policies for a field over its budget: keep the start, keep the end (the most recent text),
+# keep both ends around an ellipsis, or have the utility model summarize it (falls back to 'middle')
+POLICIES = ('head', 'tail', 'middle', 'summarize')
+ELLIPSIS = ' [...] '
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]')
+
+SUMMARIZE_PROMPT = """
+Summarize the following text in at most {words} words, keep names, events and their order, and answer only with the summary:
+{text}
+"""
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: Optional[str]):
+    # tiktoken is optional: without it, or when its encoding files cannot be downloaded (offline), tokens are estimated;
+    # Claude and unknown models use cl100k_base as an approximation
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('cl100k_base')
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Tokens of a text for a model: exact with tiktoken installed, otherwise one token per CJK character
+    and one per 4 other characters.
+
+    :param text: (str) Any text.
+    :param model: (str, optional) Model name, e.g. 'gpt-3.5-turbo'.
+    :return: (int) Token count.
+    """
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _cut(text: str, tokens: int, model: Optional[str], from_end: bool) -> str:
+    # The first (or last) `tokens` tokens of text, cut at a whitespace when there is one nearby
+    encoding = _encoding(model)
+    if encoding is not None:
+        ids = encoding.encode(text, disallowed_special=())
+        piece = encoding.decode(ids[-tokens:] if from_end else ids[:tokens]) if tokens > 0 else ''
+    else:
+        chars = int(len(text) * tokens / max(count_tokens(text, model), 1))
+        piece = text[len(text) - chars:] if from_end else text[:chars]
+    if len(piece) > 40:
+        space = piece.find(' ', 0, 20) if from_end else piece.rfind(' ', len(piece) - 20)
+        if space > 0:
+            piece = piece[space + 1:] if from_end else piece[:space]
+    return piece
+
+
+def truncate(text: str, budget: int, policy: str = 'tail', model: Optional[str] = None) -> str:
+    """
+    Fit a text into a token budget.
+
+    :param text: (str) Field value.
+    :param budget: (int) Maximum tokens.
+    :param policy: (str) 'head', 'tail' or 'middle' ('summarize' is handled by PromptBudget and truncates like 'middle').
+    :param model: (str, optional) Model the tokens are counted for.
+    :return: (str) The text unchanged when it fits, otherwise its kept part(s) joined by ELLIPSIS.
+    """
+    if count_tokens(text, model) <= budget:
+        return text
+    if policy == 'head':
+        return _cut(text, budget, model, from_end=False) + ELLIPSIS.rstrip()
+    if policy == 'tail':
+        return ELLIPSIS.lstrip() + _cut(text, budget, model, from_end=True)
+    head = budget // 3
+    return _cut(text, head, model, from_end=False) + ELLIPSIS + _cut(text, budget - head, model, from_end=True)
+
+
+class PromptBudget:
+    def __init__(self, node: str, budgets: Dict[str, Tuple[int, str]], model: Optional[str] = None, llm=None):
+        """
+        Token budgets of the template fields of one node, so its prompt stops growing with the story.
+
+        :param node: (str) Node the prompt belongs to, used in logs and for summarization calls ('<node>:summarize').
+        :param budgets: (Dict[str, Tuple[int, str]]) Field -> (max tokens, policy), policy one of POLICIES.
+        :param model: (str, optional) Model the tokens are counted for.
+        :param llm: (Runnable, optional) Model used by the 'summarize' policy (default: settings.UTIL_LLM).
+        """
+        for field, (_, policy) in budgets.items():
+            if policy not in POLICIES:
+                raise ValueError(f"Unknown policy '{policy}' for field '{field}', choose one of {POLICIES}")
+        self.node = node
+        self.budgets = budgets
+        self.model = model
+        self.llm = llm
+
+    def _over(self, values: Dict[str, str]):
+        for field, value in values.items():
+            if field not in self.budgets or value is None:
+                continue
+            budget, policy = self.budgets[field]
+            tokens = count_tokens(str(value), self.model)
+            if tokens > budget:
+                yield field, str(value), tokens, budget, policy
+
+    def _log(self, field: str, tokens: int, budget: int, policy: str):
+        print(f"{self.node}: '{field}' has {tokens} tokens, budget {budget} ({policy})")
+
+    def _summary_prompt(self, text: str, budget: int) -> str:
+        # Summarize an over-long text, only its last part when even that would not fit the utility model comfortably
+        return SUMMARIZE_PROMPT.format(words=max(budget * 3 // 4, 10), text=truncate(text, 12000, 'tail', self.model))
+
+    def _llm(self):
+        if self.llm is None:
+            import settings
+            self.llm = settings.get_llm('UTIL_LLM')
+        return self.llm
+
+    def fit(self, **values) -> Dict[str, str]:
+        """
+        Apply the budgets to the given field values.
+
+        :param values: Field values, fields without a budget are returned unchanged.
+        :return: (Dict[str, str]) The values, those over budget truncated or summarized.
+        """
+        from LLM.Invoker import invoke_llm, LLMCallError
+        fitted = dict(values)
+        for field, text, tokens, budget, policy in self._over(values):
+            self._log(field, tokens, budget, policy)
+            if policy == 'summarize':
+                try:
+                    text = invoke_llm(self._llm(), self._summary_prompt(text, budget), node=f'{self.node}:summarize')
+                except LLMCallError:
+                    pass
+            fitted[field] = truncate(text, budget, 'middle' if policy == 'summarize' else policy, self.model)
+        return fitted
+
+    async def afit(self, **values) -> Dict[str, str]:
+        """
+        Async twin of fit.
+        """
+        from LLM.Invoker import ainvoke_llm, LLMCallError
+        fitted = dict(values)
+        for field, text, tokens, budget, policy in self._over(values):
+            self._log(field, tokens, budget, policy)
+            if policy == 'summarize':
+                try:
+                    text = await ainvoke_llm(self._llm(), self._summary_prompt(text, budget), node=f'{self.node}:summarize')
+                except LLMCallError:
+                    pass
+            fitted[field] = truncate(text, budget, 'middle' if policy == 'summarize' else policy, self.model)
+        return fitted
+
+
+def prompt_budget(node: str, llm=None) -> PromptBudget:
+    """
+    Budgets of a node configured in settings.PROMPT_BUDGETS, tokens counted for the node's model.
+
+    :param node: (str) Node name, a key of settings.PROMPT_BUDGETS (nodes without budgets get none).
+    :param llm: (Runnable, optional) The node's model, to count tokens with its tokenizer.
+    :return: (PromptBudget) The budgets.
+    """
+    import settings
+    from LLM.RateLimiter import model_name
+    return PromptBudget(node, settings.PROMPT_BUDGETS.get(node, {}), model_name(llm) if llm is not None else None)
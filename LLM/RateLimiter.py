@@ -0,0 +1,197 @@
+'''
+-- @Time    : 2025/7/29 11:10
+-- @File    : RateLimiter.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+from LLM.PromptBudget import count_tokens
+
+try:
+    import fcntl
+except ImportError:  # Windows: buckets are shared by the threads and coroutines of one process only
+    fcntl = None
+
+
+def model_name(llm) -> Optional[str]:
+    """
+    :param llm: (Runnable) Chat model, or a chain ending with one.
+    :return: (str, optional) Its model name, e.g. 'gpt-3.5-turbo'.
+    """
+    model = getattr(llm, 'last', llm)
+    return getattr(model, 'model_name', None) or getattr(model, 'model', None)
+
+
+def estimate_prompt_tokens(prompt: Any, model: Optional[str] = None) -> int:
+    """
+    Token count of a prompt, see LLM.PromptBudget.count_tokens, plus a few per message.
+
+    :param prompt: Prompt string, message list, prompt value or chain input.
+    :param model: (str, optional) Model the tokens are counted for.
+    :return: (int) Estimated prompt tokens.
+    """
+    if hasattr(prompt, 'to_messages'):
+        prompt = prompt.to_messages()
+    if isinstance(prompt, (list, tuple)):
+        return sum(estimate_prompt_tokens(p, model) + 4 for p in prompt)
+    if isinstance(prompt, dict):
+        return sum(estimate_prompt_tokens(v, model) for v in prompt.values())
+    content = getattr(prompt, 'content', prompt)
+    return count_tokens(content if isinstance(content, str) else str(content), model)
+
+
+def usage_tokens(response: Any) -> Optional[int]:
+    """
+    :param response: (AIMessage) Model response.
+    :return: (int, optional) Total tokens the provider reported for the call, None when it did not.
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage:
+        return usage.get('total_tokens')
+    return None
+
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Tuple[float, float]], state_dir: Optional[str] = None,
+                 output_tokens: int = 1024):
+        """
+        Token buckets per model, one for requests per minute and one for tokens per minute.
+        Callers wait until both buckets hold enough before calling, instead of being throttled by the provider.
+        Buckets are shared by threads and coroutines through a lock and, with state_dir, by every process
+        using the same directory through a locked state file per model.
+
+        :param limits: (Dict[str, Tuple[float, float]]) Model name -> (requests per minute, tokens per minute);
+            None for either means no limit on it. Models not listed are not limited.
+        :param state_dir: (str, optional) Directory of the shared bucket files, None for buckets of this process only.
+        :param output_tokens: (int) Completion tokens reserved per call when the model has no max_tokens;
+            the reservation is corrected with the usage the provider reports.
+        """
+        self.limits = dict(limits)
+        self.state_dir = state_dir if fcntl is not None else None
+        self.output_tokens = output_tokens
+        self._lock = threading.Lock()
+        self._states: Dict[str, Dict[str, float]] = {}
+        if self.state_dir:
+            os.makedirs(self.state_dir, exist_ok=True)
+
+    def limited(self, model: Optional[str]) -> bool:
+        """
+        :param model: (str, optional) Model name.
+        :return: (bool) True when calls of the model are rate limited.
+        """
+        return model is not None and model in self.limits
+
+    def reserve(self, llm, prompt) -> Tuple[Optional[str], int]:
+        """
+        Model and tokens a call will be charged with.
+
+        :param llm: (Runnable) Chat model or chain.
+        :param prompt: Prompt of the call.
+        :return: (Tuple) Model name (None when not limited) and estimated prompt + completion tokens.
+        """
+        model = model_name(llm)
+        if not self.limited(model):
+            return None, 0
+        max_tokens = getattr(getattr(llm, 'last', llm), 'max_tokens', None)
+        return model, estimate_prompt_tokens(prompt, model) + (max_tokens if isinstance(max_tokens, int) else self.output_tokens)
+
+    @contextmanager
+    def _state(self, model: str):
+        # Current bucket levels, saved back when the block ends; the caller holds self._lock
+        rpm, tpm = self.limits[model]
+        if not self.state_dir:
+            state = self._states.setdefault(model, {'requests': rpm or 0, 'tokens': tpm or 0, 'updated': time.time()})
+            yield state
+            return
+        path = os.path.join(self.state_dir, re.sub(r'[^\w.-]+', '_', model) + '.bucket')
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                state = json.loads(content) if content else {'requests': rpm or 0, 'tokens': tpm or 0, 'updated': time.time()}
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _take(self, model: str, tokens: int) -> float:
+        # Take one request and the tokens when both buckets hold enough and return 0, otherwise the seconds to wait
+        rpm, tpm = self.limits[model]
+        with self._lock, self._state(model) as state:
+            now = time.time()
+            elapsed = max(now - state['updated'], 0.)
+            state['updated'] = now
+            waits = []
+            if rpm:
+                state['requests'] = min(rpm, state['requests'] + elapsed * rpm / 60)
+                waits.append((1 - state['requests']) * 60 / rpm)
+            if tpm:
+                tokens = min(tokens, tpm)
+                state['tokens'] = min(tpm, state['tokens'] + elapsed * tpm / 60)
+                waits.append((tokens - state['tokens']) * 60 / tpm)
+            wait = max(waits + [0.])
+            if wait <= 0:
+                if rpm:
+                    state['requests'] -= 1
+                if tpm:
+                    state['tokens'] -= tokens
+            return wait
+
+    def acquire(self, model: Optional[str], tokens: int) -> float:
+        """
+        Block until the model has capacity for one request of `tokens` tokens, and take it.
+
+        :param model: (str, optional) Model name, None returns at once.
+        :param tokens: (int) Tokens of the call, see reserve.
+        :return: (float) Seconds waited.
+        """
+        if not self.limited(model):
+            return 0.
+        start = time.perf_counter()
+        while True:
+            wait = self._take(model, tokens)
+            if wait <= 0:
+                return time.perf_counter() - start
+            # A little jitter, so that waiting callers don't all retry at the same instant
+            time.sleep(wait * random.uniform(1., 1.1))
+
+    async def aacquire(self, model: Optional[str], tokens: int) -> float:
+        """
+        Async twin of acquire, waits without blocking the event loop.
+        """
+        if not self.limited(model):
+            return 0.
+        start = time.perf_counter()
+        while True:
+            wait = self._take(model, tokens)
+            if wait <= 0:
+                return time.perf_counter() - start
+            await asyncio.sleep(wait * random.uniform(1., 1.1))
+
+    def settle(self, model: Optional[str], reserved: int, used: Optional[int]):
+        """
+        Correct the token bucket with the usage the provider reported: return what was over-reserved,
+        charge what was under-reserved.
+
+        :param model: (str, optional) Model name.
+        :param reserved: (int) Tokens taken by acquire.
+        :param used: (int, optional) Tokens the call actually used, None to keep the reservation.
+        """
+        if not self.limited(model) or used is None or not self.limits[model][1]:
+            return
+        tpm = self.limits[model][1]
+        with self._lock, self._state(model) as state:
+            state['tokens'] = min(tpm, state['tokens'] + min(reserved, tpm) - used)
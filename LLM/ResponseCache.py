@@ -0,0 +1,203 @@
+'''
+-- @Time    : 2025/7/25 10:20
+-- @File    : ResponseCache.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# Sampling parameters that change the response distribution, read from the chat model when present
+SAMPLING_PARAMS = ('temperature', 'top_p', 'top_k', 'max_tokens', 'n', 'stop')
+
+
+def _render(prompt: Any) -> Any:
+    # Exact rendered input: strings as they are, messages as (role, content), prompt values as their messages
+    if hasattr(prompt, 'to_messages'):
+        prompt = prompt.to_messages()
+    if isinstance(prompt, (list, tuple)):
+        return [_render(p) for p in prompt]
+    if hasattr(prompt, 'content') and hasattr(prompt, 'type'):
+        return [prompt.type, prompt.content]
+    if isinstance(prompt, dict):
+        return {str(k): _render(v) for k, v in prompt.items()}
+    return prompt if isinstance(prompt, (str, int, float, bool, type(None))) else repr(prompt)
+
+
+def response_key(llm, prompt: Any) -> str:
+    """
+    Cache key of a call: provider, model, sampling parameters and the exact rendered messages.
+
+    :param llm: (Runnable) Chat model, or a chain ending with one.
+    :param prompt: Prompt string, message list or chain input.
+    :return: (str) sha256 hex digest.
+    """
+    model = getattr(llm, 'last', llm)
+    identity = {
+        'provider': f"{type(model).__module__}.{type(model).__name__}",
+        'model': getattr(model, 'model_name', None) or getattr(model, 'model', None),
+        'params': {name: getattr(model, name, None) for name in SAMPLING_PARAMS},
+        'chain': repr(getattr(llm, 'first', None)) if model is not llm else None,
+        'prompt': _render(prompt),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+
+
+class ResponseCache:
+    def __init__(self, path: str, ttl: Optional[float] = None, max_entries: int = 10000):
+        """
+        Persistent prompt -> response cache in one SQLite file, shared by every process using the same path.
+        Identical concurrent requests in a process are coalesced: one caller asks the model, the others wait for it.
+
+        :param path: (str) SQLite database file.
+        :param ttl: (float, optional) Seconds a response stays valid, None to keep it until evicted.
+        :param max_entries: (int) Maximum number of responses, the least recently used ones are evicted.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, node TEXT, response TEXT, '
+                         'created REAL, last_used REAL)')
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _Flight] = {}
+        self._ainflight: Dict[Tuple[int, str], asyncio.Future] = {}
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :param key: (str) Output of response_key.
+        :return: (str, optional) Cached response, None when missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key: str, node: str, response: str):
+        """
+        Store a response, evicting the least recently used ones beyond max_entries.
+
+        :param key: (str) Output of response_key.
+        :param node: (str) Node that made the call, kept for inspection.
+        :param response: (str) Raw response content.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, node, response, now, now))
+            self._db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+                             'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self._db.commit()
+
+    def delete(self, key: str):
+        """
+        :param key: (str) Output of response_key.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self._db.commit()
+
+    def fetch(self, key: str, node: str, compute: Callable[[], str]) -> str:
+        """
+        Cached response of key, or compute() stored under key. While one caller computes a key,
+        other callers of the same key wait for its result instead of sending the same request.
+
+        :param key: (str) Output of response_key.
+        :param node: (str) Node that made the call.
+        :param compute: (Callable) Makes the call and returns the raw response content.
+        :return: (str) Response content.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self._count('hits')
+            return cached
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.value is not None:
+                self._count('coalesced')
+                return flight.value
+            # The leader failed, try on our own
+            return compute()
+        self._count('misses')
+        try:
+            flight.value = compute()
+            self.put(key, node, flight.value)
+            return flight.value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    async def afetch(self, key: str, node: str, compute: Callable[[], Awaitable[str]]) -> str:
+        """
+        Async twin of fetch: identical requests of the same event loop are coalesced,
+        SQLite is read and written in a worker thread.
+
+        :param key: (str) Output of response_key.
+        :param node: (str) Node that made the call.
+        :param compute: (Callable) Coroutine function making the call and returning the raw response content.
+        :return: (str) Response content.
+        """
+        cached = await asyncio.to_thread(self.get, key)
+        if cached is not None:
+            self._count('hits')
+            return cached
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        future = self._ainflight.get(flight_key)
+        if future is not None:
+            value = await asyncio.shield(future)
+            if value is not None:
+                self._count('coalesced')
+                return value
+            # The leader failed, try on our own
+            return await compute()
+        future = self._ainflight[flight_key] = loop.create_future()
+        self._count('misses')
+        try:
+            value = await compute()
+            await asyncio.to_thread(self.put, key, node, value)
+            future.set_result(value)
+            return value
+        finally:
+            self._ainflight.pop(flight_key, None)
+            if not future.done():
+                future.set_result(None)
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def clear(self):
+        """Remove every cached response."""
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
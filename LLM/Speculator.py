@@ -0,0 +1,236 @@
+'''
+-- @Time    : 2025/7/30 15:40
+-- @File    : Speculator.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+## Start work a later node will probably need before the graph knows whether it will run
+#Invocation method:
+"""
+speculator().start('twist', outline, lambda: get_abstract(outline, language), lambda: aget_abstract(outline, language))
+...
+speculator().discard('twist')  # the graph took the other branch: cancelled, or its result ignored
+found, KG = speculator().take('twist', outline)  # the branch runs: the result when it was started for this input
+"""
+
+COLUMNS = ('started', 'hits', 'misses', 'failed', 'unspeculated')
+
+
+def story_scope() -> str:
+    # Speculations belong to the running story: its output directory, one per batch job
+    import settings
+    return settings.OUTPUT_DIR.get()
+
+
+class _Speculation:
+    def __init__(self, key: Hashable, future, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.key = key
+        self.future = future  # concurrent.futures.Future, or asyncio.Task when loop is set
+        self.loop = loop
+
+    def cancel(self):
+        if self.loop is None:
+            # A call already running in the pool cannot be interrupted, its result is dropped
+            self.future.cancel()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.future.cancel)
+
+
+class Speculator:
+    def __init__(self, workers: int = 2):
+        """
+        Runs work of a branch the graph has not chosen yet, at most one speculation per kind and story.
+        The branch takes the result when it was started for the same input; otherwise, or when the graph
+        takes the other branch, it is discarded. Hits and misses are counted per kind for the report.
+
+        :param workers: (int) Threads running the speculations of synchronous runs; async runs use tasks on their loop.
+        """
+        self.workers = workers
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._slots: Dict[Tuple[str, str], _Speculation] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, kind: str, column: str):
+        # In the caller's lock
+        self.stats.setdefault(kind, dict.fromkeys(COLUMNS, 0))[column] += 1
+
+    def _submit(self, func: Callable[[], Any]):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='speculation')
+        # In a copy of the caller's context, so the call sees the story's settings.OUTPUT_DIR and graph config
+        return self._pool.submit(contextvars.copy_context().run, func)
+
+    def start(self, kind: str, key: Hashable, func: Callable[[], Any],
+              afunc: Optional[Callable[[], Awaitable[Any]]] = None):
+        """
+        Start a speculation, replacing (and counting as a miss) the pending one of the same kind and story.
+
+        :param kind: (str) What is speculated, e.g. 'twist'.
+        :param key: (Hashable) The input it is computed from; take only returns it for the same key.
+        :param func: (Callable) The work, called without arguments in a worker thread.
+        :param afunc: (Callable, optional) Async twin of func, run as a task when called from an event loop.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        slot = (kind, story_scope())
+        with self._lock:
+            pending = self._slots.get(slot)
+            if pending is not None and pending.key == key:
+                return
+            if pending is not None:
+                pending.cancel()
+                self._count(kind, 'misses')
+            if loop is not None and afunc is not None:
+                self._slots[slot] = _Speculation(key, loop.create_task(afunc()), loop)
+            else:
+                self._slots[slot] = _Speculation(key, self._submit(func))
+            self._count(kind, 'started')
+
+    def pending(self, kind: str) -> bool:
+        """
+        :param kind: (str) What is speculated.
+        :return: (bool) True when the running story has a speculation of this kind.
+        """
+        with self._lock:
+            return (kind, story_scope()) in self._slots
+
+    def _pop(self, kind: str, key: Hashable,
+             match: Optional[Callable[[Hashable, Hashable], bool]] = None) -> Optional[_Speculation]:
+        with self._lock:
+            speculation = self._slots.pop((kind, story_scope()), None)
+            if speculation is None:
+                self._count(kind, 'unspeculated')
+                return None
+        # Outside the lock, match may run a model
+        usable = speculation.key == key if match is None else match(speculation.key, key)
+        with self._lock:
+            if not usable:
+                # Started for an input that changed since
+                speculation.cancel()
+                self._count(kind, 'misses')
+                return None
+            return speculation
+
+    def _failed(self, kind: str, error: BaseException) -> Tuple[bool, Any]:
+        with self._lock:
+            self._count(kind, 'failed')
+        print(f"Speculative {kind} failed ({type(error).__name__}: {error}), running it again.")
+        return False, None
+
+    def _hit(self, kind: str, value: Any) -> Tuple[bool, Any]:
+        with self._lock:
+            self._count(kind, 'hits')
+        return True, value
+
+    def take(self, kind: str, key: Hashable,
+             match: Optional[Callable[[Hashable, Hashable], bool]] = None) -> Tuple[bool, Any]:
+        """
+        The speculation's result for the branch that now runs, waiting for it when it is not done yet.
+
+        :param kind: (str) What is speculated.
+        :param key: (Hashable) The input the branch needs the result for.
+        :param match: (Callable, optional) match(started_key, key) -> True when the result is still usable for key
+            (default: the keys are equal).
+        :return: (Tuple[bool, Any]) (True, result) on a hit; (False, None) when there was none, it was started for
+            another input or it failed, and the branch computes the result itself.
+        """
+        speculation = self._pop(kind, key, match)
+        if speculation is None:
+            return False, None
+        if speculation.loop is not None:
+            # A task of an event loop cannot be waited for from a synchronous node
+            speculation.cancel()
+            with self._lock:
+                self._count(kind, 'misses')
+            return False, None
+        try:
+            value = speculation.future.result()
+        except Exception as e:
+            return self._failed(kind, e)
+        return self._hit(kind, value)
+
+    async def atake(self, kind: str, key: Hashable,
+                    match: Optional[Callable[[Hashable, Hashable], bool]] = None) -> Tuple[bool, Any]:
+        """
+        Async twin of take, waits without blocking the event loop; match runs in a worker thread.
+        """
+        if match is None:
+            speculation = self._pop(kind, key)
+        else:
+            speculation = await asyncio.to_thread(self._pop, kind, key, match)
+        if speculation is None:
+            return False, None
+        future = speculation.future
+        if speculation.loop is None:
+            future = asyncio.wrap_future(future)
+        elif speculation.loop is not asyncio.get_running_loop():
+            speculation.cancel()
+            with self._lock:
+                self._count(kind, 'misses')
+            return False, None
+        try:
+            value = await future
+        except asyncio.CancelledError as e:
+            if not future.cancelled():
+                raise  # the waiting node itself was cancelled
+            return self._failed(kind, e)
+        except Exception as e:
+            return self._failed(kind, e)
+        return self._hit(kind, value)
+
+    def discard(self, kind: str):
+        """
+        The graph took the other branch: cancel the running story's speculation of this kind, or drop its result.
+
+        :param kind: (str) What is speculated.
+        """
+        with self._lock:
+            speculation = self._slots.pop((kind, story_scope()), None)
+            if speculation is not None:
+                speculation.cancel()
+                self._count(kind, 'misses')
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: (Dict[str, Dict[str, float]]) Per kind: speculations started, hits (result used), misses (discarded),
+            failed, unspeculated (the branch ran without a speculation) and the hit rate (hits / started).
+        """
+        with self._lock:
+            report = {kind: dict(stats) for kind, stats in self.stats.items()}
+        for stats in report.values():
+            stats['hit_rate'] = stats['hits'] / stats['started'] if stats['started'] else 0.
+        return report
+
+    def print_report(self):
+        report = self.report()
+        if not report:
+            return
+        print(f"{'speculation':<16}" + ''.join(f"{column:>13}" for column in COLUMNS) + f"{'hit rate':>10}")
+        for kind, stats in sorted(report.items()):
+            print(f"{kind:<16}" + ''.join(f"{stats[column]:>13}" for column in COLUMNS)
+                  + f"{stats['hit_rate']:>10.0%}")
+
+
+_speculator: Optional[Speculator] = None
+_speculator_lock = threading.Lock()
+
+
+def speculator() -> Speculator:
+    """
+    :return: (Speculator) The process-wide speculator, created on first use with settings.SPECULATION_WORKERS threads.
+    """
+    global _speculator
+    with _speculator_lock:
+        if _speculator is None:
+            import settings
+            _speculator = Speculator(settings.SPECULATION_WORKERS)
+        return _speculator
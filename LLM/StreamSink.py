@@ -0,0 +1,252 @@
+'''
+-- @Time    : 2025/7/28 09:50
+-- @File    : StreamSink.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import os
+import threading
+from typing import Any, Callable, Optional, Tuple
+
+
+def chunk_text(chunk: Any) -> str:
+    """
+    Text of one streamed message chunk: a string content, or the text blocks of a content list (Anthropic).
+
+    :param chunk: (AIMessageChunk or str) Streamed piece.
+    :return: (str) Its text, '' when it carries none.
+    """
+    content = getattr(chunk, 'content', chunk)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return ''.join(block if isinstance(block, str) else block.get('text', '') for block in content
+                       if isinstance(block, (str, dict)))
+    return ''
+
+
+class MarkerFilter:
+    def __init__(self, start: Optional[str] = None, end: Optional[str] = None):
+        """
+        Lets through only the text between a start and an end marker of a streamed response (e.g. '## ending:' / '##END'),
+        a marker split across chunks is held back until it is complete.
+
+        :param start: (str, optional) Marker the visible text follows, None to show from the first token.
+        :param end: (str, optional) Marker the visible text stops at, None to show until the last token.
+        """
+        self.start = start
+        self.end = end
+        self._buffer = ''
+        self._state = 'before' if start else 'inside'
+        self._leading = True
+
+    def feed(self, text: str) -> str:
+        """
+        :param text: (str) Next streamed text.
+        :return: (str) The part of it, or of what was held back, that can be shown now.
+        """
+        if self._state == 'after':
+            return ''
+        self._buffer += text
+        if self._state == 'before':
+            found = self._buffer.find(self.start)
+            if found < 0:
+                self._buffer = self._buffer[-(len(self.start) - 1):] if len(self.start) > 1 else ''
+                return ''
+            self._buffer = self._buffer[found + len(self.start):]
+            self._state = 'inside'
+        if self.end:
+            found = self._buffer.find(self.end)
+            if found >= 0:
+                visible, self._buffer, self._state = self._buffer[:found].rstrip(), '', 'after'
+            else:
+                keep = len(self.end) - 1
+                visible = self._buffer[:len(self._buffer) - keep] if keep else self._buffer
+                self._buffer = self._buffer[len(visible):]
+        else:
+            visible, self._buffer = self._buffer, ''
+        if self._leading:
+            visible = visible.lstrip()
+            self._leading = not visible
+        return visible
+
+    def close(self) -> str:
+        """
+        :return: (str) Text held back at the end of the stream, when the end marker never came.
+        """
+        visible = self._buffer if self._state == 'inside' else ''
+        self._buffer, self._state = '', 'after'
+        return visible.rstrip() if not self._leading else visible.strip()
+
+
+def graph_stream_writer() -> Optional[Callable[[Any], None]]:
+    """
+    The custom stream writer of the running LangGraph node, None outside a graph run.
+
+    :return: (Callable, optional) Writer whose payloads show up in graph.stream(..., stream_mode="custom").
+    """
+    try:
+        from langgraph.config import get_stream_writer
+        return get_stream_writer()
+    except Exception:
+        return None
+
+
+class StreamSink:
+    def __init__(self, path: Optional[str] = None, console: bool = True, writer: Optional[Callable[[Any], None]] = None):
+        """
+        Receives the tokens of streamed LLM calls and shows them as they arrive: appended to the story file,
+        printed to stdout and sent as LangGraph custom stream events ({'event': 'token' | 'rollback' | 'commit', ...}).
+        Everything streamed since the last commit is provisional: a retry, a failed check or the next streamed call
+        (e.g. the rewrite replacing a draft) truncates it from the file again.
+
+        :param path: (str, optional) Story file the text is appended to, None to only print it.
+        :param console: (bool) Print the tokens to stdout.
+        :param writer: (Callable, optional) Stream writer for the events (default: the one of the running graph node).
+        """
+        self.path = path
+        self.console = console
+        self.writer = writer if writer is not None else graph_stream_writer()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._node = ''
+        self._filter = MarkerFilter()
+        self._checkpoint: Optional[int] = None
+        self._pending = ''
+
+    def _emit(self, event: str, **payload):
+        if self.writer is not None:
+            try:
+                self.writer({'event': event, 'node': self._node, **payload})
+            except Exception:
+                self.writer = None
+
+    def _append(self, text: str):
+        if self.path:
+            with open(self.path, 'ab') as f:
+                f.write(text.encode('utf-8'))
+        if self.console:
+            print(text, end='', flush=True)
+
+    def _truncate(self, reason: str):
+        # Remove the provisional text, in the caller's lock
+        if self._checkpoint is None:
+            return
+        if self.path and os.path.exists(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(self._checkpoint)
+        if self._pending:
+            if self.console:
+                print(f"\n[{reason}, discarding {len(self._pending)} streamed characters]\n", flush=True)
+            self._emit('rollback', chars=len(self._pending), reason=reason)
+        self._checkpoint, self._pending = None, ''
+
+    def begin(self, node: str, markers: Optional[Tuple[Optional[str], Optional[str]]] = None) -> int:
+        """
+        Start streaming one attempt of a call, replacing the provisional text of the previous one.
+
+        :param node: (str) Node making the call, reported with the events.
+        :param markers: (Tuple, optional) Start and end markers around the text to show, see MarkerFilter.
+        :return: (int) Generation to pass to write; writes of older generations (abandoned attempts) are ignored.
+        """
+        with self._lock:
+            self._truncate('replaced')
+            self._generation += 1
+            self._node = node
+            self._filter = MarkerFilter(*(markers or (None, None)))
+            self._checkpoint = os.path.getsize(self.path) if self.path and os.path.exists(self.path) else 0
+            return self._generation
+
+    def write(self, generation: int, text: str):
+        """
+        :param generation: (int) Generation returned by begin.
+        :param text: (str) Streamed text.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            visible = self._filter.feed(text)
+            if visible:
+                self._show(visible)
+
+    def finish(self, generation: int):
+        """
+        The attempt's stream ended: show what the marker filter held back.
+
+        :param generation: (int) Generation returned by begin.
+        """
+        with self._lock:
+            if generation == self._generation:
+                visible = self._filter.close()
+                if visible:
+                    self._show(visible)
+
+    def _show(self, visible: str):
+        self._append(visible)
+        self._pending += visible
+        self._emit('token', text=visible)
+
+    def replace(self, text: str):
+        """
+        Replace the provisional text with a revised version of it, e.g. a draft extended by a continuation call.
+
+        :param text: (str) New provisional text.
+        """
+        with self._lock:
+            if self._checkpoint is None:
+                self._checkpoint = os.path.getsize(self.path) if self.path and os.path.exists(self.path) else 0
+            if text.startswith(self._pending):
+                added = text[len(self._pending):]
+            else:
+                if self.path and os.path.exists(self.path):
+                    with open(self.path, 'r+b') as f:
+                        f.truncate(self._checkpoint)
+                if self.console:
+                    print(f"\n[revised, {len(text)} characters]\n", flush=True)
+                self._emit('rollback', chars=len(self._pending), reason='revised')
+                self._pending, added = '', text
+            if added:
+                self._show(added)
+
+    def rollback(self, reason: str = 'rolled back'):
+        """
+        Remove the provisional text and ignore further writes of the current attempt.
+
+        :param reason: (str) Shown on the console and in the rollback event.
+        """
+        with self._lock:
+            self._truncate(reason)
+            self._generation += 1
+
+    def commit(self, final: Optional[str] = None):
+        """
+        Keep the provisional text for good.
+
+        :param final: (str, optional) Exact text to keep; when the streamed text differs from it
+            (whitespace, marker leftovers), the file region is rewritten so the file matches the non-streamed result.
+        """
+        with self._lock:
+            if final is not None and final != self._pending and self.path:
+                if self._checkpoint is not None and os.path.exists(self.path):
+                    with open(self.path, 'r+b') as f:
+                        f.truncate(self._checkpoint)
+                with open(self.path, 'ab') as f:
+                    f.write(final.encode('utf-8'))
+            if self.console:
+                print(flush=True)
+            self._emit('commit', chars=len(final if final is not None else self._pending))
+            self._checkpoint, self._pending = None, ''
+            self._generation += 1
+
+
+def story_sink(path: Optional[str] = None) -> Optional[StreamSink]:
+    """
+    Sink streaming the story to the console and the given file, configured from settings (STREAM_STORY, STREAM_TO_CONSOLE).
+
+    :param path: (str, optional) Story file, None to only print.
+    :return: (StreamSink, optional) The sink, None when streaming is off.
+    """
+    import settings
+    if not settings.STREAM_STORY:
+        return None
+    return StreamSink(path, console=settings.STREAM_TO_CONSOLE)
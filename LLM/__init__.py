@@ -0,0 +1,25 @@
+'''
+-- @Time    : 2025/7/24 15:30
+-- @File    : __init__.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+from LLM.ResponseCache import ResponseCache, response_key
+from LLM.StreamSink import StreamSink, MarkerFilter, story_sink
+from LLM.RateLimiter import RateLimiter
+from LLM.PromptBudget import PromptBudget, prompt_budget, count_tokens, truncate
+from LLM.Speculator import Speculator, speculator
+from LLM.Invoker import Invoker, LLMCallError, LLMTimeout, InvalidOutput, is_retryable, get_invoker, invoke_llm, ainvoke_llm
+from LLM.OutputParser import SectionMissing, InvalidKG, between, parse_sections, parse_kg, invoke_sections, ainvoke_sections
+'''
+Usage:
+from LLM import invoke_llm
+outline = invoke_llm(settings.get_llm('UTIL_LLM'), prompt, node='generate_plain_story', check=get_outline)
+# retried with backoff on timeouts, throttling and unparsable output, raises LLMCallError when it gives up
+outline = await ainvoke_llm(llm, prompt, node='generate_plain_story', check=get_outline)  # same, from async nodes
+sink = StreamSink(settings.FINAL_STORY_PATH)
+text = invoke_llm(llm, messages, node='generate_expansion:writer', sink=sink)  # tokens reach the file and stdout as they arrive
+sink.commit(text)  # otherwise the next streamed call or a failed attempt removes them again
+reason, selected = invoke_sections(llm, prompt, node='generate_plain_story:select', markers=['## Reason:', '## Selected Outline:'])
+# a response missing a section is kept, only the missing section is asked for again ('<node>:salvage')
+'''
@@ -1,7 +1,5 @@
 import os , sys
-from utils import set_env
 
-set_env ()
 current_dir = os.getcwd ()
 parent_dir = os.path.dirname ( current_dir )
 # Add the parent directory to sys.path for module imports
@@ -9,14 +7,16 @@ sys.path.insert ( 0 , parent_dir )
 from StoryStarter import Starter_subgraph
 from StoryState import StoryState
 from TwistGenerator import Twist_subgraph
+from TwistGenerator.KnowledgeGraphProcess import discard_twist_speculation
+from PlainGenerator.PlainGenerate import discard_plain_prefetch
 from PlainGenerator import Plain_subgraph
 from langgraph.constants import START , END
 from langgraph.graph import StateGraph
 from Expander import Expender_subgraph
 from End import End_subgraph
 
-# Add the parent directory to sys.path again (redundant but ensures configuration)
-from settings import *
+import settings
+from settings import SIMILARITY_THRESHOLD , MAX_LEN
 
 # Compile subgraphs into executable nodes for the main graph
 twist_subgraph = Twist_subgraph.compile ()
@@ -32,14 +32,28 @@ def if_similarity_higher_than_threshold(state: StoryState , similarity_threshold
     """
     Checks if the story's current similarity score meets or exceeds the defined threshold.
     High similarity indicates repetitive content, triggering a plot twist.
+    With settings.TWIST_ON_HISTORY the highest similarity to any earlier outline ('HistorySimilarity') counts as well.
 
     :param state: (StoryState) Current story state containing similarity metric.
     :param similarity_threshold: (float) Threshold for determining when a twist is needed (default from settings).
     :return: (bool) True if similarity is high, False otherwise.
     """
-    if state['similarity'] >= similarity_threshold:
+    similarity = state['similarity']
+    if similarity is None:
+        # Decided by the similarity cascade's lexical tier, its score is not on the embedding scale
+        from Embedding import similarity_cascade
+        twist = similarity_cascade ().decide ( state['LexicalSimilarity'] )
+    else:
+        if settings.TWIST_ON_HISTORY:
+            similarity = max ( similarity , state.get ( 'HistorySimilarity' , 0 ) )
+        twist = similarity >= similarity_threshold
+    if twist:
+        # The plain outline prefetched during the Expander is not needed
+        discard_plain_prefetch ()
         return True
     else:
+        # A KG extraction started for a foreseen twist is not needed
+        discard_twist_speculation ()
         return False
 
 
@@ -54,6 +68,8 @@ def if_stop_generate(state: StoryState , max_length=MAX_LEN) -> bool:
     :return: (bool) True if maximum length is reached, False otherwise.
     """
     if state['TotalStoryLength'] >= max_length:
+        discard_twist_speculation ()
+        discard_plain_prefetch ()
         return True
     else:
         print ( "One generate round is finished. Now start to generate next round." )
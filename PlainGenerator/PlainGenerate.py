@@ -5,41 +5,72 @@
 -- @IDE     : PyCharm
 '''
 from StoryState import StoryState
-from utils import set_env
-set_env()
 import warnings
 warnings.filterwarnings("ignore")
 from PlainGenerator.PlainWritingAssistant import PlainWritingAssistant
+import settings
+from LLM import speculator
 
 
 def generate_plain_story(state: StoryState, length:int = 400, long_term_memory:str = "")->StoryState:
     """
     Generates a plain story outline based on the given story state and parameters.
-    Continuously attempts to initialize the writing assistant until successful, then generates the story.
+    Initializes the writing assistant, then generates the story.
 
     :param state: (StoryState) Object containing current story metadata (characters, goal, language, etc.)
     :param length: (int) Target length of the generated story segment (default: 400)
     :param long_term_memory: (str) Long-term memory context to guide the generation (default: empty string)
     :return: (StoryState) Updated story state with the new generated content added to RecentStory
     """
-    # Create a PlainWritingAssistant instance
-    button: bool = True
-    while button:
-        try:
-            writing_assistant = PlainWritingAssistant(
-                language=state['Language'],
-                length=length,
-                topic=state['Topic'],
-                last_outline=state['RecentStory'][-1],
-                goal=state['MainGoal'],
-                long_term_memory=long_term_memory,
-                start_sign=state['StartSign']
-            )
-            button = False
-        except:
-            continue
-    # Generate the plain story
-    chosen_outline = writing_assistant()
+    # Prefetched while the previous round was expanded, when its outline did not drift since
+    found, chosen_outline = take_prefetched(state, length, long_term_memory)
+    if not found:
+        # Create a PlainWritingAssistant instance
+        writing_assistant = make_assistant(state, length, long_term_memory)
+        # Generate the plain story
+        chosen_outline = writing_assistant()
+    return plain_state(state, chosen_outline)
+
+
+async def agenerate_plain_story(state: StoryState, length:int = 400, long_term_memory:str = "")->StoryState:
+    """
+    Async twin of generate_plain_story.
+    """
+    found, chosen_outline = await atake_prefetched(state, length, long_term_memory)
+    if not found:
+        writing_assistant = make_assistant(state, length, long_term_memory)
+        chosen_outline = await writing_assistant.acall()
+    return plain_state(state, chosen_outline)
+
+
+def make_assistant(state: StoryState, length:int, long_term_memory:str)->PlainWritingAssistant:
+    """
+    Creates the writing assistant continuing the latest outline of the story.
+
+    :param state: (StoryState) Current story state
+    :param length: (int) Target length of the generated story segment
+    :param long_term_memory: (str) Long-term memory context to guide the generation
+    :return: (PlainWritingAssistant) The assistant
+    """
+    return PlainWritingAssistant(
+        language=state['Language'],
+        length=length,
+        topic=state['Topic'],
+        last_outline=state['RecentStory'][-1],
+        goal=state['MainGoal'],
+        long_term_memory=long_term_memory,
+        start_sign=state['StartSign']
+    )
+
+
+def plain_state(state: StoryState, chosen_outline:str)->StoryState:
+    """
+    Builds the story state after a plain outline was chosen.
+
+    :param state: (StoryState) Story state before the generation
+    :param chosen_outline: (str) The chosen outline
+    :return: (StoryState) Updated story state with the new generated content added to RecentStory
+    """
     state_final = {
         'MainCharacter': state['MainCharacter'],
         'MainGoal': state['MainGoal'],
@@ -53,6 +84,78 @@ def generate_plain_story(state: StoryState, length:int = 400, long_term_memory:s
     return state_final
 
 
+def prefetch_plain_story(state: StoryState, length:int = 400, long_term_memory:str = ""):
+    """
+    With settings.PREFETCH_PLAIN, start generating the next round's plain outline from this round's outline in the
+    background, so the utility model works while the writer model expands the round.
+
+    :param state: (StoryState) Story state at the start of the Expander
+    :param length: (int) Target length, as the next generate_plain_story will use (default: 400)
+    :param long_term_memory: (str) Long-term memory context, as the next generate_plain_story will use
+    """
+    if not settings.PREFETCH_PLAIN:
+        return
+    # The state the next plain round would see, were the outline not changed by the Expander
+    basis = {**state, 'RecentStory': [state['RecentStory'][-1]], 'StartSign': False}
+    key = (basis['RecentStory'][-1], state['Language'], length, long_term_memory)
+    speculator().start('plain', key, lambda: make_assistant(basis, length, long_term_memory)(),
+                       lambda: make_assistant(basis, length, long_term_memory).acall())
+
+
+def outline_drift_ok(prefetched: tuple, current: tuple) -> bool:
+    """
+    Whether a prefetched outline still continues the story: the outline it was generated from and the one the round
+    ended with (the Expander may have rewritten it) are close enough in embedding space.
+
+    :param prefetched: (tuple) Key of the prefetch: outline, language, length, long-term memory
+    :param current: (tuple) The same for the plain round that runs now
+    :return: (bool) True when the prefetched outline can be used
+    """
+    if prefetched[1:] != current[1:]:
+        return False
+    if prefetched[0] == current[0]:
+        return True
+    from utils import encode_paragraphs
+    from Embedding import twist_model
+    basis, final = encode_paragraphs([prefetched[0], current[0]], name=twist_model())
+    similarity = float(basis @ final)
+    if similarity < settings.PREFETCH_MIN_SIMILARITY:
+        print(f"The outline drifted during the expansion (similarity {similarity:.3f}), discarding the prefetched outline.")
+        return False
+    return True
+
+
+def take_prefetched(state: StoryState, length:int = 400, long_term_memory:str = ""):
+    """
+    :param state: (StoryState) Current story state
+    :param length: (int) Target length of the generated story segment
+    :param long_term_memory: (str) Long-term memory context
+    :return: (tuple) (True, outline) when a usable prefetched outline was waited for, (False, None) otherwise
+    """
+    if not settings.PREFETCH_PLAIN:
+        return False, None
+    key = (state['RecentStory'][-1], state['Language'], length, long_term_memory)
+    return speculator().take('plain', key, match=outline_drift_ok)
+
+
+async def atake_prefetched(state: StoryState, length:int = 400, long_term_memory:str = ""):
+    """
+    Async twin of take_prefetched.
+    """
+    if not settings.PREFETCH_PLAIN:
+        return False, None
+    key = (state['RecentStory'][-1], state['Language'], length, long_term_memory)
+    return await speculator().atake('plain', key, match=outline_drift_ok)
+
+
+def discard_plain_prefetch():
+    """
+    The next round is a twist or the ending: cancel the prefetched plain outline, or drop it.
+    """
+    if settings.PREFETCH_PLAIN:
+        speculator().discard('plain')
+
+
 def check_and_pass(state: StoryState) -> StoryState:
     """
     Validates and cleans the story state, ensuring consistency in the RecentStory field.
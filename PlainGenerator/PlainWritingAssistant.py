@@ -5,7 +5,8 @@
 -- @IDE     : PyCharm
 '''
 
-from settings import UTIL_LLM
+import settings
+from LLM import invoke_llm, ainvoke_llm, invoke_sections, ainvoke_sections, parse_sections, LLMCallError, prompt_budget
 
 ## Create a plain story generator assistant
 #Invocation method:
@@ -20,16 +21,17 @@ writing_assistant = PlainWritingAssistant(
             )
 chosen_outline = writing_assistant()
 """
-import os,sys,json
-from langchain_openai import ChatOpenAI
-from typing import Optional
+import os,sys,json,re
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 import os,sys
 
 import warnings
 
 warnings.filterwarnings("ignore")
-from utils import get_content_between_a_b,set_env
-set_env()
+from utils import get_content_between_a_b
 
 # Add the parent directory to sys.path
 current_dir = os.getcwd()
@@ -68,27 +70,71 @@ Output your result in the following format, don't change the format, English, su
 ## END
 """
 
+# Parallel mode (settings.PLAIN_PARALLEL): one short call per candidate outline, all sent at once
+CANDIDATE_PROMPT="""
+You're a story generator and a native speaker of {language}. Your task is to generate an outline in {language}, continuing to write this story based on {last_outline}, your outline must be close to the topic: '{topic}' and the goal: '{goal}'. Based on your memory:{long_term_memory}
+Other writers are drafting other continuations at the same time, this is draft {index} of {n}: take the story towards {direction}, so that your draft differs from theirs.
+Follow these steps:
+1. Create ONE continuing outline based on the original outline, at least {length} words;
+2. Your output should be in {language}, and your story should still be on this topic: {topic}.
+Output your result in the following format, don't change the format, English, such as "## Outline:":
+## Outline:
+<here, put your outline in {language}>
+## END
+"""
+
+# One direction per candidate, so that concurrent calls don't all write the most likely continuation
+CANDIDATE_DIRECTIONS = [
+    "an unexpected turn of events",
+    "a choice that reveals the main character",
+    "a lighter and funnier scene",
+    "higher stakes and a new obstacle",
+    "a new place or a new character",
+    "a consequence of something that happened earlier",
+]
+
+SELECT_N_PROMPT="""
+Selecting the most funny continuing outlines from the following {n} outlines:
+{outlines}
+and give me your reason.
+Follow these steps:
+1. Analyze these {n} outlines.
+2. Select the one most funny continuing outline from these {n} outlines.
+Output your result in the following format, don't change the format, English, such as"## Reason:":
+## Reason:
+<here, put your reason>
+## Selected Outline:
+<here, put only the number of your selected outline, from 1 to {n}>
+## END
+"""
+
+SELECTORS = ('llm', 'local', 'local+llm')
+
+# Sections of the generate and select responses, in their order
+OUTLINE_MARKERS = ["## Outline1:", "## Outline2:", "## Outline3:"]
+SELECT_MARKERS = ["## Reason:", "## Selected Outline:"]
+
+SUMMARY_PROMPT = "here is an outline:{outline}, summerize it in up to 30 words."
+
 
 def parser_generate_response(response:str):
     """
     Function to parse the response of generated story outlines.
 
     This function extracts three different story outlines from the response text returned by the large language model.
-    It uses the `get_content_between_a_b` function to intercept the corresponding outline content based on specific delimiters.
+    It uses `parse_sections` to intercept the outlines between the OUTLINE_MARKERS, tolerating case, spacing and a missing END marker.
 
     Args:
         response (str): The response text containing story outlines returned by the large language model.
 
     Returns:
         tuple: A tuple containing three story outline strings, namely the first outline, the second outline, and the third outline.
+
+    Raises:
+        SectionMissing: When an outline is missing.
     """
-    # Extract the first story outline from the response text
-    outline1 = get_content_between_a_b("## Outline1:","## Outline2:",response)
-    # Extract the second story outline from the response text
-    outline2 = get_content_between_a_b("## Outline2:","## Outline3:",response)
-    # Extract the third story outline from the response text
-    outline3 = get_content_between_a_b("## Outline3:","## END",response)
-    return outline1,outline2,outline3
+    sections = parse_sections(response, OUTLINE_MARKERS)
+    return tuple(sections[marker] for marker in OUTLINE_MARKERS)
 
 
 def parser_select_response(response:str):
@@ -96,23 +142,71 @@ def parser_select_response(response:str):
     Function to parse the response of selected story outlines.
 
     This function extracts the reason for selecting the story outline and the final selected story outline from the response text returned by the large language model.
-    It uses the `get_content_between_a_b` function to intercept the corresponding content based on specific delimiters.
+    It uses `parse_sections` to intercept the contents between the SELECT_MARKERS, tolerating case, spacing and a missing END marker.
 
     Args:
         response (str): The response text containing the selection reason and the selected outline returned by the large language model.
 
     Returns:
         tuple: A tuple containing the selection reason string and the selected story outline string.
+
+    Raises:
+        SectionMissing: When the reason or the selected outline is missing.
+    """
+    sections = parse_sections(response, SELECT_MARKERS)
+    return tuple(sections[marker] for marker in SELECT_MARKERS)
+
+
+def parser_candidate_response(response:str):
+    """
+    Function to parse the response of one candidate outline (parallel mode).
+
+    Args:
+        response (str): The response text containing one story outline.
+
+    Returns:
+        str: The outline.
+    """
+    return get_content_between_a_b("## Outline:","## END",response)
+
+
+def parser_select_index(n:int):
+    """
+    Build the parser of a selection answered with an outline number (parallel mode).
+
+    Args:
+        n (int): Number of candidate outlines.
+
+    Returns:
+        Callable: Parser returning (reason, index) with index counted from 0, raising ValueError when the number is missing or out of range.
+    """
+    check = selected_index(n)
+    def parser(response:str):
+        return check(parser_select_response(response))
+    return parser
+
+
+def selected_index(n:int):
+    """
+    Build the check of the (reason, selected) sections of a selection answered with an outline number.
+
+    Args:
+        n (int): Number of candidate outlines.
+
+    Returns:
+        Callable: Check returning (reason, index) with index counted from 0, raising ValueError when the number is missing or out of range.
     """
-    # Extract the reason for selecting the story outline from the response text
-    reason = get_content_between_a_b("## Reason:","## Selected Outline:",response)
-    # Extract the final selected story outline from the response text
-    selected = get_content_between_a_b("## Selected Outline:","## END",response)
-    return reason,selected
+    def check(sections):
+        reason, selected = sections
+        number = re.search(r"\d+", selected)
+        if number is None or not 1 <= int(number.group()) <= n:
+            raise ValueError(f"No outline number between 1 and {n} in: {selected!r}")
+        return reason, int(number.group()) - 1
+    return check
 
 
 class PlainWritingAssistant:
-    def __init__(self, language="English", length=350, topic="",last_outline="", goal = "",long_term_memory:str = '',start_sign:bool=False, llm=UTIL_LLM):
+    def __init__(self, language="English", length=350, topic="",last_outline="", goal = "",long_term_memory:str = '',start_sign:bool=False, llm=None, parallel:Optional[bool]=None, candidates:Optional[int]=None, selector:Optional[str]=None):
         """
         Initialize an instance of the PlainWritingAssistant class.
 
@@ -123,7 +217,10 @@ class PlainWritingAssistant:
             last_outline (str, optional): The previous story outline, defaults to an empty string.
             goal (str, optional): The goal of the story, defaults to an empty string.
             long_term_memory (str, optional): Long-term memory content, defaults to an empty string.
-            llm (ChatOpenAI, optional): The instance used to call the large language model, defaults to a ChatOpenAI instance using the gpt-3.5-turbo model.
+            llm (ChatOpenAI, optional): The instance used to call the large language model, defaults to settings.UTIL_LLM (gpt-3.5-turbo).
+            parallel (bool, optional): Ask for each candidate outline in its own concurrent call, defaults to settings.PLAIN_PARALLEL.
+            candidates (int, optional): Number of candidate outlines in parallel mode, defaults to settings.PLAIN_CANDIDATES.
+            selector (str, optional): 'llm' (LLM judge), 'local' (embeddings only) or 'local+llm' (embeddings, LLM judge when too close to call), defaults to settings.PLAIN_SELECTOR.
         """
         self.start_sign = start_sign
         self.language = language
@@ -131,43 +228,71 @@ class PlainWritingAssistant:
         self.topic = topic
         self.goal = goal
         self.last_outline = last_outline
-        self.llm = llm
+        self.llm = llm if llm is not None else settings.get_llm('UTIL_LLM')
         self.long_term_memory = long_term_memory
+        self.parallel = settings.PLAIN_PARALLEL if parallel is None else parallel
+        self.candidates = settings.PLAIN_CANDIDATES if candidates is None else candidates
+        if self.candidates < 1:
+            raise ValueError(f"candidates must be at least 1, got {self.candidates}")
+        self.selector = settings.PLAIN_SELECTOR if selector is None else selector
+        if self.selector not in SELECTORS:
+            raise ValueError(f"Unknown selector '{self.selector}', choose one of {SELECTORS}")
         print("Setting up PlainWritingAssistant...")
 
     def __call__(self, storage:Optional[str] = None)->str:
         """
         Method executed when the class instance is called.
         This method calls the `step` method and returns the return value of the `step` method.
+        Every LLM call of the step is retried on its own by LLM.invoke_llm, which raises LLMCallError when it gives up.
 
         Returns:
             The return value of calling the `step` method.
         """
-        button = True
-        trying = 0
-        while button and trying < 4:
-            try:
-                self.clear()
-                button = False
-                return self.step(storage)
-            except:
-                print(f"running {self.__class__.__name__} failed, retrying...")
-                trying += 1
-        warnings.warn(f"running {self.__class__.__name__} failed {trying} times, return None")
-        return None
+        self.clear()
+        self.fit_fields(prompt_budget('generate_plain_story', self.llm).fit(
+            last_outline=self.last_outline, long_term_memory=self.long_term_memory))
+        return self.step(storage)
+
+    async def acall(self, storage:Optional[str] = None)->str:
+        """
+        Async twin of __call__.
+
+        Returns:
+            The return value of the `astep` method.
+        """
+        self.clear()
+        self.fit_fields(await prompt_budget('generate_plain_story', self.llm).afit(
+            last_outline=self.last_outline, long_term_memory=self.long_term_memory))
+        return await self.astep(storage)
+
+    def fit_fields(self, fields: dict):
+        """
+        Use the prompt fields fitted to their token budgets (settings.PROMPT_BUDGETS), so the prompts of every
+        candidate and of the judge stay the same size however long the story gets.
 
+        Args:
+            fields (dict): 'last_outline' and 'long_term_memory' as returned by PromptBudget.fit.
+        """
+        self.last_outline = fields['last_outline']
+        self.long_term_memory = fields['long_term_memory']
 
+    def generate_prompt(self)->str:
+        """
+        Format the prompt asking for three continuing outlines.
+
+        Returns:
+            str: The rendered prompt.
+        """
+        return GENERATE_PROMPT.format(language=self.language, length=self.length, topic=self.topic, goal=self.goal, last_outline=self.last_outline, long_term_memory=self.long_term_memory)
 
-    def generate(self):
+    def select_prompt(self)->str:
         """
-        Generate a prompt based on a predefined template and call the large language model to get the response content.
+        Format the prompt asking to select one of the three generated outlines.
 
         Returns:
-            str: The response text returned by the large language model.
+            str: The rendered prompt.
         """
-        prompt = GENERATE_PROMPT.format(language=self.language, length=self.length, topic=self.topic, goal=self.goal, last_outline=self.last_outline, long_term_memory=self.long_term_memory)
-        response = self.llm.invoke(prompt).content
-        return response
+        return SELECT_PROMPT.format(length=self.length, topic=self.topic, goal=self.goal, outline1=self.outline1, outline2=self.outline2, outline3=self.outline3, start_sign=self.start_sign)
 
     def generate_outlines(self):
         """
@@ -176,17 +301,136 @@ class PlainWritingAssistant:
         Returns:
             tuple: A tuple containing three story outline strings, namely the first outline, the second outline, and the third outline.
         """
-        button = True
-        trying = 0
+        # A response missing an outline is kept, only the missing ones are asked for again
+        self.outline1,self.outline2,self.outline3 = invoke_sections(self.llm, self.generate_prompt(), node='generate_plain_story:generate', markers=OUTLINE_MARKERS)
 
-        response = self.generate()
-        self.outline1,self.outline2,self.outline3 = parser_generate_response(response)
+        return self.outline1,self.outline2,self.outline3
 
+    async def agenerate_outlines(self):
+        """
+        Async twin of generate_outlines.
+        """
+        self.outline1,self.outline2,self.outline3 = await ainvoke_sections(self.llm, self.generate_prompt(), node='generate_plain_story:generate', markers=OUTLINE_MARKERS)
         return self.outline1,self.outline2,self.outline3
 
+    def candidate_prompt(self, index:int)->str:
+        """
+        Format the prompt asking for one candidate outline (parallel mode).
+
+        Args:
+            index (int): Candidate number, counted from 0.
+
+        Returns:
+            str: The rendered prompt.
+        """
+        return CANDIDATE_PROMPT.format(language=self.language, length=self.length, topic=self.topic, goal=self.goal, last_outline=self.last_outline, long_term_memory=self.long_term_memory,
+                                       index=index + 1, n=self.candidates, direction=CANDIDATE_DIRECTIONS[index % len(CANDIDATE_DIRECTIONS)])
+
+    def select_n_prompt(self)->str:
+        """
+        Format the prompt asking to select one of the candidate outlines by number (parallel mode).
+
+        Returns:
+            str: The rendered prompt.
+        """
+        outlines = "\n".join(f"## Outline{i + 1}:\n{outline}" for i, outline in enumerate(self.outlines))
+        return SELECT_N_PROMPT.format(n=len(self.outlines), outlines=outlines)
+
+    def generate_candidates(self)->List[str]:
+        """
+        Ask for the candidate outlines in concurrent calls, one per candidate (parallel mode).
+        A candidate whose call gives up is dropped, the round only fails when every candidate failed.
+
+        Returns:
+            List[str]: The candidate outlines that came back.
+        """
+        def one(index):
+            try:
+                return invoke_llm(self.llm, self.candidate_prompt(index), node='generate_plain_story:generate', check=parser_candidate_response)
+            except LLMCallError as e:
+                return e
+        with ThreadPoolExecutor(max_workers=self.candidates) as pool:
+            # Each call in a copy of the caller's context: the story's OUTPUT_DIR, LangGraph's config and callbacks
+            futures = [pool.submit(contextvars.copy_context().run, one, index) for index in range(self.candidates)]
+            results = [future.result() for future in futures]
+        return self._keep_candidates(results)
+
+    async def agenerate_candidates(self)->List[str]:
+        """
+        Async twin of generate_candidates.
+        """
+        results = await asyncio.gather(*(ainvoke_llm(self.llm, self.candidate_prompt(index), node='generate_plain_story:generate', check=parser_candidate_response)
+                                         for index in range(self.candidates)), return_exceptions=True)
+        return self._keep_candidates(results)
+
+    def _keep_candidates(self, results)->List[str]:
+        failed = [r for r in results if isinstance(r, BaseException)]
+        for r in failed:
+            if not isinstance(r, LLMCallError):
+                raise r
+        self.outlines = [r for r in results if not isinstance(r, BaseException)]
+        if not self.outlines:
+            raise failed[0]
+        if failed:
+            print(f"{len(failed)} of {self.candidates} candidate outlines failed, selecting among the other {len(self.outlines)}.")
+        return self.outlines
+
+    def judge(self, candidates:List[str]):
+        """
+        Ask the LLM to select one of the candidate outlines: by number in parallel mode, by copying it otherwise.
+        With a single candidate, the call is skipped.
+
+        Args:
+            candidates (List[str]): The candidate outlines.
+
+        Returns:
+            tuple: The selection reason and the selected outline.
+        """
+        if len(candidates) == 1:
+            return "Only one candidate outline.", candidates[0]
+        if self.parallel:
+            reason, index = invoke_sections(self.llm, self.select_n_prompt(), node='generate_plain_story:select', markers=SELECT_MARKERS, check=selected_index(len(candidates)))
+            return reason, candidates[index]
+        return tuple(invoke_sections(self.llm, self.select_prompt(), node='generate_plain_story:select', markers=SELECT_MARKERS))
+
+    async def ajudge(self, candidates:List[str]):
+        """
+        Async twin of judge.
+        """
+        if len(candidates) == 1:
+            return "Only one candidate outline.", candidates[0]
+        if self.parallel:
+            reason, index = await ainvoke_sections(self.llm, self.select_n_prompt(), node='generate_plain_story:select', markers=SELECT_MARKERS, check=selected_index(len(candidates)))
+            return reason, candidates[index]
+        return tuple(await ainvoke_sections(self.llm, self.select_prompt(), node='generate_plain_story:select', markers=SELECT_MARKERS))
+
+    def local_select(self, candidates:List[str]):
+        """
+        Select a candidate outline with embeddings (relevance to the goal and topic, novelty against the story so far),
+        without an LLM call. Used when self.selector is 'local' or 'local+llm'. The story so far is the story's novelty
+        index, calculate_similarity adds every round's outline to it while settings.PLAIN_SELECTOR is local.
+
+        Args:
+            candidates (List[str]): The candidate outlines.
+
+        Returns:
+            Optional[tuple]: The selection reason and the selected outline, or None when the LLM judge should decide:
+            always for the 'llm' selector, and for 'local+llm' when the two best scores are within settings.SELECTOR_MARGIN.
+        """
+        if self.selector == 'llm':
+            return None
+        from Embedding import outline_selector, story_index
+        history = story_index()
+        index, close, reason = outline_selector().select(candidates, self.goal, self.topic, self.last_outline,
+                                                         history.vectors if len(history) else None)
+        if close and self.selector == 'local+llm':
+            print(f"{reason} Too close to call, asking the LLM judge.")
+            return None
+        return reason, candidates[index]
+
     def select_outlines(self, show_reason=False):
         """
-        Generate three story outlines and select the most interesting one from them.
+        Generate the candidate outlines and select one of them, locally with embeddings or with the LLM judge (see self.selector).
 
         Args:
             show_reason (bool, optional): Whether to return the reason for selection, defaults to False.
@@ -194,9 +438,21 @@ class PlainWritingAssistant:
         Returns:
             Union[str, tuple]: If show_reason is False, return the selected story outline; if True, return a tuple containing the selection reason and the selected story outline.
         """
-        self.generate_outlines()
-        prompt = SELECT_PROMPT.format(length=self.length, topic=self.topic, goal=self.goal, outline1=self.outline1, outline2=self.outline2, outline3=self.outline3, start_sign=self.start_sign)
-        self._reason, self.chosen_outline = parser_select_response(self.llm.invoke(prompt).content)
+        candidates = self.generate_candidates() if self.parallel else list(self.generate_outlines())
+        selected = self.local_select(candidates)
+        self._reason, self.chosen_outline = selected if selected is not None else self.judge(candidates)
+        if show_reason:
+            return self._reason,self.chosen_outline
+        else:
+            return self.chosen_outline
+
+    async def aselect_outlines(self, show_reason=False):
+        """
+        Async twin of select_outlines.
+        """
+        candidates = await self.agenerate_candidates() if self.parallel else list(await self.agenerate_outlines())
+        selected = await asyncio.to_thread(self.local_select, candidates)
+        self._reason, self.chosen_outline = selected if selected is not None else await self.ajudge(candidates)
         if show_reason:
             return self._reason,self.chosen_outline
         else:
@@ -213,18 +469,39 @@ class PlainWritingAssistant:
             str: The selected story outline.
         """
         if mem_storage:
-            import json
             self.select_outlines(show_reason=True)
-            summarization = self.llm.invoke("here is an outline:{outline}, summerize it in up to 30 words.".format(outline = self.chosen_outline)).content
-            k_v = {
-                summarization.split("\n"): self.chosen_outline
-            }
-            with open(mem_storage, "w", encoding = 'UTF-8') as f:
-                json.dump(k_v, f,ensure_ascii=False, indent=2)
+            summarization = invoke_llm(self.llm, SUMMARY_PROMPT.format(outline = self.chosen_outline), node='generate_plain_story:summarize')
+            self.save_summary(mem_storage, summarization)
         else:
             self.chosen_outline = self.select_outlines()
         return self.chosen_outline
 
+    async def astep(self, mem_storage: Optional[str] = None):
+        """
+        Async twin of step, the summary file is written in a worker thread.
+        """
+        if mem_storage:
+            await self.aselect_outlines(show_reason=True)
+            summarization = await ainvoke_llm(self.llm, SUMMARY_PROMPT.format(outline = self.chosen_outline), node='generate_plain_story:summarize')
+            await asyncio.to_thread(self.save_summary, mem_storage, summarization)
+        else:
+            self.chosen_outline = await self.aselect_outlines()
+        return self.chosen_outline
+
+    def save_summary(self, mem_storage: str, summarization: str):
+        """
+        Store the summary and the selected outline.
+
+        Args:
+            mem_storage (str): The file path to store the summary and the selected outline.
+            summarization (str): Summary of the selected outline.
+        """
+        k_v = {
+            summarization.strip(): self.chosen_outline
+        }
+        with open(mem_storage, "w", encoding = 'UTF-8') as f:
+            json.dump(k_v, f,ensure_ascii=False, indent=2)
+
     def clear(self):
         """
         Reset the attributes generated during the process of generating and selecting story outlines to None.
@@ -233,9 +510,9 @@ class PlainWritingAssistant:
             PlainWritingAssistant: The current instance of the class.
         """
         # Define a list of attributes to be reset to None
-        attrs_to_clear = ['outline1' , 'outline2' , 'outline3' , 'chosen_outline' , '_reason']
-        # Iterate through the attribute list and use the setattr function to set the attribute values to None
-        if hasattr(self, 'outline1'):
-            for attr in attrs_to_clear:
+        attrs_to_clear = ['outline1' , 'outline2' , 'outline3' , 'outlines' , 'chosen_outline' , '_reason']
+        # Iterate through the attribute list and delete the ones set by the previous call
+        for attr in attrs_to_clear:
+            if hasattr(self, attr):
                 delattr(self, attr)
         return self
\ No newline at end of file
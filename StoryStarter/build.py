@@ -1,5 +1,6 @@
 from langgraph.constants import START , END
 from langgraph.graph import StateGraph
+from langchain_core.runnables import RunnableLambda
 import os
 
 from StoryState import StoryState
@@ -7,21 +8,23 @@ from StoryState import StoryState
 from StoryStarter.starter import *
 import warnings
 warnings.filterwarnings("ignore")
+# Nodes with an async twin run it under ainvoke / astream
+setting_node = RunnableLambda(setting_of_story, afunc=asetting_of_story, name="setting_of_story")
 little_graph = StateGraph(StoryState, output = StoryState)
-little_graph.add_node("setting_of_story", setting_of_story)
+little_graph.add_node("setting_of_story", setting_node)
 little_graph.add_edge(START, "setting_of_story")
 little_graph.add_node('clean_dict',clean_dict)
 little_graph.add_edge("clean_dict", "setting_of_story")
 little_graph.add_conditional_edges(
     'setting_of_story',
-    judge_if_similarity_higher_enough,
+    RunnableLambda(judge_if_similarity_higher_enough, afunc=ajudge_if_similarity_higher_enough),
     {True: END,
      False: 'clean_dict'}
 )
 
 Starter_subgraph = StateGraph(StoryState, output = StoryState)
-Starter_subgraph.add_node("setting_of_story", setting_of_story)
-Starter_subgraph.add_node("store_to_memory", store_to_memory)
+Starter_subgraph.add_node("setting_of_story", setting_node)
+Starter_subgraph.add_node("store_to_memory", RunnableLambda(store_to_memory, afunc=astore_to_memory, name="store_to_memory"))
 Starter_subgraph.add_node('little_graph', little_graph.compile())
 Starter_subgraph.add_node('check_keys', check_keys)
 Starter_subgraph.add_edge(START, 'check_keys')
@@ -1,9 +1,9 @@
 
 import sys
 import os
+import asyncio
 from typing import TypedDict , Dict
 
-from langchain_openai import ChatOpenAI
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -12,8 +12,9 @@ current_dir = os.getcwd()
 parent_dir = os.path.dirname(current_dir)
 # 将上一级目录添加到 sys.path 中
 sys.path.insert(0, parent_dir)
-from utils import get_content_between_a_b, set_env,get_similarity
-set_env()
+from utils import get_content_between_a_b, encode_paragraphs
+import settings
+from LLM import invoke_llm, ainvoke_llm, invoke_sections, ainvoke_sections, LLMCallError
 from StoryState import StoryState
 START_PRMPT='''
 You are a story creator, also a native speaker of {language}.
@@ -55,11 +56,14 @@ def get_main_goal(prompt):
     return get_content_between_a_b('## main goal:','## outline:',prompt)
 def get_outline(prompt):
     return get_content_between_a_b('## outline:','## END', prompt)
+SETTING_MARKERS = ['## main character:', '## main goal:', '## outline:']
+def order_settings(sections):
+    # Sections in SETTING_MARKERS order -> (main goal, main character, outline)
+    main_character , main_goal , outline = sections
+    return main_goal , main_character , outline
 
 
 
-from settings import UTIL_LLM
-llm = UTIL_LLM
 # Node
 
 def check_keys(state: dict):
@@ -80,58 +84,102 @@ def clean_dict(state: dict):
         "Topic": state["Topic"]
     }
 
+def setting_request(state:StoryState):
+    """
+    Prompt of the setting call: the whole setting from Language and Topic, or only the outline when the input
+    already names the main character and goal.
+    :param state: (StoryState) Input state.
+    :return: (tuple) Prompt and whether MainCharacter / MainGoal were given, or None for an input with a MainGoal only.
+    """
+    if state.get('MainCharacter') is not None:
+        return START_WITH_MAIN_PROMPT.format ( language=state['Language'] , topic=state['Topic'] ,
+                                               main_character=state['MainCharacter'] , main_goal=state.get ( 'MainGoal' ) ) , True
+    if state.get('MainGoal') is None:
+        return START_PRMPT.format ( language=state['Language'] , topic=state['Topic'] ) , False
+    return None
+
+def setting_result(state:StoryState, with_main:bool, response)-> StoryState:
+    """
+    State of the story once the setting call answered.
+    :param state: (StoryState) Input state.
+    :param with_main: (bool) Whether MainCharacter / MainGoal were given.
+    :param response: The outline, or (main goal, main character, outline).
+    :return: (StoryState) The story's first state.
+    """
+    if with_main:
+        state ['RecentStory'] =[response]
+        state['similarity'] = 0
+        state['StartSign'] = True
+        state['TotalStoryLength'] = 0
+        return state
+    main_goal , main_character , outline = response
+    return {
+        'Topic': state['Topic'] ,
+        'Language': state['Language'] ,
+        'MainGoal': main_goal ,
+        'MainCharacter': main_character ,
+        'RecentStory': [outline] ,
+        'StartSign': True ,
+        'similarity': 0,
+    }
+
+def setting_failed(state:StoryState, with_main:bool, error:Exception):
+    if with_main:
+        warnings.warn(f"Input error:\n"
+                      f"Your input can be Dict with keys: 'Language', 'Topic', 'MainGoal', 'MainCharacter'.\n"
+                      f"or Dict with keys:'Language', 'Topic'\n"
+                      f"But Your input is: {state}\n({error})")
+    else:
+        warnings.warn (
+            f"Error in StoryStarter: setting_of_story, please check your input.\nYour input is: {state}\n({error})" )
+    return None
+
 def setting_of_story(state:StoryState)-> StoryState:
     print("Setting up StoryStarterBeginning...")
-    def _set_story(state):
-        prompt = START_PRMPT.format ( language=state['Language'] , topic=state['Topic'] )
-        try:
-            response = llm.invoke ( prompt ).content
-            main_goal = get_main_goal ( response )
-            main_character = get_main_character ( response )
-            outline = get_outline ( response )
-            return {
-                'Topic': state['Topic'] ,
-                'Language': state['Language'] ,
-                'MainGoal': main_goal ,
-                'MainCharacter': main_character ,
-                'RecentStory': [outline] ,
-                'StartSign': True ,
-                'similarity': 0,
-            }
-        except:
-            warnings.warn (
-                f"Error in StoryStarter: setting_of_story, please check your input.\nYour input is: {state}" )
-            return None
-
-    if state.get('MainCharacter') is not None:
-        try:
-            MainGoal = state.get ( 'MainGoal' )
-            p = START_WITH_MAIN_PROMPT.format ( language=state['Language'] , topic=state['Topic'] ,main_character=state['MainCharacter'],main_goal=MainGoal)
-            response = llm.invoke ( p ).content
-            outline = get_outline ( response )
-            state ['RecentStory'] =[outline]
-            state['similarity'] = 0
-            state['StartSign'] = True
-            state['TotalStoryLength'] = 0
-            return state
-        except:
-            warnings.warn(f"Input error:\n"
-                          f"Your input can be Dict with keys: 'Language', 'Topic', 'MainGoal', 'MainCharacter'.\n"
-                          f"or Dict with keys:'Language', 'Topic'\n"
-                          f"But Your input is: {state}\n")
-            return None
-    if state.get('MainCharacter') is None and state.get('MainGoal') is None:
-        return _set_story(state)
+    request = setting_request ( state )
+    if request is None:
+        return None
+    prompt , with_main = request
+    try:
+        if with_main:
+            response = invoke_llm ( settings.get_llm('UTIL_LLM') , prompt , node='setting_of_story' , check=get_outline )
+        else:
+            # Missing sections are asked for again by invoke_sections, unparsable responses generated again
+            response = invoke_sections ( settings.get_llm('UTIL_LLM') , prompt , node='setting_of_story' ,
+                                         markers=SETTING_MARKERS , check=order_settings )
+    except (LLMCallError, ValueError) as e:
+        return setting_failed ( state , with_main , e )
+    return setting_result ( state , with_main , response )
+
+
+async def asetting_of_story(state:StoryState)-> StoryState:
+    """
+    Async twin of setting_of_story.
+    """
+    print("Setting up StoryStarterBeginning...")
+    request = setting_request ( state )
+    if request is None:
+        return None
+    prompt , with_main = request
+    try:
+        if with_main:
+            response = await ainvoke_llm ( settings.get_llm('UTIL_LLM') , prompt , node='setting_of_story' , check=get_outline )
+        else:
+            response = await ainvoke_sections ( settings.get_llm('UTIL_LLM') , prompt , node='setting_of_story' ,
+                                                markers=SETTING_MARKERS , check=order_settings )
+    except (LLMCallError, ValueError) as e:
+        return setting_failed ( state , with_main , e )
+    return setting_result ( state , with_main , response )
 
 
 def judge_if_similarity_higher_enough(state:StoryState) -> bool:
     try:
-        similarity_beginning = get_similarity (
-                [state['MainCharacter'] , state['MainGoal']]
-            )[1]
-        similarity_topic = get_similarity (
-                [state['Topic'] , state['MainGoal']]
-            )[1]
+        # One batched encode for all three settings, MainGoal is shared by both scores
+        character, goal, topic = encode_paragraphs (
+                [state['MainCharacter'] , state['MainGoal'] , state['Topic']]
+            )
+        similarity_beginning = float ( character @ goal )
+        similarity_topic = float ( topic @ goal )
         if state['Language'].lower() == 'english':
             if similarity_beginning > 0.65 and similarity_topic > 0.15:
                 return True
@@ -150,15 +198,43 @@ def judge_if_similarity_higher_enough(state:StoryState) -> bool:
         return False
 
 from memory_storage.MemoryStore import MemoryStore
+from memory_storage.MemoryWriter import memory_writer
+from Embedding import reset_story_index
+def first_memory(memory_store:MemoryStore):
+    memory_store.first_store()
+    memory_store.write_down_memory()
+
 def store_to_memory(state:StoryState) -> StoryState:
+    # A new story starts, earlier outlines must not count against its novelty
+    reset_story_index()
     memory_store = MemoryStore(state)
-    memory_store.first_store()
     memory_store.write_down_settings()
-    memory_store.write_down_memory()
+    if settings.MEMORY_BACKGROUND:
+        # The first plain round only needs the outline, the memory is written meanwhile
+        memory_writer().submit(lambda: first_memory(memory_store))
+    else:
+        first_memory(memory_store)
     return {
         **state,  # 保留原状态中的所有键值对
     }
 
+async def ajudge_if_similarity_higher_enough(state:StoryState) -> bool:
+    # The embedding model runs in a worker thread, so the event loop keeps serving other stories
+    return await asyncio.to_thread ( judge_if_similarity_higher_enough , state )
+
+async def astore_to_memory(state:StoryState) -> StoryState:
+    reset_story_index()
+    memory_store = MemoryStore(state)
+    await memory_store.awrite_down_settings()
+    if settings.MEMORY_BACKGROUND:
+        await memory_writer().asubmit(lambda: first_memory(memory_store))
+    else:
+        await memory_store.afirst_store()
+        await memory_store.awrite_down_memory()
+    return {
+        **state,
+    }
+
 def judge_if_set_Main_by_user(state:StoryState) -> bool:
     if state.get('MainCharacter') is None and state.get('MainGoal') is None:
         return False
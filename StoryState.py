@@ -1,4 +1,4 @@
-from typing import List , TypedDict
+from typing import List , Optional , TypedDict
 
 
 
@@ -9,5 +9,7 @@ class StoryState(TypedDict, total=False):
     RecentStory: List[str]
     Language: str
     Topic: str
-    similarity: float
+    similarity: Optional[float]  # None when the similarity cascade's lexical tier decided
+    HistorySimilarity: float
+    LexicalSimilarity: float
     TotalStoryLength: int
\ No newline at end of file
@@ -8,8 +8,6 @@
 import os,sys
 # Import type hints for type checking
 from typing import TypedDict , List
-# Import ChatOpenAI from langchain_openai for language model interactions
-from langchain_openai import ChatOpenAI
 # Import StoryState class for managing story-related states
 from StoryState import StoryState
 
@@ -17,15 +15,16 @@ from StoryState import StoryState
 import warnings
 
 # Import functions for twist processing and abstract extraction
-from TwistGenerator.SimilaityCalculate import process_twist,get_abstract
-# Import the utility language model from settings
-from settings import UTIL_LLM
+from TwistGenerator.SimilaityCalculate import process_twist,get_abstract,aprocess_twist,aget_abstract
+# Import settings, the utility language model is read from it when a node runs
+import settings
+from LLM import speculator
 
 # Suppress all warnings
 warnings.filterwarnings("ignore")
-# Import utility functions and set environment variables
-from utils import get_content_between_a_b,set_env
-set_env()
+# Import utility functions
+from utils import get_content_between_a_b
+from Embedding import embed_outlines
 
 # Add the parent directory to the system path to allow module imports
 # Get the current working directory
@@ -49,11 +48,57 @@ class TwistKG(TypedDict, total=False):
     Language: str  # Language used in the story
     Topic: str  # Topic of the story
     similarity: float  # Similarity value
+    HistorySimilarity: float  # Highest similarity to any earlier outline
     OriginalKG: str  # Original knowledge graph of the story
     TotalStoryLength: int  # Total length of the story
 
+def twist_likely(state: StoryState) -> bool:
+    """
+    Guesses, before the graph scores the round, whether the next round will be a twist: this round's similarity
+    (RecentStory[0] against the outline the Expander just updated, RecentStory[-1]) and, with settings.TWIST_ON_HISTORY,
+    the previous round's 'HistorySimilarity' are close to the threshold. The state's 'similarity' cannot be used,
+    plain_state resets it every plain round.
+
+    Args:
+        state (StoryState): The story state once the Expander updated the outline.
+
+    Returns:
+        bool: True when the similarity is within settings.SPECULATION_MARGIN of settings.SIMILARITY_THRESHOLD or above.
+    """
+    recent_story = state.get('RecentStory', [])
+    if len(recent_story) >= 2:
+        # The pair calculate_similarity will score after the Expander
+        emb1, emb2 = embed_outlines(recent_story[0], recent_story[-1])
+        similarity = float(emb1 @ emb2)
+    else:
+        similarity = state.get('similarity') or 0
+    if settings.TWIST_ON_HISTORY:
+        similarity = max(similarity, state.get('HistorySimilarity', 0))
+    return similarity >= settings.SIMILARITY_THRESHOLD - settings.SPECULATION_MARGIN
+
+def speculate_twist(state: StoryState):
+    """
+    With settings.SPECULATE_TWIST, start extracting the KG of the round's final outline in the background when a twist
+    is likely, so a twist round finds it done; catch_nodes_of_original_story takes it, a plain round discards it.
+
+    Args:
+        state (StoryState): The story state once the Expander updated the outline (RecentStory[-1]).
+    """
+    if not settings.SPECULATE_TWIST or not twist_likely(state):
+        return
+    outline, language = state["RecentStory"][-1], state["Language"]
+    speculator().start('twist', (outline, language), lambda: get_abstract(outline, language),
+                       lambda: aget_abstract(outline, language))
+
+def discard_twist_speculation():
+    """
+    The round did not go to the twist branch: cancel the speculative KG extraction, or drop its result.
+    """
+    if settings.SPECULATE_TWIST:
+        speculator().discard('twist')
+
 # Function to catch nodes of the original story
-def catch_nodes_of_original_story(state: StoryState,llm=UTIL_LLM) -> TwistKG:
+def catch_nodes_of_original_story(state: StoryState,llm=None) -> TwistKG:
     print("Setting up TwistWritingAssistant...")
     print("Start to catch KG nodes in generated outline...")
     """
@@ -61,29 +106,39 @@ def catch_nodes_of_original_story(state: StoryState,llm=UTIL_LLM) -> TwistKG:
 
     Args:
         state (StoryState): A state object containing story information.
-        llm (ChatOpenAI): The language model used to generate the knowledge graph, defaulting to gpt-3.5-turbo.
+        llm (ChatOpenAI): The language model used to generate the knowledge graph, defaulting to settings.UTIL_LLM.
 
     Returns:
         TwistKG: Knowledge graph information including the original knowledge graph.
     """
-    # Number of attempts
-    trying = 0
-    # Flag to control the loop
-    button = True
-    while (trying < 4
-           and button):
-        try:
-            # Get the abstract of the last recent story
-            KG = get_abstract(state["RecentStory"][-1], state["Language"], llm=llm)
-            # Set the flag to False to exit the loop
-            button = False
-        except:
-            # Increment the number of attempts if an exception occurs
-            trying += 1
-    if trying == 4:
-        print("Failed to catch nodes of original story.")
-        # Exit the program if all attempts fail
-        sys.exit()
+    found = False
+    if llm is None and settings.SPECULATE_TWIST:
+        # Extracted during the Expander when the twist was foreseen
+        found, KG = speculator().take('twist', (state["RecentStory"][-1], state["Language"]))
+    if not found:
+        if llm is None:
+            llm = settings.get_llm('UTIL_LLM')
+        # Get the abstract of the last recent story; retries and backoff are handled by LLM.invoke_llm,
+        # which raises LLMCallError when it gives up
+        KG = get_abstract(state["RecentStory"][-1], state["Language"], llm=llm)
+    return {
+        **state,
+        "OriginalKG": KG
+    }
+
+async def acatch_nodes_of_original_story(state: StoryState,llm=None) -> TwistKG:
+    """
+    Async twin of catch_nodes_of_original_story.
+    """
+    print("Setting up TwistWritingAssistant...")
+    print("Start to catch KG nodes in generated outline...")
+    found = False
+    if llm is None and settings.SPECULATE_TWIST:
+        found, KG = await speculator().atake('twist', (state["RecentStory"][-1], state["Language"]))
+    if not found:
+        if llm is None:
+            llm = settings.get_llm('UTIL_LLM')
+        KG = await aget_abstract(state["RecentStory"][-1], state["Language"], llm=llm)
     return {
         **state,
         "OriginalKG": KG
@@ -102,6 +157,26 @@ def generate_twist_for_outline(state:TwistKG) -> StoryState:
     """
     # Generate the twist outline
     outline = process_twist(state["Language"], state["Topic"], state["OriginalKG"])
+    return twist_state(state, outline)
+
+async def agenerate_twist_for_outline(state:TwistKG) -> StoryState:
+    """
+    Async twin of generate_twist_for_outline.
+    """
+    outline = await aprocess_twist(state["Language"], state["Topic"], state["OriginalKG"])
+    return twist_state(state, outline)
+
+def twist_state(state:TwistKG, outline:str) -> StoryState:
+    """
+    Builds the story state after a twist outline was generated.
+
+    Args:
+        state (TwistKG): An object containing knowledge graph information related to story twists.
+        outline (str): The generated twist outline.
+
+    Returns:
+        StoryState: An updated story state object.
+    """
     print("Generating key twist nodes in generated outline...")
     if len(outline)>51:
         print('Outline in generated twist outline:',outline[:50],'...(etc.)')
@@ -6,13 +6,13 @@
 '''
 
 import os,sys,json
-from langchain_openai import ChatOpenAI
 from typing import List, Dict, Any, TypedDict, Optional
 import warnings
 warnings.filterwarnings("ignore")
-from utils import get_content_between_a_b,set_env
-set_env()
-from settings import UTIL_LLM
+from utils import get_content_between_a_b
+import settings
+from LLM import invoke_llm, ainvoke_llm
+from LLM.OutputParser import parse_kg
 # 将上一级目录添加到 sys.path 中
 current_dir = os.getcwd()
 parent_dir = os.path.dirname(current_dir)
@@ -62,41 +62,70 @@ Output your result in the following format, don't change the format, English, su
 ## END
 """
 
-def generate_twist(language: str, topic: str, KG:str, length = 500, llm = ChatOpenAI(model="gpt-3.5-turbo",temperature=0.8)) -> str:
+def twist_llm():
+    return settings.get_llm('TWIST_LLM')
+def generate_twist(language: str, topic: str, KG:str, length = 500, llm = None, check = None) -> str:
+    if llm is None:
+        llm = twist_llm()
     prompt_generate = GENERATE_TWIST_PRMPT.format(language=language, KG=KG, topic=topic,length=length)
-    story = llm.invoke(prompt_generate).content
+    story = invoke_llm(llm, prompt_generate, node='generate_twist_for_outline', check=check)
     return story
+async def agenerate_twist(language: str, topic: str, KG:str, length = 500, llm = None, check = None) -> str:
+    if llm is None:
+        llm = twist_llm()
+    prompt_generate = GENERATE_TWIST_PRMPT.format(language=language, KG=KG, topic=topic,length=length)
+    return await ainvoke_llm(llm, prompt_generate, node='generate_twist_for_outline', check=check)
 def parser(story: str) -> (str, json):
     outline = get_content_between_a_b("## outline:", "## END",story)
     return outline
-def process_twist(language: str, topic: str, KG:str, length = 500, llm = UTIL_LLM)-> (str, json):
+def process_twist(language: str, topic: str, KG:str, length = 500, llm = None)-> (str, json):
     '''
     generate a twist of the story
     :param language: str, the language of the story
     :param topic: str, the topic of the story
     :param KG: str, the knowledge graph of outline
     :param length: int, minium length of generated outline
-    :param llm: model
+    :param llm: model (default: settings.UTIL_LLM)
     :return: (generated outline: str,
             KG: json)
+    :raises LLMCallError: when no parsable twist could be generated.
+    '''
+    if llm is None:
+        llm = settings.get_llm('UTIL_LLM')
+    return generate_twist(language, topic, KG, length, llm, check=parser)
+async def aprocess_twist(language: str, topic: str, KG:str, length = 500, llm = None)-> (str, json):
     '''
-    button = True
-    trying = 0
-    while button and trying < 4:
-        try:
-            p = parser(generate_twist(language, topic,KG,length, llm))
-            button = False
-        except:
-            trying += 1
-    if trying == 4:
-        print("Failed to generate twist.")
-        sys.exit()
-    return p
+    async twin of process_twist
+    '''
+    if llm is None:
+        llm = settings.get_llm('UTIL_LLM')
+    return await agenerate_twist(language, topic, KG, length, llm, check=parser)
 
-def get_abstract(last_story: str, language: str,llm=UTIL_LLM) -> Optional[str]:
+def get_abstract(last_story: str, language: str,llm=None) -> Optional[str]:
+    if llm is None:
+        llm = settings.get_llm('UTIL_LLM')
     prompt = IMPORTANT_PROMPT.format(last_story=last_story, language=language)
-    story_abstract = llm.invoke(prompt).content
-    abstract = get_content_between_a_b("## abstraction:", "## END",story_abstract)
-    story_KG = llm.invoke(ABSTRACT_PROMPT.format(abstract=abstract, language=language)).content
-    KG = get_content_between_a_b("## KG:", "## END",story_KG)
-    return KG
\ No newline at end of file
+    abstract = invoke_llm(llm, prompt, node='catch_nodes_of_original_story', check=parser_abstract)
+    KG = invoke_llm(llm, ABSTRACT_PROMPT.format(abstract=abstract, language=language), node='catch_nodes_of_original_story',
+                    check=parser_KG)
+    return KG
+
+async def aget_abstract(last_story: str, language: str,llm=None) -> Optional[str]:
+    if llm is None:
+        llm = settings.get_llm('UTIL_LLM')
+    prompt = IMPORTANT_PROMPT.format(last_story=last_story, language=language)
+    abstract = await ainvoke_llm(llm, prompt, node='catch_nodes_of_original_story', check=parser_abstract)
+    return await ainvoke_llm(llm, ABSTRACT_PROMPT.format(abstract=abstract, language=language), node='catch_nodes_of_original_story',
+                             check=parser_KG)
+
+def parser_abstract(story_abstract: str) -> str:
+    return get_content_between_a_b("## abstraction:", "## END", story_abstract)
+
+def parser_KG(story_KG: str) -> str:
+    """
+    :param story_KG: (str) Response to ABSTRACT_PROMPT.
+    :return: (str) Its knowledge graph, repaired and validated (see LLM.OutputParser.parse_kg), as JSON.
+    :raises ValueError: when there is no usable knowledge graph, so that the call is retried.
+    """
+    KG = parse_kg(get_content_between_a_b("## KG:", "## END", story_KG))
+    return json.dumps(KG, ensure_ascii=False, indent=2)
\ No newline at end of file
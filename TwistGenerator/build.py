@@ -15,14 +15,15 @@ current_dir = os.getcwd()
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
-from TwistGenerator.KnowledgeGraphProcess import catch_nodes_of_original_story , generate_twist_for_outline
+from TwistGenerator.KnowledgeGraphProcess import catch_nodes_of_original_story , generate_twist_for_outline, \
+    acatch_nodes_of_original_story, agenerate_twist_for_outline, TwistKG
+from langchain_core.runnables import RunnableLambda
 
 warnings.filterwarnings("ignore")
-from utils import set_env
-set_env()
-Twist_subgraph = StateGraph(StoryState,output = StoryState)
-Twist_subgraph.add_node('catch_nodes_of_original_story',catch_nodes_of_original_story)
-Twist_subgraph.add_node('generate_twist_for_outline',generate_twist_for_outline)
+# TwistKG carries OriginalKG from one node to the next, only the StoryState keys leave the subgraph
+Twist_subgraph = StateGraph(TwistKG,output = StoryState)
+Twist_subgraph.add_node('catch_nodes_of_original_story',RunnableLambda(catch_nodes_of_original_story, afunc=acatch_nodes_of_original_story, name='catch_nodes_of_original_story'))
+Twist_subgraph.add_node('generate_twist_for_outline',RunnableLambda(generate_twist_for_outline, afunc=agenerate_twist_for_outline, name='generate_twist_for_outline'))
 Twist_subgraph.add_edge(START, 'catch_nodes_of_original_story')
 Twist_subgraph.add_edge('catch_nodes_of_original_story', 'generate_twist_for_outline')
 Twist_subgraph.add_edge('generate_twist_for_outline', END)
\ No newline at end of file
@@ -0,0 +1,248 @@
+'''
+-- @Time    : 2025/7/28 16:20
+-- @File    : batch.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+"""
+Generate many stories from a JSONL job file, several at a time.
+Each line is one initial state ({"Language", "Topic", "MainCharacter", "MainGoal"}, optionally under "state"),
+with an optional "id" (or "job_id" / "request_id") naming its output directory.
+A line that cannot be read as a job is recorded as failed in the summary and the other jobs still run.
+Every job writes result.json and memory_storage/ into <out>/<id>/, and one line per finished job
+(status, seconds, length or error) is appended to the summary as soon as it finishes.
+run in bash: python batch.py jobs.jsonl --out batch_output --workers 4
+             python batch.py jobs.jsonl --out batch_output --async --concurrency 16
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+STATE_KEYS = ('Language', 'Topic', 'MainCharacter', 'MainGoal')
+ID_KEYS = ('id', 'job_id', 'request_id')
+
+
+def load_jobs(path: str) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Read the job file. A line that is not valid JSON or not a valid job does not stop the others.
+
+    :param path: (str) JSONL file, one initial state per line; blank lines are skipped.
+    :return: (Tuple) Jobs as {'id': str, 'state': dict}, ids made unique and safe as directory names,
+        and a summary record with status 'error' per invalid line.
+    """
+    jobs, invalid, seen = [], [], set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job_id = f"job-{number:04d}"
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("a job must be a JSON object")
+                job_id = next((str(record[key]) for key in ID_KEYS if record.get(key) is not None), job_id)
+                source = record.get('state', record)
+                if not isinstance(source, dict):
+                    raise ValueError("'state' must be a JSON object")
+                state = {key: source[key] for key in STATE_KEYS if source.get(key) is not None}
+                state.setdefault('Language', 'English')
+                if 'Topic' not in state:
+                    raise ValueError("a job needs at least a 'Topic'")
+            except ValueError as e:  # json.JSONDecodeError is a ValueError
+                print(f"{path}:{number}: skipped, {e}")
+                invalid.append({'id': re.sub(r'[^\w.-]+', '_', job_id), 'status': 'error', 'output_dir': None, 'seconds': 0.,
+                                'error': f"{path}:{number}: {type(e).__name__}: {e}"})
+                continue
+            job_id = re.sub(r'[^\w.-]+', '_', job_id)
+            while job_id in seen:
+                job_id += '_'
+            seen.add(job_id)
+            jobs.append({'id': job_id, 'state': state})
+    return jobs, invalid
+
+
+def finished_jobs(summary_path: str) -> set:
+    """
+    :param summary_path: (str) Summary JSONL of an earlier run.
+    :return: (set) Ids of the jobs that finished successfully there.
+    """
+    if not os.path.exists(summary_path):
+        return set()
+    with open(summary_path, 'r', encoding='utf-8') as f:
+        return {record['id'] for record in map(json.loads, filter(str.strip, f)) if record.get('status') == 'ok'}
+
+
+class Summary:
+    def __init__(self, path: str):
+        """
+        Append-only JSONL summary, one line per finished job, written as jobs finish.
+
+        :param path: (str) Summary file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.counts = {'ok': 0, 'error': 0}
+
+    def add(self, record: Dict):
+        with self._lock:
+            self.counts[record['status']] += 1
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        print(f"[{record['id']}] {record['status']} in {record['seconds']:.0f}s "
+              f"({self.counts['ok']} ok, {self.counts['error']} failed so far)")
+
+
+def prepare(job: Dict, out_dir: str) -> str:
+    job_dir = os.path.abspath(os.path.join(out_dir, job['id']))
+    os.makedirs(os.path.join(job_dir, 'memory_storage'), exist_ok=True)
+    return job_dir
+
+
+def record(job: Dict, job_dir: str, start: float, result: Optional[Dict] = None,
+           error: Optional[BaseException] = None) -> Dict:
+    entry = {'id': job['id'], 'status': 'ok' if error is None else 'error', 'output_dir': job_dir,
+             'seconds': round(time.time() - start, 1)}
+    if error is None:
+        entry['length'] = result.get('TotalStoryLength')
+    else:
+        entry['error'] = f"{type(error).__name__}: {error}"
+        entry['traceback'] = ''.join(traceback.format_exception(error))[-2000:]
+    return entry
+
+
+def flush_job_memory(job: Dict):
+    """
+    Wait for the job's pending background memory writes, which End only waits for when the story gets there.
+    A failed write is reported, not raised, so it does not hide the job's own result or error.
+
+    :param job: (Dict) Job from load_jobs, run in the current output directory.
+    """
+    from memory_storage.MemoryWriter import flush_memory
+    try:
+        flush_memory()
+    except Exception as e:
+        print(f"[{job['id']}] a background memory write failed: {type(e).__name__}: {e}")
+
+
+async def aflush_job_memory(job: Dict):
+    """
+    Async twin of flush_job_memory.
+    """
+    import asyncio
+    await asyncio.to_thread(flush_job_memory, job)
+
+
+def run_job(graph, job: Dict, out_dir: str, config: Dict) -> Dict:
+    """
+    Run one story synchronously in its own output directory.
+
+    :param graph: (CompiledGraph) The story graph.
+    :param job: (Dict) Job from load_jobs.
+    :param out_dir: (str) Parent output directory.
+    :param config: (Dict) Graph config.
+    :return: (Dict) Summary record.
+    """
+    import settings
+    job_dir, start = prepare(job, out_dir), time.time()
+    token = settings.OUTPUT_DIR.set(job_dir)
+    try:
+        return record(job, job_dir, start, result=graph.invoke(dict(job['state']), config=config))
+    except Exception as e:
+        return record(job, job_dir, start, error=e)
+    finally:
+        flush_job_memory(job)
+        settings.OUTPUT_DIR.reset(token)
+
+
+async def arun_job(graph, job: Dict, out_dir: str, config: Dict) -> Dict:
+    """
+    Async twin of run_job, the story runs with ainvoke on the shared event loop.
+    """
+    import settings
+    job_dir, start = prepare(job, out_dir), time.time()
+    # Each task has its own copy of the context, so the output directory stays with this job
+    settings.OUTPUT_DIR.set(job_dir)
+    try:
+        return record(job, job_dir, start, result=await graph.ainvoke(dict(job['state']), config=config))
+    except Exception as e:
+        return record(job, job_dir, start, error=e)
+    finally:
+        await aflush_job_memory(job)
+
+
+def run_threads(graph, jobs: List[Dict], out_dir: str, summary: Summary, workers: int, config: Dict):
+    """
+    Run the jobs in a pool of worker threads, at most `workers` stories at a time.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='story') as pool:
+        for future in [pool.submit(run_job, graph, job, out_dir, config) for job in jobs]:
+            future.add_done_callback(lambda f: summary.add(f.result()))
+
+
+async def run_async(graph, jobs: List[Dict], out_dir: str, summary: Summary, concurrency: int, config: Dict):
+    """
+    Run the jobs on one event loop, at most `concurrency` stories at a time.
+    """
+    import asyncio
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(job):
+        async with semaphore:
+            summary.add(await arun_job(graph, job, out_dir, config))
+
+    await asyncio.gather(*(one(job) for job in jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate stories from a JSONL job file")
+    parser.add_argument('jobs', help="JSONL file, one initial state per line")
+    parser.add_argument('--out', default='batch_output', help="Parent directory of the per-job output directories")
+    parser.add_argument('--summary', default=None, help="Summary JSONL (default: <out>/summary.jsonl)")
+    parser.add_argument('--workers', type=int, default=4, help="Stories generated at once in worker threads")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="Run the stories on one event loop instead")
+    parser.add_argument('--concurrency', type=int, default=8, help="Stories generated at once with --async")
+    parser.add_argument('--resume', action='store_true', help="Skip the jobs already finished in the summary")
+    parser.add_argument('--recursion-limit', type=int, default=100)
+    args = parser.parse_args()
+
+    jobs, invalid = load_jobs(args.jobs)
+    os.makedirs(args.out, exist_ok=True)
+    summary_path = args.summary or os.path.join(args.out, 'summary.jsonl')
+    if args.resume:
+        done = finished_jobs(summary_path)
+        jobs = [job for job in jobs if job['id'] not in done]
+        print(f"Resuming: {len(done)} jobs already finished.")
+    summary = Summary(summary_path)
+    for entry in invalid:
+        summary.add(entry)
+
+    from utils import set_env
+    set_env()
+    from MainGraph import main_graph
+    from LLM import get_invoker, speculator
+
+    config = {"recursion_limit": args.recursion_limit}
+    start = time.time()
+    print(f"Running {len(jobs)} stories, {args.concurrency if args.use_async else args.workers} at a time...")
+    try:
+        if args.use_async:
+            import asyncio
+            asyncio.run(run_async(main_graph, jobs, args.out, summary, args.concurrency, config))
+        else:
+            run_threads(main_graph, jobs, args.out, summary, args.workers, config)
+    finally:
+        elapsed = time.time() - start
+        print(f"{summary.counts['ok']} stories done, {summary.counts['error']} failed in {elapsed:.0f}s "
+              f"({summary.counts['ok'] / max(elapsed, 1e-9) * 3600:.1f} stories/hour). Summary: {summary_path}")
+        get_invoker().print_report()
+        speculator().print_report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+-- @Time    : 2025/7/22 09:40
+-- @File    : import_budget.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+"""
+Measure import time of the entry points against settings.IMPORT_BUDGET_MS.
+Each target runs in a fresh interpreter with `python -X importtime`, the report lists the slowest packages.
+run in bash: python import_budget.py [--top 15]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from settings import IMPORT_BUDGET_MS
+
+# target name -> interpreter arguments
+TARGETS = {
+    'main.py --help': ['main.py', '--help'],
+    'graph compilation': ['-c', 'import MainGraph'],
+}
+_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)')
+
+
+def measure(argv: List[str]) -> Tuple[float, List[Tuple[str, int, float, float]]]:
+    """
+    Run one target in a fresh interpreter and collect its import tree.
+
+    :param argv: (List[str]) Arguments passed to the interpreter after `-X importtime`.
+    :return: (Tuple) Wall time in ms, and (module, depth, self ms, cumulative ms) for every import in load order.
+    """
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv, capture_output=True, text=True, env=env,
+                          stdin=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(argv)} exited with {proc.returncode}:\n{proc.stderr[-2000:]}")
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            modules.append((name, (len(indent) - 1) // 2, int(own) / 1000, int(cumulative) / 1000))
+    return wall_ms, modules
+
+
+def per_package(modules: List[Tuple[str, int, float, float]]) -> Dict[str, float]:
+    """
+    Import time of every top-level package, as the sum of the self time of its modules,
+    so a package is charged for its own modules no matter who imported it first.
+
+    :param modules: (List) Output of measure.
+    :return: (Dict[str, float]) Package name -> ms.
+    """
+    totals = {}
+    for name, _, own, _ in modules:
+        package = name.split('.')[0]
+        totals[package] = totals.get(package, 0.0) + own
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import-time budget of the entry points')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest packages to list per target')
+    args = parser.parse_args()
+    over_budget = False
+    for target, argv in TARGETS.items():
+        wall_ms, modules = measure(argv)
+        import_ms = sum(cumulative for _, depth, _, cumulative in modules if depth == 0)
+        budget = IMPORT_BUDGET_MS.get(target)
+        status = 'ok' if budget is None or import_ms <= budget else 'OVER BUDGET'
+        over_budget = over_budget or status != 'ok'
+        print(f"{target}: imports {import_ms:.0f} ms (budget {budget} ms), wall {wall_ms:.0f} ms  [{status}]")
+        for package, ms in sorted(per_package(modules).items(), key=lambda item: -item[1])[:args.top]:
+            print(f"    {ms:9.1f} ms  {package}")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
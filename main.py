@@ -5,12 +5,9 @@
 -- @IDE     : PyCharm
 '''
 import argparse
+import os
 
-
-from utils import set_env
-set_env()
-
-from MainGraph import main_graph
+# Parse arguments before importing the graph, so `python main.py --help` stays cheap
 parser = argparse.ArgumentParser(
         description='story writing')
 parser.add_argument("--OPENAI_API_KEY", type=str, default="")
@@ -20,9 +17,19 @@ parser.add_argument("--SIMILARITY_THRESHOLD", type=float, default=0.8)
 parser.add_argument("--TOPIC", type=str, default="love-fiction in high school")
 parser.add_argument("--MAIN_GOAL", type=str, default="Mika wants to find the meaning of love and get in love with Ellen forever")
 parser.add_argument("--LANGUAGE", type=str, default="English")
+parser.add_argument("--ASYNC", action="store_true", help="run the graph with ainvoke on an event loop")
 
 args = parser.parse_args()
 
+# Keys given on the command line take precedence, set_env only asks for the missing ones
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY"):
+    if getattr(args, key):
+        os.environ[key] = getattr(args, key)
+from utils import set_env
+set_env()
+
+from MainGraph import main_graph
+from LLM import get_invoker, speculator
 
 initial_state = {
     "Language": args.LANGUAGE,
@@ -31,4 +38,19 @@ initial_state = {
     "MainGoal": args.MAIN_GOAL
 }
 
-result = main_graph.invoke(initial_state,config={"recursion_limit": 100})
\ No newline at end of file
+try:
+    if args.ASYNC:
+        import asyncio
+        result = asyncio.run(main_graph.ainvoke(initial_state,config={"recursion_limit": 100}))
+    else:
+        result = main_graph.invoke(initial_state,config={"recursion_limit": 100})
+finally:
+    # With MEMORY_BACKGROUND, writes still queued when the graph fails before End would be lost with the worker thread
+    from memory_storage.MemoryWriter import flush_memory
+    try:
+        flush_memory()
+    except Exception as e:
+        print(f"A background memory write failed: {type(e).__name__}: {e}")
+    # latency and retry counters of every node's LLM calls
+    get_invoker().print_report()
+    speculator().print_report()
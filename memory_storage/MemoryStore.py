@@ -6,23 +6,20 @@
 '''
 
 import os, json,sys
+import asyncio
 
-from langchain.prompts import (
+from langchain_core.prompts import (
     ChatPromptTemplate,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
 )
-from langchain_openai import ChatOpenAI
 current_dir = os.getcwd()
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
-from utils import get_content_between_a_b,set_env
-
-
-from utils import set_env
+from utils import get_content_between_a_b
 from StoryState import StoryState
-from settings import STORY_SETTING_PATH, MEMORY_STORAGE_PATH
-set_env()
+import settings
+from LLM import invoke_llm, ainvoke_llm, LLMCallError, prompt_budget
 import warnings
 SYS_MEMORY_PROMPT = """
 You're a good storage bot for saving story outlines.You're a native {language} speaker. You're good at summary stories and save them in logical order. You got a story outline summarization job, the settings of the story are as follows:
@@ -60,116 +57,169 @@ def memory_parser(str)->str:
     """
     return get_content_between_a_b('## new memory added:','## END',str)
 
-from settings import UTIL_LLM
-llm = UTIL_LLM
-
-
 class MemoryStore:
-    def __init__(self, state:StoryState, llm = llm):
+    def __init__(self, state:StoryState, llm = None):
         """
         Initializes the MemoryStore instance.
         :param state: The StoryState object containing story metadata and recent story content.
-        :param llm: The language model instance (default is ChatOpenAI with gpt-3.5-turbo).
+        :param llm: The language model instance (default is settings.UTIL_LLM, gpt-3.5-turbo).
         """
         self.state = state
-        self.llm = llm
+        self.llm = llm if llm is not None else settings.get_llm('UTIL_LLM')
         self.memory_store = None
 
     def __call__(self):
         return self.memory_store
 
+    def first_prompt(self, first_outline:str = None)->str:
+        """
+        Formats the prompt saving the first outline of the story.
+        :param first_outline: The first outline fitted to its token budget (default: the first one of the state).
+        :return: The rendered prompt.
+        """
+        system_message_prompt = SystemMessagePromptTemplate.from_template ( SYS_MEMORY_PROMPT )
+        human_message = HumanMessagePromptTemplate.from_template ( BEGINNING_SYS_MEMORY_PROMPT )
+        prompt_setting = ChatPromptTemplate.from_messages ( [system_message_prompt , human_message] )
+        return prompt_setting.format (
+            topic=self.state['Topic'] ,
+            main_character=self.state['MainCharacter'] ,
+            main_goal=self.state['MainGoal'] ,
+            language=self.state['Language'] ,
+            first_outline=first_outline if first_outline is not None else self.state["RecentStory"][0]
+        )
+
+    def normal_prompt(self, memory_storage:str, new_outline:str = None)->str:
+        """
+        Formats the prompt adding the newest outline to the existing memory.
+        :param memory_storage: The memory saved so far.
+        :param new_outline: The newest outline fitted to its token budget (default: the last one of the state).
+        :return: The rendered prompt.
+        """
+        system_message_prompt = SystemMessagePromptTemplate.from_template(SYS_MEMORY_PROMPT)
+        human_message = HumanMessagePromptTemplate.from_template(WRITE_MEMORY_PROMPT)
+        prompt_setting = ChatPromptTemplate.from_messages ( [system_message_prompt , human_message] )
+        return prompt_setting.format (
+            topic = self.state['Topic'],
+            main_character = self.state['MainCharacter'],
+            main_goal = self.state['MainGoal'],
+            language = self.state['Language'],
+            new_outline = new_outline if new_outline is not None else self.state["RecentStory"][-1],
+            memory_storage = memory_storage
+        )
+
     def first_store(self):
         """
         Stores the first outline of the story into memory using the language model.
         Initializes the memory_store attribute with the parsed response.
+        :raises LLMCallError: when no memory could be generated.
         """
+        print(f"Generating memory...")
+        fields = prompt_budget ( 'store_to_memory' , self.llm ).fit ( first_outline=self.state["RecentStory"][0] )
         try:
-            print(f"Generating memory...")
-            system_message_prompt = SystemMessagePromptTemplate.from_template ( SYS_MEMORY_PROMPT )
-            human_message = HumanMessagePromptTemplate.from_template ( BEGINNING_SYS_MEMORY_PROMPT+BEGINNING_SYS_MEMORY_PROMPT )
-            prompt_setting = ChatPromptTemplate.from_messages ( [system_message_prompt , human_message] )
-            init_prompt = prompt_setting.format (
-                topic=self.state['Topic'] ,
-                main_character=self.state['MainCharacter'] ,
-                main_goal=self.state['MainGoal'] ,
-                language=self.state['Language'] ,
-                first_outline=self.state["RecentStory"][0]
-            )
-            response = self.llm.invoke ( [init_prompt] ).content
-            memory = memory_parser(response)
-            self.memory_store = memory
-        except:
+            self.memory_store = invoke_llm ( self.llm , [self.first_prompt(**fields)] , node='store_to_memory' , check=memory_parser )
+        except LLMCallError:
             warnings.warn(f"Memory store could not be created.")
-            sys.exit()
+            raise
 
+    async def afirst_store(self):
+        """
+        Async twin of first_store.
+        :raises LLMCallError: when no memory could be generated.
+        """
+        print(f"Generating memory...")
+        fields = await prompt_budget ( 'store_to_memory' , self.llm ).afit ( first_outline=self.state["RecentStory"][0] )
+        try:
+            self.memory_store = await ainvoke_llm ( self.llm , [self.first_prompt(**fields)] , node='store_to_memory' , check=memory_parser )
+        except LLMCallError:
+            warnings.warn(f"Memory store could not be created.")
+            raise
 
     def normal_store(self):
         """
         Stores a new outline of the story into memory, appending to existing memory.
         Uses the language model to process the new outline based on existing memory.
         :return: The updated memory_store content.
+        :raises LLMCallError: when no memory could be generated.
         """
         print ( f"Generating memory..." )
+        # The memory file grows every round, it is fitted to settings.PROMPT_BUDGETS like the new outline
+        fields = prompt_budget ( 'write_to_memory' , self.llm ).fit (
+            memory_storage=self.pull_memory() , new_outline=self.state["RecentStory"][-1] )
+        init_prompt = self.normal_prompt ( **fields )
         try:
-            system_message_prompt = SystemMessagePromptTemplate.from_template(SYS_MEMORY_PROMPT)
-            human_message = HumanMessagePromptTemplate.from_template(WRITE_MEMORY_PROMPT)
-            prompt_setting = ChatPromptTemplate.from_messages ( [system_message_prompt , human_message] )
-            init_prompt = prompt_setting.format (
-                topic = self.state['Topic'],
-                main_character = self.state['MainCharacter'],
-                main_goal = self.state['MainGoal'],
-                language = self.state['Language'],
-                new_outline = self.state["RecentStory"][-1],
-                memory_storage = self.pull_memory(MEMORY_STORAGE_PATH)
-            )
-            response = self.llm.invoke ( [init_prompt] ).content
-            memory = memory_parser(response)
-            self.memory_store = memory
-        except:
+            self.memory_store = invoke_llm ( self.llm , [init_prompt] , node='write_to_memory' , check=memory_parser )
+        except LLMCallError:
+            warnings.warn(f"Memory store could not be created.")
+            raise
+
+    async def anormal_store(self):
+        """
+        Async twin of normal_store, the memory file is read in a worker thread.
+        :raises LLMCallError: when no memory could be generated.
+        """
+        print ( f"Generating memory..." )
+        fields = await prompt_budget ( 'write_to_memory' , self.llm ).afit (
+            memory_storage=await asyncio.to_thread ( self.pull_memory ) , new_outline=self.state["RecentStory"][-1] )
+        init_prompt = self.normal_prompt ( **fields )
+        try:
+            self.memory_store = await ainvoke_llm ( self.llm , [init_prompt] , node='write_to_memory' , check=memory_parser )
+        except LLMCallError:
             warnings.warn(f"Memory store could not be created.")
-            sys.exit()
+            raise
 
-    def pull_memory(self, path:str = MEMORY_STORAGE_PATH):
+    def pull_memory(self, path:str = None):
         """
         Retrieves the current content of the memory_store.
         :return: The content stored in memory.
         """
         try:
             print(f"Pulling memory...")
-            with open(path,'r') as f:
+            with open(path or settings.MEMORY_STORAGE_PATH,'r') as f:
                 memory = f.read()
             return memory
         except:
             warnings.warn(f"Memory store could not be pulled.")
 
 
-    def write_down_settings(self,path:str=STORY_SETTING_PATH):
+    def write_down_settings(self,path:str=None):
         """
         Writes the story settings to a JSON file.
         :param path: The file path where the JSON data will be saved.
         """
         try:
             print(f"Writing settings to your story setting path...")
-            with open(path,'w') as f:
+            with open(path or settings.STORY_SETTING_PATH,'w') as f:
                 json.dump(self.state,f)
         except:
             warnings.warn(f"Memory store could not be written down.")
 
-    def write_down_memory(self,path:str = MEMORY_STORAGE_PATH):
+    def write_down_memory(self,path:str = None):
         """
         Writes the current memory_store content to a JSON file.
         :param path: The file path where the JSON data will be saved.
         """
         try:
             print ( f"Writing long-term memories to your story memory path..." )
-            with open(path,'a') as f:
+            with open(path or settings.MEMORY_STORAGE_PATH,'a') as f:
                 json.dump(self.memory_store,f)
         except:
             warnings.warn(f"Memory store could not be written down.")
 
-    def delete_memory(self,path:str = MEMORY_STORAGE_PATH):
+    async def awrite_down_settings(self,path:str=None):
+        """
+        Async twin of write_down_settings, the file is written in a worker thread.
+        """
+        await asyncio.to_thread ( self.write_down_settings , path )
+
+    async def awrite_down_memory(self,path:str = None):
+        """
+        Async twin of write_down_memory, the file is written in a worker thread.
+        """
+        await asyncio.to_thread ( self.write_down_memory , path )
+
+    def delete_memory(self,path:str = None):
         """
         Deletes the JSON file containing the memory_store content.
         :param path: The file path of the JSON file to be deleted.
         """
-        os.remove(path)
\ No newline at end of file
+        os.remove(path or settings.MEMORY_STORAGE_PATH)
\ No newline at end of file
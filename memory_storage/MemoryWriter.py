@@ -0,0 +1,131 @@
+'''
+-- @Time    : 2025/7/27 10:40
+-- @File    : MemoryWriter.py
+-- @Project : StoryGenerator
+-- @IDE     : PyCharm
+'''
+import asyncio
+import contextvars
+import queue
+import threading
+from typing import Callable, Dict, Optional
+
+## Write long-term memory in the background while the next round is generated
+#Invocation method:
+"""
+writer = memory_writer()
+writer.submit(lambda: MemoryStore(state).normal_store())  # returns at once, blocks only when the queue is full
+...
+writer.flush()  # before reading the memory file: waits for every submitted write, raises the first failure
+"""
+
+
+class MemoryWriter:
+    def __init__(self, maxsize: int = 2):
+        """
+        One worker thread running memory writes in submission order, so every write sees the memory of the ones before it.
+        Each job runs in a copy of the context it was submitted from.
+
+        :param maxsize: (int) Pending writes allowed before submit blocks, so memory never falls more than this many rounds behind.
+        """
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name='memory-writer', daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            context, job = self._queue.get()
+            try:
+                context.run(job)
+            except BaseException as e:
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def submit(self, job: Callable[[], None]):
+        """
+        Queue a memory write behind the pending ones.
+
+        :param job: (Callable) The write, called without arguments in the worker thread.
+        :raises Exception: the failure of an earlier write, so it surfaces at the next round instead of at the end.
+        """
+        self._raise_error()
+        self._queue.put((contextvars.copy_context(), job))
+
+    def flush(self):
+        """
+        Wait until every submitted write is done.
+
+        :raises Exception: the first failure among them.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def pending(self) -> int:
+        """
+        :return: (int) Writes submitted and not finished yet.
+        """
+        return self._queue.unfinished_tasks
+
+    async def asubmit(self, job: Callable[[], None]):
+        """
+        Async twin of submit, waits for room in the queue in a worker thread.
+        """
+        await asyncio.to_thread(self.submit, job)
+
+    async def aflush(self):
+        """
+        Async twin of flush.
+        """
+        await asyncio.to_thread(self.flush)
+
+
+_writers: Dict[str, MemoryWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def memory_writer(path: Optional[str] = None) -> MemoryWriter:
+    """
+    The background writer of one memory file, created on first use.
+
+    :param path: (str, optional) Memory file (default: settings.MEMORY_STORAGE_PATH).
+    :return: (MemoryWriter) Shared writer for that path.
+    """
+    import settings
+    if path is None:
+        path = settings.MEMORY_STORAGE_PATH
+    with _writers_lock:
+        if path not in _writers:
+            _writers[path] = MemoryWriter(settings.MEMORY_QUEUE_SIZE)
+        return _writers[path]
+
+
+def flush_memory(path: Optional[str] = None):
+    """
+    Wait for the pending background writes of a memory file, if it has a writer.
+
+    :param path: (str, optional) Memory file (default: settings.MEMORY_STORAGE_PATH).
+    :raises Exception: the first failure among them.
+    """
+    import settings
+    with _writers_lock:
+        writer = _writers.get(path or settings.MEMORY_STORAGE_PATH)
+    if writer is not None:
+        writer.flush()
+
+
+async def aflush_memory(path: Optional[str] = None):
+    """
+    Async twin of flush_memory.
+    """
+    await asyncio.to_thread(flush_memory, path)
@@ -4,21 +4,218 @@
 -- @Project : StoryGenerator
 -- @IDE     : PyCharm
 '''
+from contextvars import ContextVar
 from typing import Optional
-from langchain_anthropic import ChatAnthropic
 import os
-from langchain_openai import ChatOpenAI
+import threading
 
 current_dir = os.getcwd()
 EXPEND_LEN = 700# best set is 3500 for English
 SIMILARITY_THRESHOLD = 0.8
+# also route to a twist when the new outline is too close to ANY earlier outline, not only the previous one
+TWIST_ON_HISTORY = False
+NOVELTY_TOP_K = 3  # most similar earlier outlines reported per round
+# sentence embedding model of the starter's gates and paragraph segmentation, see Embedding/EmbeddingProvider.py
+EMBEDDING_MODEL = 'sentence-transformers/all-mpnet-base-v2'
+# model of the twist gate and every outline comparison (novelty index, local outline selector, prefetch drift check).
+# SIMILARITY_THRESHOLD 0.8 was tuned with MiniLM, re-check it when changing this; None shares EMBEDDING_MODEL (one model loaded)
+TWIST_EMBEDDING_MODEL: Optional[str] = 'sentence-transformers/all-MiniLM-L6-v2'
+# persistent embedding cache shared across rounds, runs and concurrent processes, None disables it
+EMBEDDING_CACHE_DIR = current_dir + "/memory_storage/embedding_cache"
+EMBEDDING_CACHE_SIZE = 50000  # max cached vectors per model, least recently used ones are evicted
+# CPU inference backend of the embedding model: 'torch', 'torch-int8' (dynamic int8 quantization), 'onnx' or 'openvino'.
+# Check twist decisions against full precision with `python -m Embedding.BackendCheck` after changing it.
+EMBEDDING_BACKEND = 'torch'
+EMBEDDING_ONNX_FILE: Optional[str] = None  # e.g. 'onnx/model_qint8_avx512.onnx', a pre-quantized ONNX export
+EMBEDDING_STORAGE_DTYPE = 'float32'  # 'float16' halves the embedding cache and novelty index
+EMBEDDING_TRUNCATE_DIM: Optional[int] = None  # keep only the first N embedding dimensions
+# Embed outlines longer than the model's max sequence length chunk by chunk instead of truncating them
+EMBEDDING_LONG_TEXT = True
+EMBEDDING_CHUNK_TOKENS = 200  # estimated tokens per chunk, below max_seq_length (256 for MiniLM, 384 for mpnet)
+# Cheap-first twist check: character n-gram similarity decides clear cases, the embedding model only runs
+# when the lexical score lies in [SIMILARITY_THRESHOLD - CASCADE_BAND[0], SIMILARITY_THRESHOLD + CASCADE_BAND[1]].
+# The band is not calibrated for your stories: check it with `python -m Embedding.CascadeCheck` before enabling it.
+# With a local PLAIN_SELECTOR the outlines are embedded for the novelty index anyway, so the cascade saves nothing there.
+SIMILARITY_CASCADE = False
+CASCADE_BAND = (0.35, 0.15)
+# Plain rounds: ask for PLAIN_CANDIDATES outlines in concurrent calls (one outline each) instead of one call writing three
+PLAIN_PARALLEL = False
+PLAIN_CANDIDATES = 3
+# How a plain round picks its outline: 'llm' (SELECT_PROMPT judge), 'local' (embeddings: relevance to MainGoal/Topic
+# plus novelty against the story, no LLM call) or 'local+llm' (local, LLM judge when the two best are within SELECTOR_MARGIN)
+PLAIN_SELECTOR = 'llm'
+SELECTOR_WEIGHTS = (1.0, 1.0)  # (relevance, novelty)
+SELECTOR_MARGIN = 0.02
+# Summarize each round into long-term memory in a background thread while the next round is generated;
+# writes run in order and whatever reads the memory file (End) waits for the pending ones
+MEMORY_BACKGROUND = True
+MEMORY_QUEUE_SIZE = 2  # pending writes before the graph waits for memory to catch up
+# Stream the expander's and the ending's tokens to the story file and the console as they arrive; drafts replaced by
+# a rewrite or failing the length check are truncated again. Events also reach graph.stream(..., stream_mode="custom")
+STREAM_STORY = False
+STREAM_TO_CONSOLE = True
+# Start the twist branch's KG extraction (catch_nodes_of_original_story) while the Expander reviews and rewrites,
+# when the previous round's similarity is within SPECULATION_MARGIN of SIMILARITY_THRESHOLD; the result is dropped
+# when the round goes plain. Hits and misses are shown in the report.
+SPECULATE_TWIST = False
+SPECULATION_MARGIN = 0.1
+SPECULATION_WORKERS = 2  # threads running speculations of synchronous runs
+# Generate the next round's plain outline (UTIL_LLM) from this round's outline while the writer model expands it,
+# dropped when the Expander's outline update drifts below PREFETCH_MIN_SIMILARITY or the next round is a twist
+PREFETCH_PLAIN = False
+PREFETCH_MIN_SIMILARITY = 0.85
+# Opt-in: an expansion shorter than EXPEND_LEN is continued by the writer (at most EXPAND_TOPUP_ROUNDS calls, stitched at
+# a sentence boundary) instead of generated again; 0 regenerates it as before. Responses under EXPAND_TOPUP_MIN_FRACTION
+# of the length are still generated again, topped-up ones are cut at a sentence end beyond EXPAND_TOPUP_MAX_OVERSHOOT.
+EXPAND_TOPUP_ROUNDS = 0  # e.g. 2
+EXPAND_TOPUP_MIN_FRACTION = 0.5
+EXPAND_TOPUP_MAX_OVERSHOOT = 0.5
+# Reader review of each expanded part: REVIEW_CRITICS are asked in concurrent calls, one aspect each ('logic', 'character',
+# 'pacing'); empty for one reader call reviewing logic and character growth together. Up to REVIEW_ROUNDS review + rewrite
+# rounds; with REVIEW_SKIP_EMPTY a review where no critic has anything to say ends them without a rewrite.
+REVIEW_CRITICS = ()
+REVIEW_ROUNDS = 1
+REVIEW_SKIP_EMPTY = True
+# First round: expand and review the first and the last outline concurrently instead of one after the other
+EXPAND_START_PARALLEL = False
 WRITE_TO_FILE: Optional[bool] = False
 MAX_LEN = 10000
 
-STORY_SETTING_PATH = current_dir + "/memory_storage/story_setting.json"
-MEMORY_STORAGE_PATH = current_dir + "/memory_storage/memory.json"
-FINAL_STORY_PATH = current_dir + "/result.json"
+# Files of one story, under the output directory of the running story: current_dir, or the job's own directory
+# when batch.py runs several stories at once (settings.OUTPUT_DIR is a ContextVar, see output_path).
+# settings.FINAL_STORY_PATH etc. are resolved on every read.
+OUTPUT_FILES = {
+    'STORY_SETTING_PATH': "memory_storage/story_setting.json",
+    'MEMORY_STORAGE_PATH': "memory_storage/memory.json",
+    'FINAL_STORY_PATH': "result.json",
+    'NOVELTY_INDEX_PATH': "memory_storage/novelty_index.npy",
+    'SIMILARITY_LOG_PATH': "memory_storage/similarity_pairs.jsonl",  # outline pairs the router scored
+}
+OUTPUT_DIR: ContextVar[str] = ContextVar('OUTPUT_DIR', default=current_dir)
+# which LLM to write story
+WRITE_LLM_MODEL = 'claude-3-sonnet-20240229'
 # which LLM to expand story
-WRITE_LLM = ChatAnthropic(model = 'claude-3-sonnet-20240229')
+EXPAND_LLM_MODEL = 'claude-3-opus-20240229'
 # which LLM to use as utils
-UTIL_LLM = ChatOpenAI(model = 'gpt-3.5-turbo')
\ No newline at end of file
+UTIL_LLM_MODEL = 'gpt-3.5-turbo'
+# which LLM to generate twist outlines, sampled hotter than the utility calls
+TWIST_LLM_MODEL = 'gpt-3.5-turbo'
+TWIST_LLM_TEMPERATURE = 0.8
+# every LLM call goes through LLM.invoke_llm: per-attempt deadline (seconds), attempts, exponential backoff with jitter
+LLM_TIMEOUT: Optional[float] = 120
+# Long generations get their own deadline (None: no deadline); streamed calls only time out after
+# LLM_STREAM_IDLE_TIMEOUT seconds without text. The clients get the longest deadline and no SDK retries of their own.
+LLM_NODE_TIMEOUTS = {
+    'generate_expansion:writer': 900,
+    'generate_expansion:rewrite': 900,
+    'generate_expansion:topup': 600,
+    'end_generation': 900,
+}
+LLM_STREAM_IDLE_TIMEOUT: Optional[float] = 60
+LLM_MAX_ATTEMPTS = 4
+LLM_THROTTLED_ATTEMPTS = 8  # rate limited / overloaded calls wait and retry longer instead of failing the story
+LLM_BACKOFF_BASE = 1.0
+LLM_BACKOFF_CAP = 30.0
+# Persistent prompt/response cache, opt-in per node, e.g. {'store_to_memory', 'write_to_memory',
+# 'catch_nodes_of_original_story', 'generate_plain_story:select', 'setting_of_story'} ('node' covers all 'node:part' calls).
+# Only identical provider, model, sampling parameters and rendered messages hit.
+LLM_CACHE_NODES: set = set()
+LLM_CACHE_PATH = current_dir + "/memory_storage/llm_cache.sqlite"
+LLM_CACHE_TTL: Optional[float] = 7 * 24 * 3600  # seconds, None keeps responses until evicted
+LLM_CACHE_MAX_ENTRIES = 10000
+# Requests / tokens per minute per model, shared by every thread, coroutine and (through LLM_RATE_STATE_DIR) process,
+# calls wait for capacity instead of being throttled, e.g. {WRITE_LLM_MODEL: (50, 40000), UTIL_LLM_MODEL: (3500, 90000)}
+LLM_RATE_LIMITS: dict = {}
+LLM_RATE_STATE_DIR: Optional[str] = current_dir + "/memory_storage/rate_limits"  # None: buckets of this process only
+LLM_RATE_OUTPUT_TOKENS = 1024  # completion tokens reserved per call before the provider reports the usage
+# Token budget and policy of the prompt fields that grow with the story, per node: field -> (max tokens, policy),
+# policy 'head', 'tail', 'middle' (both ends) or 'summarize' (UTIL_LLM summary, only when over budget).
+# Tokens are counted with tiktoken when it is installed, estimated otherwise; every call's prompt size is in the report.
+PROMPT_BUDGETS = {
+    'end_generation': {'specific_story': (4000, 'summarize'), 'outline': (1000, 'tail')},
+    'write_to_memory': {'memory_storage': (1500, 'middle'), 'new_outline': (1000, 'head')},
+    'store_to_memory': {'first_outline': (1000, 'head')},
+    'generate_plain_story': {'last_outline': (1000, 'tail'), 'long_term_memory': (1000, 'tail')},
+}
+# import-time budget (ms) checked by `python import_budget.py`
+IMPORT_BUDGET_MS = {
+    'main.py --help': 500,
+    'graph compilation': 3000,
+}
+
+
+def _client_timeout() -> Optional[float]:
+    # Backstop of the per-call deadlines LLM.invoke_llm binds to each request
+    deadlines = [LLM_TIMEOUT, *LLM_NODE_TIMEOUTS.values()]
+    return None if None in deadlines else max(deadlines)
+
+
+def _build_write_llm():
+    from langchain_anthropic import ChatAnthropic
+    return ChatAnthropic(model = WRITE_LLM_MODEL, timeout = _client_timeout(), max_retries = 0)
+
+
+def _build_expand_llm():
+    from langchain_anthropic import ChatAnthropic
+    return ChatAnthropic(model_name = EXPAND_LLM_MODEL, timeout = _client_timeout(), max_retries = 0)
+
+
+def _build_util_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model = UTIL_LLM_MODEL, timeout = _client_timeout(), max_retries = 0)
+
+
+def _build_twist_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model = TWIST_LLM_MODEL, temperature = TWIST_LLM_TEMPERATURE, timeout = _client_timeout(), max_retries = 0)
+
+
+_LLM_FACTORIES = {
+    'WRITE_LLM': _build_write_llm,
+    'EXPAND_LLM': _build_expand_llm,
+    'UTIL_LLM': _build_util_llm,
+    'TWIST_LLM': _build_twist_llm,
+}
+_llm_lock = threading.Lock()
+
+
+def get_llm(name: str):
+    """
+    Return the shared client named WRITE_LLM, EXPAND_LLM, UTIL_LLM or TWIST_LLM, building it the first time it is asked for,
+    so importing settings never imports an LLM client library or asks for API keys.
+    Nodes call get_llm at run time; graph compilation only sees the function, never the client.
+    Assigning settings.WRITE_LLM = <your model> before the first call replaces the default client.
+
+    :param name: (str) One of 'WRITE_LLM', 'EXPAND_LLM', 'UTIL_LLM', 'TWIST_LLM'.
+    :return: (BaseChatModel) The client.
+    """
+    if name not in _LLM_FACTORIES:
+        raise KeyError(f"Unknown LLM '{name}', choose one of {list(_LLM_FACTORIES)}")
+    with _llm_lock:
+        if name not in globals():
+            from utils import set_env
+            set_env()
+            globals()[name] = _LLM_FACTORIES[name]()
+    return globals()[name]
+
+
+def output_path(name: str) -> str:
+    """
+    Path of one story file in the output directory of the running story.
+
+    :param name: (str) One of OUTPUT_FILES, e.g. 'FINAL_STORY_PATH'.
+    :return: (str) Absolute path.
+    """
+    return os.path.join(OUTPUT_DIR.get(), OUTPUT_FILES[name])
+
+
+def __getattr__(name: str):
+    """
+    Keeps `settings.WRITE_LLM` / `from settings import UTIL_LLM` working, the client is built on first read.
+    Story file paths (settings.FINAL_STORY_PATH, ...) are resolved in the output directory of the running story.
+    """
+    if name in _LLM_FACTORIES:
+        return get_llm(name)
+    if name in OUTPUT_FILES:
+        return output_path(name)
+    raise AttributeError(f"module 'settings' has no attribute '{name}'")
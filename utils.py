@@ -3,13 +3,19 @@
 This is a Python test script. Write some content you want to test:
 This is some utils you may want to see?
 '''
-import re
 # I tested the other method to calculate the similarity is that one better?see Expander/interact
 # I think I put some nodes there.
 
 def pass_INFO(state):
     return state
+_ENV_READY = False
 def set_env():
+    """
+    Ask for missing API keys and set MKL variables. Runs only once per process, later calls return immediately.
+    """
+    global _ENV_READY
+    if _ENV_READY:
+        return
     import os , getpass
     def _set_env(var: str):
         if not os.environ.get ( var ):
@@ -21,30 +27,33 @@ def set_env():
     os.environ['MKL_THREADING_LAYER'] = 'GNU'
     _set_env ( "OPENAI_API_KEY" )
     _set_env ( "ANTHROPIC_API_KEY" )
+    _ENV_READY = True
 
-from typing import List
+from typing import List, Optional, Tuple, TYPE_CHECKING
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sentence_transformers import  util
 import os
 # Set environment variables to ignore MKL warnings
 os.environ['MKL_SERVICE_FORCE_INTEL'] = '1'
 os.environ['MKL_THREADING_LAYER'] = 'GNU'
-embedder = SentenceTransformer('sentence-transformers/all-mpnet-base-v2')
+# The embedding model is loaded lazily by the shared provider, see Embedding/EmbeddingProvider.py
+from Embedding import provider
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 def get_content_between_a_b(a, b, text, none_delete_n = False):
     """
-    Extract content between a and b from text using regular expressions.
+    Extract content between a and b from text, see LLM.OutputParser.between:
+    markers match case-insensitively with flexible whitespace, a missing end marker ends the content
+    at the next '## Header:' line or the end of the text.
 
     :param a: Start marker
     :param b: End marker
     :param text: Text to extract from
+    :param none_delete_n: Kept for compatibility, the content is always stripped
     :return: Extracted content with leading and trailing whitespace removed
+    :raises SectionMissing: (a ValueError) when the start marker is missing
     """
-    if none_delete_n:
-        return re.search(f"{a}(.*?)\n{b}", text, re.DOTALL).group(1).strip()
-
-    else:
-        return re.search(f"{a}(.*?)\n{b}", text, re.DOTALL).group(1).strip().strip("\n")
+    from LLM.OutputParser import between
+    return between(a, b, text)
 if __name__ == '__main__':
     test_text = """
     ## start
@@ -71,10 +80,8 @@ def content2list(content:str):
     return: list[str]: List containing non-empty paragraphs.
     """
     if "\n" in content:
-        paralists = content.split("\n")
         # Remove empty strings from the list
-        while '' in paralists:
-            paralists.remove('')
+        paralists = [para for para in content.split("\n") if para != '']
     else:
         paralists = [content]
     return paralists
@@ -89,27 +96,52 @@ def para_length(paralists:List[str]):
     Returns:
     numpy.ndarray: Array containing the cumulative sum of string lengths of paragraphs in the input list.
     """
-    len_para = []
-    len_paras_sum = []
-    tmp = 0
     try:
-        for i in paralists:
-            tmp += len(i)
-            len_para.append(len(i))
-            len_paras_sum.append(tmp)
-        len_paras_sum = np.array(len_paras_sum)
-        return len_paras_sum
+        return np.cumsum(np.fromiter(map(len, paralists), dtype=np.int64, count=len(paralists)))
     except:
         return np.array([0])
 
 
-def get_similarity(paralists:List[str], embedder:SentenceTransformer = embedder):
+def encode_paragraphs(paralists:List[str], embedder:Optional["SentenceTransformer"] = None, batch_size:int = 32, name:Optional[str] = None):
+    """
+    Encode every paragraph of the list in one batched forward pass.
+
+    Parameters:
+    paralists (list): List of paragraph strings to encode.
+    embedder: Embedding model used to encode paragraph strings (default: the shared provider's model).
+    batch_size (int): Number of paragraphs sent to the model per forward pass.
+    name (str, optional): Model of the shared provider (default: settings.EMBEDDING_MODEL).
+
+    Returns:
+    numpy.ndarray: L2-normalised float32 embeddings, one row per paragraph.
+    """
+    if embedder is None:
+        return provider.encode(paralists, name, batch_size)
+    embeddings = embedder.encode(list(paralists), batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def adjacent_similarity(embeddings:np.ndarray):
+    """
+    Cosine similarity between every pair of adjacent rows of a normalised embedding matrix, computed as one row-wise dot product.
+
+    Parameters:
+    embeddings (numpy.ndarray): L2-normalised embeddings, one row per paragraph.
+
+    Returns:
+    numpy.ndarray: Array of length len(embeddings) - 1 whose i-th score compares row i with row i+1.
+    """
+    return np.einsum("ij,ij->i", embeddings[:-1], embeddings[1:])
+
+
+def get_similarity(paralists:List[str], embedder:Optional["SentenceTransformer"] = None):
     """
     Calculate similarity scores between adjacent paragraph string pairs using an embedding model.
+    All paragraphs are encoded once in a single batched call, then the adjacent cosine scores are computed together.
 
     Parameters:
     paralists (list): List of paragraph strings for which similarity scores need to be calculated.
-    embedder: Embedding model used to encode paragraph strings.
+    embedder: Embedding model used to encode paragraph strings (default: the configured model of the shared provider).
 
     Returns:
     numpy.ndarray: Array containing similarity scores between adjacent paragraph string pairs, with an additional score of 1 at the beginning.
@@ -120,17 +152,9 @@ def get_similarity(paralists:List[str], embedder:SentenceTransformer = embedder)
                         0.87858981
                         0.88035393]
     """
-    simi_score = []
-    for i in range(len(paralists)-1):
-        # Encode current paragraph
-        target_embedding = embedder.encode(paralists[i], convert_to_tensor=True)
-        # Encode next paragraph
-        others_embedding = embedder.encode(paralists[i+1], convert_to_tensor=True)
-        # Calculate cosine similarity
-        memory_scores = util.cos_sim(target_embedding, others_embedding)
-        numpy_scores = memory_scores.cpu().numpy()
-        simi_score.append(numpy_scores)
-    simi_score = np.array(simi_score).reshape(1,-1)[0]
+    if len(paralists) < 2:
+        return np.array([1.])
+    simi_score = adjacent_similarity(encode_paragraphs(paralists, embedder))
     simi_score = np.concatenate(([1], simi_score))
     return simi_score
 
@@ -148,34 +172,99 @@ def max_drop(simi_score:np.ndarray, max_drop_threshold=0.1, score_threshold=0.7,
     Returns:
     numpy.ndarray: Array containing indices where similarity scores drop significantly and fall below the threshold.
     """
-    simi_score = simi_score[mode:]
-    diff = [0]
-    for i in range(len(simi_score)-1):
-        diff.append(simi_score[i]-simi_score[i+1])
-    diff = np.array(diff)
+    simi_score = np.asarray(simi_score)[mode:]
+    # diff[i] = simi_score[i-1] - simi_score[i], with 0 for the first score
+    diff = np.concatenate(([0], -np.diff(simi_score)))
     # Find indices where the difference is greater than the maximum drop threshold
     idx = (np.argwhere(diff > max_drop_threshold)).flatten()
     del_id = np.where(simi_score[idx] >= score_threshold)
     idx = np.delete(idx, del_id)
     return idx+mode
 
-def calculate_two_para_similarity(para1:str, para2:str, model:SentenceTransformer = embedder):
-    str1_embedding = model.encode(para1,convert_to_tensor=True)
-    str2_embedding = model.encode(para2, convert_to_tensor=True)
-    similarity_score = util.cos_sim(str1_embedding, str2_embedding)
-    return similarity_score
+def calculate_two_para_similarity(para1:str, para2:str, model:Optional["SentenceTransformer"] = None):
+    """
+    Cosine similarity of two paragraphs, encoded together in one batched call.
+
+    :param para1: (str) First paragraph.
+    :param para2: (str) Second paragraph.
+    :param model: (SentenceTransformer, optional) Embedding model used to encode both paragraphs (default: the configured model).
+    :return: (float) Cosine similarity score.
+    """
+    return float(adjacent_similarity(encode_paragraphs([para1, para2], model))[0])
+
 
 
+def window_bounds(len_paras:np.ndarray, min_length:int = 200, str_range:int = 1000):
+    """
+    Left and right paragraph indices of every window the segmentation walks through.
+    Window k spans cumulative lengths [min_length + k*str_range, min_length + (k+1)*str_range], clipped to the total length;
+    its left (right) index is the first paragraph whose cumulative length reaches the lower (upper) bound.
+    All windows are located with one searchsorted call instead of rescanning the cumulative array per window.
+
+    Parameters:
+    len_paras (numpy.ndarray): Cumulative paragraph lengths, see para_length.
+    min_length (int): Cumulative length where the first window starts.
+    str_range (int): Length covered by one window.
+
+    Returns:
+    numpy.ndarray, numpy.ndarray: Left indices and right indices of the windows, in order.
+    """
+    assert str_range > 0, f"str_range must be positive, got {str_range}"
+    total = len_paras[-1]
+    n_windows = max(int(np.ceil((total - min_length) / str_range)), 1)
+    bounds = np.minimum(min_length + str_range * np.arange(n_windows + 1, dtype=np.float64), total)
+    lefts = np.searchsorted(len_paras, bounds[:-1], side='left')
+    rights = np.searchsorted(len_paras, bounds[1:], side='left')
+    return lefts, rights
 
-def Seperate_window(paralists:List, simi_score:List, min_length:int = 200,str_range:int=1000,threshold:float=None):
+
+def segment_argmin(simi_score:np.ndarray, starts:np.ndarray, ends:np.ndarray):
+    """
+    Index of the lowest score inside each of several disjoint, increasing, non-empty ranges [start, end), in O(n) total.
+    Ties go to the first index, like np.argmin.
+
+    Parameters:
+    simi_score (numpy.ndarray): Similarity scores.
+    starts (numpy.ndarray): First index of every range.
+    ends (numpy.ndarray): End index (exclusive) of every range, each end is smaller than the next start.
+
+    Returns:
+    numpy.ndarray: Absolute index of the minimum of every range.
+    """
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    n = len(simi_score)
+    # Minimum of every range: reduceat over [start, end) pairs, keep the even slots
+    edges = np.stack((starts, ends), axis=1).ravel()
+    # Pad one element so an end equal to n is still a valid reduceat index
+    padded = np.append(simi_score, simi_score[-1])
+    range_min = np.minimum.reduceat(padded, edges)[::2]
+    # Owner range of every position, and whether the position lies inside its range
+    marks = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(marks, starts, 1)
+    np.add.at(marks, ends, -1)
+    inside = np.cumsum(marks)[:n] > 0
+    is_start = np.zeros(n, dtype=bool)
+    is_start[starts] = True
+    owner = np.cumsum(is_start) - 1
+    own_min = range_min[np.maximum(owner, 0)]
+    hit = inside & ((simi_score == own_min) | (np.isnan(simi_score) & np.isnan(own_min)))
+    hits = np.flatnonzero(hit)
+    return hits[np.searchsorted(hits, starts)]
+
+
+def Seperate_window(paralists:List, simi_score:List, min_length:int = 200,str_range:int=1000,threshold:float=None, verbose:bool=True):
     """
     Move a window to find suitable paragraph indices for segmentation based on paragraph length and similarity scores.
+    Each window cuts at its lowest similarity score. Windows are located with cumsum + searchsorted and their minima
+    are found in one vectorized pass, so the cost is O(n) in the number of paragraphs.
     Parameters:
     paralists (list): Input paragraph list.
     simi_score (list): List of similarity scores between adjacent paragraphs.
     min_length (int): Minimum paragraph length requirement.
     str_range (int): Paragraph length range.
     threshold (float): Similarity score threshold.
+    verbose (bool): Print every window and warnings, set False for a quiet run.
     Returns:
     list: List of segmented paragraph indices.
     Input paragraph list: ['This is the content of the first paragraph.',
@@ -187,52 +276,38 @@ def Seperate_window(paralists:List, simi_score:List, min_length:int = 200,str_ra
     Segmented paragraph index list: [1]
     """
     len_paras = para_length(paralists)
+    n = len(paralists)
     if len_paras[-1] <= min_length:
-        print(f"Paragraphs' length too short, paragraph list: [{paralists[0]}...(etc)] requiring total length larger than {min_length} up to the last paragraph: {len_paras[-1]}.\n"
-              f"Paragraph length is too short. Paragraph list: [{paralists[0]}...(etc)] requires cumulative length greater than {min_length} for the last paragraph, but actual length is {len_paras[-1]}. Cutting directly")
-        return [len(paralists)-1]
-    left = -2
-    right = 0
-    min_threshold, max_threshold= 0,0
+        if verbose:
+            print(f"Paragraphs' length too short, paragraph list: [{paralists[0]}...(etc)] requiring total length larger than {min_length} up to the last paragraph: {len_paras[-1]}.\n"
+                  f"Paragraph length is too short. Paragraph list: [{paralists[0]}...(etc)] requires cumulative length greater than {min_length} for the last paragraph, but actual length is {len_paras[-1]}. Cutting directly")
+        return [n-1]
+    simi_score = np.asarray(simi_score)
     # Dimension check
     assert len(len_paras)==len(simi_score), f"Dimension Not Match for {len(len_paras)} == {len(simi_score)}\nDimension mismatch {len(len_paras)} == {len(simi_score)}"
-    chosen_idx = []
-    while left < right and right <(len(paralists) -1):
-        right = min ( right , len ( paralists ) - 1 )
-        if min_threshold == 0:
-            min_threshold = min ( min_length , len_paras[-1] )
-        else:
-            min_threshold = min ( max_threshold , len_paras[-1] )
-        max_threshold = min ( min_threshold + str_range , len_paras[-1] )
-        # print(min_threshold, max_threshold, len_paras - min_threshold)
-        try:
-            # Find the first index where cumulative length is greater than or equal to the minimum threshold
-            left = int(np.argwhere((len_paras - min_threshold)>=0)[0][0])# type: ignore
-            # Find the first index where cumulative length is greater than or equal to the maximum threshold
-            print('left',left)
-            right = int(np.argwhere((len_paras - max_threshold)>=0)[0][0]) # type: ignore
-            print('right',right)
-        except:
-            print(f""" Unable to find suitable left (cumulative length <= minimum threshold) and right (cumulative length >= maximum threshold) indices!\n
-            len_paras(number of paragraphs): {len_paras}, min_threshold(current minimum threshold): {min_threshold}
-            len_paras - min_threshold(cumulative paragraph length - minimum threshold): {len_paras - min_threshold}
-            """)
-        try:
-            idx = np.argmin(simi_score[left+1:right])+left+1
-        except:
-            print(f""" ValueERROR, you can reset your thresholds. Threshold setting is unreasonable, left idx (cumulative length <= minimum threshold) index= {left}, right idx (cumulative length >= maximum threshold) index= {right}""")
-            right = right + 1
-            continue
+    chosen_idx = np.zeros(0, dtype=np.int64)
+    if n > 1:
+        lefts, rights = window_bounds(len_paras, min_length, str_range)
+        # A window needs at least one paragraph strictly between its left and right index
+        valid = rights - lefts >= 2
+        # The walk stops after the first window that reaches the last paragraph (an empty window counts one further)
+        reached_end = np.flatnonzero(rights + ~valid >= n - 1)
+        walked = reached_end[0] + 1 if len(reached_end) else len(lefts)
+        lefts, rights, valid = lefts[:walked], rights[:walked], valid[:walked]
+        if verbose and not valid.all():
+            print(f""" ValueERROR, you can reset your thresholds. Threshold setting is unreasonable, empty windows (left idx, right idx): {list(zip(lefts[~valid].tolist(), rights[~valid].tolist()))}""")
+        lefts, rights = lefts[valid], rights[valid]
+        chosen_idx = segment_argmin(simi_score, lefts + 1, rights)
+        if verbose:
+            for left, right, idx in zip(lefts, rights, chosen_idx):
+                print(f"left(first index with cumulative length <= minimum threshold)={left}, right(first index with cumulative length >= maximum threshold)={right}, chosen idx={idx}, its score={simi_score[idx]}")
         if threshold:
-            if simi_score[idx] < threshold:
-                chosen_idx.append(idx)
-        else:chosen_idx.append(idx)
-        print(f"left(first index with cumulative length <= minimum threshold)={left}, right(first index with cumulative length >= maximum threshold)={right}, chosen idx={idx}, its score={simi_score[idx]}")
-
+            chosen_idx = chosen_idx[simi_score[chosen_idx] < threshold]
 
     if len(chosen_idx) < 1:
-        print(f"WEIRD Content!! Please Check!!{'='*50}\nContentERROR:{paralists}\n{'='*100}")
-        chosen_idx.append(len(paralists)-1)
+        if verbose:
+            print(f"WEIRD Content!! Please Check!!{'='*50}\nContentERROR:{paralists}\n{'='*100}")
+        chosen_idx = np.array([n-1])
     return [int(idx) for idx in chosen_idx]
 
 def Seperate_similiraty(paralists:List, simi_score:List, threshold:float=None):
@@ -241,16 +316,18 @@ def Seperate_similiraty(paralists:List, simi_score:List, threshold:float=None):
     Parameters:
     paralists (list): Input paragraph list.
     simi_score (list): List of similarity scores between adjacent paragraphs.
-    threshold (float): Similarity score threshold.
+    threshold (float): Similarity score threshold, None gives no cut.
     Returns:
     list: List of segmented paragraph indices.
     """
-    idxes = np.argwhere(simi_score< threshold)
+    if threshold is None:
+        return []
+    idxes = np.flatnonzero(np.asarray(simi_score) < threshold)
     return [int(idx) for idx in idxes]
 
 
-def Seperate(paralists:List, simi_score:List, min_length:int = 200,str_range:int=1000,threshold_windows:float=None, threshold_smiliraty:float=None):
-    idx_win = Seperate_window(paralists, simi_score, min_length, str_range, threshold_windows)
+def Seperate(paralists:List, simi_score:List, min_length:int = 200,str_range:int=1000,threshold_windows:float=None, threshold_smiliraty:float=None, verbose:bool=True):
+    idx_win = Seperate_window(paralists, simi_score, min_length, str_range, threshold_windows, verbose)
     idx_simi = Seperate_similiraty(paralists, simi_score, threshold_smiliraty)
     idx = idx_win+idx_simi
     return sorted(list(set(idx)))
@@ -292,6 +369,213 @@ def cut_paras(paralists:List[str], cut_idx:List[int]):
     return paraparts, merge
 
 
+"""
+Streaming version of the segmentation above: content2list -> get_similarity -> Seperate -> cut_paras,
+for story files too long to hold in memory together with all their paragraph embeddings.
+Paragraphs are read in chunks, embedded in bounded batches, and segments are emitted as soon as their cut points are settled.
+"""
+
+def iter_paragraphs(source, chunk_size:int = 1 << 16):
+    """
+    Read a text file chunk by chunk and yield its non-empty paragraphs (lines), like content2list.
+
+    Parameters:
+    source (str or file): Path of the text file (e.g. result.json) or an open text file.
+    chunk_size (int): Number of characters read at a time.
+
+    Yields:
+    str: One non-empty paragraph at a time.
+    """
+    f = open(source, 'r', encoding='utf-8') if isinstance(source, str) else source
+    try:
+        tail = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (tail + chunk).split("\n")
+            # The last piece may continue in the next chunk
+            tail = lines.pop()
+            for line in lines:
+                if line != '':
+                    yield line
+        if tail != '':
+            yield tail
+    finally:
+        if isinstance(source, str):
+            f.close()
+
+
+def iter_similarity(paragraphs, embedder:Optional["SentenceTransformer"] = None, batch_size:int = 64):
+    """
+    Stream version of get_similarity: embed paragraphs in bounded batches and yield each paragraph with its score.
+    The last embedding of a batch is carried over, so scores across batch boundaries are the same as get_similarity's.
+
+    Parameters:
+    paragraphs (iterable): Paragraph strings.
+    embedder: Embedding model (default: the configured model of the shared provider).
+    batch_size (int): Paragraphs embedded per call, bounds the memory used by embeddings.
+
+    Yields:
+    (str, float): Paragraph and its similarity to the previous paragraph (1 for the first one).
+    """
+    previous = None
+    batch = []
+
+    def flush(batch, previous):
+        embeddings = encode_paragraphs(batch, embedder, batch_size)
+        first = 1. if previous is None else float(previous @ embeddings[0])
+        scores = np.concatenate(([first], adjacent_similarity(embeddings)))
+        return zip(batch, scores.tolist()), embeddings[-1]
+
+    for paragraph in paragraphs:
+        batch.append(paragraph)
+        if len(batch) == batch_size:
+            pairs, previous = flush(batch, previous)
+            yield from pairs
+            batch = []
+    if batch:
+        pairs, previous = flush(batch, previous)
+        yield from pairs
+
+
+class StreamingSegmenter:
+    def __init__(self, min_length:int = 200, str_range:int = 1000, threshold_windows:float = None,
+                 threshold_smiliraty:float = None, merge_length:int = 100):
+        """
+        Incremental Seperate + cut_paras. Paragraphs are pushed one at a time with their similarity score;
+        window state (cumulative length, current window, its lowest score) is carried between pushes,
+        so the cut points are the same as Seperate's on the full list. Only the paragraphs of the last,
+        not yet emitted segments are kept in memory.
+
+        :param min_length: (int) Minimum paragraph length requirement, as in Seperate_window.
+        :param str_range: (int) Paragraph length range, as in Seperate_window.
+        :param threshold_windows: (float) Similarity threshold of window cuts, as in Seperate.
+        :param threshold_smiliraty: (float) Similarity threshold of direct cuts, as in Seperate.
+        :param merge_length: (int) A last segment shorter than this is merged into the previous one, as in cut_paras.
+        """
+        assert str_range > 0, f"str_range must be positive, got {str_range}"
+        self.min_length = min_length
+        self.str_range = str_range
+        self.threshold_windows = threshold_windows
+        self.threshold_smiliraty = threshold_smiliraty
+        self.merge_length = merge_length
+        self.n = 0                    # paragraphs pushed so far
+        self.total = 0                # their cumulative length
+        self.lower = min_length       # cumulative length bounds of the current window
+        self.upper = min_length + str_range
+        self.left = None              # left index of the current window, None until the first window opens
+        self.best = None              # (score, index) lowest score strictly inside the current window
+        self.previous = None          # (index, score) of the last paragraph, not yet known to be inside a window
+        self.window_cuts = 0
+        self.pending = set()          # cut points that may still be preceded by a later cut
+        self.segment_start = 0        # index of the first buffered paragraph
+        self.buffer = []              # paragraphs from segment_start on
+        self.held = None              # last finished segment, kept back in case the final segment merges into it
+
+    def push(self, paragraph:str, score:float) -> List[Tuple[int, List[str]]]:
+        """
+        Add the next paragraph.
+
+        :param paragraph: (str) The paragraph.
+        :param score: (float) Its similarity to the previous paragraph (1 for the first one).
+        :return: (List[Tuple[int, List[str]]]) Segments finished by this paragraph, as (index of first paragraph, paragraphs).
+        """
+        i = self.n
+        self.n += 1
+        self.total += len(paragraph)
+        self.buffer.append(paragraph)
+        # The previous paragraph is not a window's right index, so it lies inside the current window
+        if self.left is not None and self.previous is not None and self.previous[0] > self.left:
+            self._consider(*self.previous)
+        if self.left is None and self.total >= self.lower:
+            self.left = i
+        if self.left is not None:
+            while self.total >= self.upper:
+                self._close_window(i)
+        self.previous = (i, score)
+        if self.threshold_smiliraty is not None and score < self.threshold_smiliraty:
+            self.pending.add(i)
+        # Later window cuts lie after the current window's left index, later direct cuts after i
+        return self._settle(i if self.left is None else self.left)
+
+    def close(self) -> List[Tuple[int, List[str]]]:
+        """
+        End of input: close the last window, apply the fallback cut and the short-last-segment merge.
+
+        :return: (List[Tuple[int, List[str]]]) Remaining segments, as (index of first paragraph, paragraphs).
+        """
+        if self.n == 0:
+            return []
+        if self.total <= self.min_length:
+            self.pending.add(self.n - 1)
+        else:
+            # The last window always ends at the last paragraph
+            self._close_window(self.n - 1)
+            if self.window_cuts == 0:
+                self.pending.add(self.n - 1)
+        out = self._settle(self.n)
+        last = (self.segment_start, self.buffer)
+        self.buffer = []
+        if self.held is None:
+            return out + [last]
+        if len("\n".join(last[1])) < self.merge_length:
+            return out + [(self.held[0], self.held[1] + last[1])]
+        return out + [self.held, last]
+
+    def _consider(self, idx:int, score:float):
+        if self.best is None or score < self.best[0]:
+            self.best = (score, idx)
+
+    def _close_window(self, right:int):
+        if self.best is not None:
+            score, idx = self.best
+            if not self.threshold_windows or score < self.threshold_windows:
+                self.pending.add(idx)
+                self.window_cuts += 1
+        self.left = right
+        self.best = None
+        self.lower = self.upper
+        self.upper += self.str_range
+
+    def _settle(self, frontier:int) -> List[Tuple[int, List[str]]]:
+        out = []
+        for cut in sorted(c for c in self.pending if c <= frontier):
+            self.pending.discard(cut)
+            if cut <= self.segment_start:
+                continue
+            segment = self.buffer[:cut - self.segment_start]
+            self.buffer = self.buffer[cut - self.segment_start:]
+            if self.held is not None:
+                out.append(self.held)
+            self.held = (self.segment_start, segment)
+            self.segment_start = cut
+        return out
+
+
+def stream_segments(source, min_length:int = 200, str_range:int = 1000, threshold_windows:float = None,
+                    threshold_smiliraty:float = None, embedder:Optional["SentenceTransformer"] = None,
+                    batch_size:int = 64, chunk_size:int = 1 << 16):
+    """
+    Segment a long story file with flat memory: read in chunks, embed in bounded batches, emit segments incrementally.
+    Gives the same segments as cut_paras(paralists, Seperate(paralists, get_similarity(paralists), ...)).
+
+    Parameters:
+    source (str or file): Path of the text file (e.g. result.json) or an open text file.
+    min_length, str_range, threshold_windows, threshold_smiliraty: See Seperate.
+    embedder: Embedding model (default: the configured model of the shared provider).
+    batch_size (int): Paragraphs embedded per call.
+    chunk_size (int): Characters read from the file at a time.
+
+    Yields:
+    (int, list): Cut point (index of the segment's first paragraph) and the paragraphs of the segment.
+    """
+    segmenter = StreamingSegmenter(min_length, str_range, threshold_windows, threshold_smiliraty)
+    for paragraph, score in iter_similarity(iter_paragraphs(source, chunk_size), embedder, batch_size):
+        yield from segmenter.push(paragraph, score)
+    yield from segmenter.close()
+
+
 def plot_cut(simi_score, cut_idx, title:str):
     """
     Visualize similarity scores and cutting points.
@@ -301,6 +585,7 @@ def plot_cut(simi_score, cut_idx, title:str):
     cut_idx (list): List of cutting point indices.
     title (str): Chart title.
     """
+    import matplotlib.pyplot as plt
     plt.title(title)
     # print(len(simi_score[cut_idx]), simi_score[cut_idx])
     # Draw scatter plot of all similarity scores
@@ -314,8 +599,6 @@ def plot_cut(simi_score, cut_idx, title:str):
     plt.show()
 
 
-import networkx as nx
-import matplotlib.pyplot as plt
 import json
 
 def visualize_knowledge_graph(json_data, output_file, title="visual KG", figsize=(12, 10), font_family=None):
@@ -329,6 +612,9 @@ def visualize_knowledge_graph(json_data, output_file, title="visual KG", figsize
     - figsize: Image size, tuple (width, height)
     - font_family: Specify Chinese-supported fonts, such as ["SimHei", "WenQuanYi Micro Hei", "Heiti TC"]
     """
+    # Plotting libraries are only needed here, import them on first use
+    import networkx as nx
+    import matplotlib.pyplot as plt
     # If input is a JSON string, parse it into a dict
     if isinstance(json_data, str):
         try: